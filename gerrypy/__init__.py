@@ -1,14 +1,18 @@
 import os
 from pyramid.config import Configurator
 
+from gerrypy.scripts.fish_scales import warm_state_template
+
 
 def main(global_config, **settings): # pragma: no cover
     """ This function returns a Pyramid WSGI application.
     """
-    settings = {'sqlalchemy.url': os.environ["DATABASE_URL"]}
+    settings['sqlalchemy.url'] = os.environ['DATABASE_URL']
     config = Configurator(settings=settings)
     config.include('pyramid_jinja2')
     config.include('.models')
     config.include('.routes')
     config.scan()
-    return config.make_wsgi_app()
+    app = config.make_wsgi_app()
+    warm_state_template(app.registry)  # Every request's State is cloned from it.
+    return app
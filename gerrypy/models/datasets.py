@@ -0,0 +1,100 @@
+"""
+The states the app can draw districts for.
+
+Each dataset has its own tract, edge, arc and arc level tables and its own
+number of districts.  Colorado's are the tables in mymodel.py; every other
+state's tables are named after it, as texas_tracts, texas_edge, texas_arc
+and texas_arc_level, and are declared here the first time they are asked
+for.  scripts/initializedb.py loads a state's tables with dataset=<name>.
+
+Besides Colorado, the datasets are listed in the gerrypy.datasets setting,
+one per line as
+
+    name num_dst latitude longitude zoom
+
+where the latitude, longitude and zoom are where the map starts.
+"""
+
+import re
+import threading
+from collections import OrderedDict, namedtuple
+
+from .meta import Base
+from .mymodel import (
+    Arc, ArcColumns, ArcLevel, ArcLevelColumns, Edge, EdgeColumns, Tract, TractColumns
+)
+
+
+Dataset = namedtuple('Dataset', 'name title num_dst tract edge arc arc_level center zoom')
+Dataset.__doc__ = """A state: its name, title, number of districts, table models, and the map's center and zoom."""
+
+COLORADO = Dataset('colorado', 'Colorado', 7, Tract, Edge, Arc, ArcLevel, (39.0, -106.0), 7)
+NAME = re.compile(r'^[a-z][a-z0-9_]*$')  # Names go into table names, so nothing that needs quoting.
+
+_models = {'colorado': (Tract, Edge, Arc, ArcLevel)}
+_registries = {}
+_lock = threading.Lock()
+
+
+def dataset_models(name):
+    """Return the (tract, edge, arc, arc level) models of the named state, declaring them once."""
+    if not NAME.match(name):
+        raise ValueError('{!r} is not a dataset name.'.format(name))
+    with _lock:
+        if name not in _models:
+            prefix = ''.join(part.title() for part in name.split('_'))
+            _models[name] = tuple(
+                type(prefix + model, (columns, Base), {'__tablename__': '{}_{}'.format(name, table)})
+                for model, columns, table in (
+                    ('Tract', TractColumns, 'tracts'),
+                    ('Edge', EdgeColumns, 'edge'),
+                    ('Arc', ArcColumns, 'arc'),
+                    ('ArcLevel', ArcLevelColumns, 'arc_level'),
+                )
+            )
+        return _models[name]
+
+
+def make_dataset(name, num_dst, center, zoom):
+    """Return the Dataset for the named state."""
+    tract, edge, arc, arc_level = dataset_models(name)
+    return Dataset(name, name.replace('_', ' ').title(), num_dst, tract, edge, arc, arc_level, center, zoom)
+
+
+def parse_datasets(text):
+    """Return an OrderedDict of name -> Dataset for Colorado and every line of text.
+
+    A line for Colorado changes its district count or map but not its tables.
+    Raises ValueError for a line that isn't name, num_dst, latitude,
+    longitude and zoom.
+    """
+    datasets = OrderedDict([(COLORADO.name, COLORADO)])
+    for line in (text or '').splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        fields = line.split()
+        if len(fields) != 5:
+            raise ValueError('Dataset line {!r} is not "name num_dst latitude longitude zoom".'.format(line))
+        name, num_dst, lat, lng, zoom = fields
+        datasets[name] = make_dataset(name, int(num_dst), (float(lat), float(lng)), int(zoom))
+    return datasets
+
+
+def get_datasets(request):
+    """Return the app's datasets, parsed once per process."""
+    registry = getattr(request, 'registry', None)
+    settings = getattr(registry, 'settings', None) or {}
+    text = settings.get('gerrypy.datasets') or ''
+    with _lock:
+        datasets = _registries.get(text)
+    if datasets is None:
+        datasets = parse_datasets(text)
+        with _lock:
+            _registries[text] = datasets
+    return datasets
+
+
+def get_dataset(request, name):
+    """Return the named dataset, or None if the app has no such state."""
+    return get_datasets(request).get(name)
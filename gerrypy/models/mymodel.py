@@ -2,47 +2,132 @@
 
 from sqlalchemy import (
     Column,
+    DateTime,
+    ForeignKey,
     Index,
     Integer,
     Float,
-    Numeric
+    Numeric,
+    SmallInteger,
+    String,
+    func
 )
 
 from geoalchemy2 import Geometry
 from .meta import Base
 
 
-# This View uses on the fly calculations to agregate district data and shapes
-class DistrictView(Base):
-    """Model for each district built by the program."""
+# The columns of each table a state dataset has.  Colorado's tables are
+# declared below; models/datasets.py declares the other states' tables
+# from the same columns under their own names.
+class TractColumns(object):
+    """The columns of a tract table."""
 
-    __tablename__ = 'vwdistrict'
-    districtid = Column(Integer, primary_key=True)
-    area = Column(Float)
-    population = Column(Integer)
-    geom = Column(Geometry('MultiPolygon'))
-
-
-# Tract table built from a Census shapefile using PostGIS
-class Tract(Base):
-    """Tract model in the db."""
-
-    __tablename__ = 'colorado_tracts'
     gid = Column(Integer, primary_key=True)
     districtid = Column(Integer)
     shape_area = Column(Numeric)
     tract_pop = Column(Integer)
-    geom = Column(Geometry('MultiPolygon'))
+    geom = Column(Geometry('MultiPolygon', srid=4269))
     isborder = Column(Integer)
     county = Column(Integer)
+    perimeter = Column(Float)  # Length of the whole boundary, in the units of Edge.length.
 
 
-# The edges are calculated using the PostGIS function ST_Touches
-# They represent tract borders, and become edges in the graph
-class Edge(Base):
-    """Edge model in the database."""
+class EdgeColumns(object):
+    """The columns of an edge table."""
 
-    __tablename__ = 'edge'
     edgeid = Column(Integer, primary_key=True)
     tract_source = Column(Integer)
     tract_target = Column(Integer)
+    length = Column(Float)  # Length of the shared border; 0 where tracts only meet at a corner.
+
+
+class ArcColumns(object):
+    """The columns of an arc table."""
+
+    arcid = Column(Integer, primary_key=True)
+    tract_gid = Column(Integer)  # The tract whose ring runs along the arc in this direction.
+    other_gid = Column(Integer)  # The tract across the arc; 0 on the state's edge.
+    geom = Column(Geometry('LineString', srid=4269))
+
+
+class ArcLevelColumns(object):
+    """The columns of an arc level table."""
+
+    arcid = Column(Integer, primary_key=True)
+    level = Column(SmallInteger, primary_key=True)
+    geom = Column(Geometry('LineString', srid=4269))
+
+
+# Tract table built from a Census shapefile using PostGIS
+class Tract(TractColumns, Base):
+    """Tract model in the db."""
+
+    __tablename__ = 'colorado_tracts'
+
+
+# The edges are found from the tract boundaries by scripts/adjacency.py
+# They represent tract borders, and become edges in the graph
+class Edge(EdgeColumns, Base):
+    """Edge model in the database."""
+
+    __tablename__ = 'edge'
+
+
+# Arcs are cut from the tract boundaries by scripts/topology.py
+# District outlines are assembled from them instead of unioning tracts
+class Arc(ArcColumns, Base):
+    """A run of tract boundary with the same tract on its far side."""
+
+    __tablename__ = 'arc'
+
+
+class ArcLevel(ArcLevelColumns, Base):
+    """An arc simplified to one of the tolerances in scripts/topology.py."""
+
+    __tablename__ = 'arc_level'
+
+
+# Every generated plan gets its own rows, so plans never overwrite each other
+class Plan(Base):
+    """A districting plan built by the program."""
+
+    __tablename__ = 'plan'
+    planid = Column(Integer, primary_key=True)
+    dataset = Column(String, nullable=False, server_default='colorado')  # Whose tract table the gids are from.
+    created = Column(DateTime, server_default=func.now())
+
+
+class PlanAssignment(Base):
+    """The district a plan gives one tract.  Unclaimed tracts have no row."""
+
+    __tablename__ = 'plan_assignment'
+    planid = Column(Integer, ForeignKey('plan.planid', ondelete='CASCADE'), primary_key=True)
+    gid = Column(Integer, primary_key=True)
+    districtid = Column(SmallInteger, nullable=False)
+
+
+def plan_totals(dbsession, planid, tract=Tract):
+    """Query each district of a plan with its area and population.
+
+    tract is the tract model of the plan's dataset.
+    """
+    return dbsession.query(
+        PlanAssignment.districtid,
+        func.sum(tract.shape_area).label('area'),
+        func.sum(tract.tract_pop).label('population'),
+    ).join(tract, tract.gid == PlanAssignment.gid).filter(
+        PlanAssignment.planid == planid
+    ).group_by(PlanAssignment.districtid).order_by(PlanAssignment.districtid)
+
+
+def plan_districts(dbsession, planid, tract=Tract):
+    """Query each district of a plan with its area, population and shape as GeoJSON.
+
+    This replaces the vwdistrict view, which could only aggregate the
+    districtid column of the shared tract table.  The shapes are unioned
+    by PostGIS; scripts/topology.py dissolves them from arcs instead.
+    """
+    return plan_totals(dbsession, planid, tract).add_columns(
+        func.ST_AsGeoJSON(func.ST_Multi(func.ST_Union(tract.geom))).label('geojson')
+    )
@@ -1,6 +1,16 @@
 def includeme(config):
     config.add_static_view(name='static', path='gerrypy:static')
-    config.add_static_view('json', path='gerrypy:views')
     config.add_route('home', '/')
     config.add_route('map', '/map')
+    config.add_route('state_map', '/map/{state}')
+    config.add_route('plan_geojson', r'/plans/{planid:\d+}/geo.json')
+    config.add_route('plan_districts', r'/plans/{planid:\d+}/districts.bin')
+    config.add_route('tract_geojson', '/tracts/geo.json')
+    config.add_route('state_tract_geojson', '/tracts/{state}/geo.json')
+    config.add_route('evaluate', '/evaluate')
+    config.add_route('state_evaluate', '/evaluate/{state}')
+    config.add_route('plan_tile', r'/tiles/{planid:\d+}/{z:\d+}/{x:\d+}/{y:\d+}.mvt')
+    config.add_route('job', '/jobs/{jobid}')
+    config.add_route('job_result', '/jobs/{jobid}/result')
+    config.add_route('job_cancel', '/jobs/{jobid}/cancel')
     config.add_route('about', '/about')
@@ -0,0 +1,347 @@
+"""
+Find which tracts border each other, and by how much, from their rings.
+
+This replaces the PostGIS ST_Touches self-join.  Every ring is broken into
+segments, which are matched in two stages, in parallel when asked:
+
+1. Segments with identical endpoints are paired through a hash table.  In
+   topologically clean data such as the Census TIGER files, that is
+   nearly every shared boundary.  The segments are spilled to temporary
+   files as they are read, bucketed by a hash of their endpoints so that
+   both sides of a boundary land in the same bucket, and matched a bucket
+   at a time.  Only one bucket per worker is ever in memory, so block-level
+   states load in the memory of a fraction of their segments.
+2. The segments left over are split into vertical strips of roughly equal
+   size.  In each strip they go into a uniform grid, and segments of
+   different tracts that share a cell are tested for collinear overlap.
+   overlap_splits finds the same overlaps for topology.py, which cuts them
+   into identical segments so its arcs pair the tracts these edges do.
+
+Boundary that no other tract shares lies on the edge of the state, which is
+how isborder is found.  What is kept in memory throughout is one total per
+tract and per pair of neighbors.
+"""
+
+import bisect
+import os
+import shutil
+import struct
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from math import hypot, sqrt
+
+
+DEFAULT_TOLERANCE = 1e-8  # Coordinate units; about a millimeter in degrees.
+DEFAULT_STRIPS = 8
+DEFAULT_BUCKETS = 16
+SEGMENT = struct.Struct('<q4d')  # gid, start, end
+VERTEX = struct.Struct('<q2d')  # gid, point
+
+
+class Adjacency(object):
+    """The result of matching tract boundaries.
+
+    lengths maps each (gid, gid) pair, lower gid first, to the length of
+    boundary the two tracts share.  Pairs that only meet at a corner have a
+    length of 0.  perimeter and outer map each gid to its total boundary
+    length and to the part of it no other tract shares.
+    """
+
+    def __init__(self, lengths, perimeter, outer, tolerance=DEFAULT_TOLERANCE):
+        """Initialize the Adjacency Object."""
+        self.lengths = lengths
+        self.perimeter = perimeter
+        self.outer = outer
+        self.tolerance = tolerance
+
+    def isborder(self, gid):
+        """Return 1 if some of the tract's boundary is on the state's edge."""
+        return int(self.outer.get(gid, 0) > self.tolerance)
+
+    def edge_rows(self):
+        """Yield (edgeid, source, target, length) in both directions, as the edge table holds them."""
+        edgeid = 0
+        for (source, target), length in sorted(self.lengths.items()):
+            edgeid += 1
+            yield edgeid, source, target, length
+            edgeid += 1
+            yield edgeid, target, source, length
+
+
+def tract_segments(tracts):
+    """Yield (gid, start, end) for every non-degenerate segment of every ring.
+
+    tracts is an iterable of (gid, rings) with each ring a list of (x, y).
+    """
+    for gid, rings in tracts:
+        for ring in rings:
+            for start, end in zip(ring, ring[1:]):
+                if start != end:
+                    yield gid, start, end
+
+
+def segment_key(start, end):
+    """Order a segment's endpoints so both of its tracts produce the same key."""
+    return (start, end) if start <= end else (end, start)
+
+
+class BucketFiles(object):
+    """Fixed-size records spilled to temporary files, one file per bucket.
+
+    add(self, bucket, *values) appends a record to a bucket, and after
+    close(self) read_records reads a bucket back from its path in paths.
+    Used as a context manager, the files are deleted on the way out.
+    """
+
+    def __init__(self, record, buckets, directory=None):
+        """Initialize the BucketFiles Object."""
+        self.record = record
+        self.directory = tempfile.mkdtemp(prefix='gerrypy-', dir=directory)
+        self.paths = [os.path.join(self.directory, '{}.bin'.format(bucket)) for bucket in range(buckets)]
+        self._files = [open(path, 'wb') for path in self.paths]
+
+    def add(self, bucket, *values):
+        """Append a record to bucket."""
+        self._files[bucket].write(self.record.pack(*values))
+
+    def close(self):
+        """Finish writing every bucket."""
+        for the_file in self._files:
+            the_file.close()
+
+    def __enter__(self):
+        """Return the BucketFiles."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close and delete the files."""
+        self.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def read_records(path, record_format):
+    """Return every record in a bucket file as a tuple."""
+    with open(path, 'rb') as the_file:
+        return list(struct.iter_unpack(record_format, the_file.read()))
+
+
+def _add_length(lengths, gid_a, gid_b, length):
+    """Add length to the (lower gid, higher gid) pair."""
+    pair = (gid_a, gid_b) if gid_a < gid_b else (gid_b, gid_a)
+    lengths[pair] = lengths.get(pair, 0.0) + length
+
+
+def _match_exact(segments, vertices):
+    """Pair identical segments and shared vertices within one bucket.
+
+    Returns (lengths, shared, leftover, touches): shared lengths by pair and
+    by gid, the segments that found no twin, and the pairs that share one of
+    the (gid, point) vertices.  A bucket holds every segment with its key
+    and every vertex at its points.
+    """
+    owners = {}
+    for gid, start, end in segments:
+        key = segment_key(start, end)
+        owners.setdefault(key, []).append(gid)
+    lengths = {}
+    shared = defaultdict(float)
+    leftover = []
+    for key, gids in owners.items():
+        if len(gids) == 2 and gids[0] != gids[1]:
+            (x1, y1), (x2, y2) = key
+            length = hypot(x2 - x1, y2 - y1)
+            _add_length(lengths, gids[0], gids[1], length)
+            shared[gids[0]] += length
+            shared[gids[1]] += length
+        else:
+            leftover.extend((gid, key[0], key[1]) for gid in gids)
+    meeting = defaultdict(set)
+    for gid, point in vertices:
+        meeting[point].add(gid)
+    touches = set()
+    for gids in meeting.values():
+        if len(gids) > 1:
+            ordered = sorted(gids)
+            for idx, gid_a in enumerate(ordered):
+                for gid_b in ordered[idx + 1:]:
+                    touches.add((gid_a, gid_b))
+    return lengths, dict(shared), leftover, touches
+
+
+def _match_bucket(segment_path, vertex_path):
+    """Read one bucket's segments and vertices from their files and pair them as _match_exact does."""
+    segments = [(gid, (x1, y1), (x2, y2)) for gid, x1, y1, x2, y2 in read_records(segment_path, SEGMENT.format)]
+    vertices = [(gid, (x, y)) for gid, x, y in read_records(vertex_path, VERTEX.format)]
+    return _match_exact(segments, vertices)
+
+
+def _overlap(first, second, tolerance):
+    """Return (length, midpoint) of the collinear overlap of two segments, or None."""
+    (ax, ay), (bx, by) = first
+    (cx, cy), (dx, dy) = second
+    ux, uy = bx - ax, by - ay
+    norm = hypot(ux, uy)
+    if abs(ux * (cy - ay) - uy * (cx - ax)) > tolerance * norm:
+        return None
+    if abs(ux * (dy - ay) - uy * (dx - ax)) > tolerance * norm:
+        return None
+    t_c = (ux * (cx - ax) + uy * (cy - ay)) / norm
+    t_d = (ux * (dx - ax) + uy * (dy - ay)) / norm
+    low = max(0.0, min(t_c, t_d))
+    high = min(norm, max(t_c, t_d))
+    if high - low <= tolerance:
+        return None
+    middle = (low + high) / 2 / norm
+    return high - low, (ax + ux * middle, ay + uy * middle)
+
+
+def _overlapping(segments, tolerance):
+    """Yield (first, second, (length, midpoint)) for each collinear overlap between segments of different tracts.
+
+    first and second index segments, a list of (gid, start, end).  The
+    segments go into a uniform grid, and only those sharing a cell are tested.
+    """
+    if not segments:
+        return
+    xs = [x for gid, start, end in segments for x in (start[0], end[0])]
+    ys = [y for gid, start, end in segments for y in (start[1], end[1])]
+    min_x, min_y = min(xs), min(ys)
+    span = max(max(xs) - min_x, max(ys) - min_y, tolerance)
+    cell = span / max(1, int(sqrt(len(segments))))
+    grid = defaultdict(list)
+    for idx, (gid, start, end) in enumerate(segments):
+        col_low = int((min(start[0], end[0]) - tolerance - min_x) // cell)
+        col_high = int((max(start[0], end[0]) + tolerance - min_x) // cell)
+        row_low = int((min(start[1], end[1]) - tolerance - min_y) // cell)
+        row_high = int((max(start[1], end[1]) + tolerance - min_y) // cell)
+        for col in range(col_low, col_high + 1):
+            for row in range(row_low, row_high + 1):
+                grid[col, row].append(idx)
+    seen = set()
+    for members in grid.values():
+        for position, first in enumerate(members):
+            gid_a, start_a, end_a = segments[first]
+            for second in members[position + 1:]:
+                gid_b, start_b, end_b = segments[second]
+                if gid_a == gid_b or (first, second) in seen:
+                    continue
+                seen.add((first, second))
+                found = _overlap((start_a, end_a), (start_b, end_b), tolerance)
+                if found:
+                    yield first, second, found
+
+
+def _match_overlaps(segments, x_low, x_high, tolerance):
+    """Find collinear overlaps between segments of different tracts.
+
+    Only overlaps whose midpoint falls in [x_low, x_high) are counted, so a
+    segment may be handed to several strips without being counted twice.
+    """
+    lengths = {}
+    shared = defaultdict(float)
+    for first, second, (length, middle) in _overlapping(segments, tolerance):
+        if x_low <= middle[0] < x_high:
+            gid_a, gid_b = segments[first][0], segments[second][0]
+            _add_length(lengths, gid_a, gid_b, length)
+            shared[gid_a] += length
+            shared[gid_b] += length
+    return lengths, dict(shared)
+
+
+def _within(start, end, point, tolerance):
+    """Check whether point, collinear with the segment, lies inside it and not at either end."""
+    ux, uy = end[0] - start[0], end[1] - start[1]
+    norm = hypot(ux, uy)
+    along = (ux * (point[0] - start[0]) + uy * (point[1] - start[1])) / norm
+    return tolerance < along < norm - tolerance
+
+
+def overlap_splits(segments, tolerance=DEFAULT_TOLERANCE):
+    """Return {(gid, segment key): points} splitting collinear overlaps into identical segments.
+
+    segments is a list of (gid, start, end), those that matched no twin.
+    Each segment that overlaps another tract's is split at the other's ends
+    that fall inside it, so both sides of the overlap then run between the
+    same two points.  The overlaps are the ones build_adjacency counts.
+    """
+    splits = defaultdict(set)
+    for first, second, found in _overlapping(segments, tolerance):
+        for this, other in ((first, second), (second, first)):
+            gid, start, end = segments[this]
+            for point in segments[other][1:]:
+                if _within(start, end, point, tolerance):
+                    splits[gid, segment_key(start, end)].add(point)
+    return dict(splits)
+
+
+def _strip_bounds(segments, strips):
+    """Choose strip boundaries that give each strip about as many segments."""
+    xs = sorted(segment_key(start, end)[0][0] for gid, start, end in segments)
+    if not xs:
+        return []
+    return sorted(set(xs[len(xs) * idx // strips] for idx in range(1, strips)))
+
+
+def _merge(target, source):
+    """Add every value in source into target."""
+    for key, value in source.items():
+        target[key] = target.get(key, 0.0) + value
+
+
+def build_adjacency(tracts, workers=1, strips=DEFAULT_STRIPS, tolerance=DEFAULT_TOLERANCE, queen=True,
+                    buckets=DEFAULT_BUCKETS, directory=None):
+    """Match tract boundaries and return an Adjacency.
+
+    tracts is an iterable of (gid, rings).  Segments are spilled to buckets
+    temporary files in directory, the system's by default; more buckets
+    hold less in memory at once.  With workers > 1, the buckets and strips
+    are matched in a process pool.  With queen, tracts that only meet at a
+    shared vertex are neighbors too, as ST_Touches would report them.
+    """
+    perimeter = defaultdict(float)
+    lengths = {}
+    shared = {}
+    leftovers = []
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    mapper = executor.map if executor else map
+    try:
+        with BucketFiles(SEGMENT, buckets, directory) as segment_files, \
+                BucketFiles(VERTEX, buckets, directory) as vertex_files:
+            for gid, start, end in tract_segments(tracts):
+                perimeter[gid] += hypot(end[0] - start[0], end[1] - start[1])
+                key = segment_key(start, end)
+                segment_files.add(hash(key) % buckets, gid, key[0][0], key[0][1], key[1][0], key[1][1])
+                if queen:
+                    vertex_files.add(hash(start) % buckets, gid, start[0], start[1])
+            segment_files.close()
+            vertex_files.close()
+            for bucket_lengths, bucket_shared, leftover, touches in mapper(
+                _match_bucket, segment_files.paths, vertex_files.paths
+            ):  # Merged as each bucket comes back, so only the totals build up.
+                for pair in touches:
+                    lengths.setdefault(pair, 0.0)
+                _merge(lengths, bucket_lengths)
+                _merge(shared, bucket_shared)
+                leftovers.extend(leftover)
+        bounds = _strip_bounds(leftovers, strips)
+        edges = [float('-inf')] + bounds + [float('inf')]
+        leftover_by_strip = [[] for _ in edges[1:]]
+        for segment in leftovers:  # Hand each leftover to every strip its x-extent crosses.
+            gid, start, end = segment
+            first = bisect.bisect_right(bounds, min(start[0], end[0]) - tolerance)
+            last = bisect.bisect_right(bounds, max(start[0], end[0]) + tolerance)
+            for strip in range(first, last + 1):
+                leftover_by_strip[strip].append(segment)
+        del leftovers
+        for strip_lengths, strip_shared in mapper(
+            _match_overlaps, leftover_by_strip, edges[:-1], edges[1:],
+            [tolerance] * len(leftover_by_strip)
+        ):
+            _merge(lengths, strip_lengths)
+            _merge(shared, strip_shared)
+    finally:
+        if executor:
+            executor.shutdown()
+    outer = {gid: max(0.0, length - shared.get(gid, 0.0)) for gid, length in perimeter.items()}
+    return Adjacency(lengths, dict(perimeter), outer, tolerance)
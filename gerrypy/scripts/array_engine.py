@@ -0,0 +1,375 @@
+"""
+Build districts over the CSR tract graph with flat arrays.
+
+ArrayState draws the same plans as fish_scales.State, step for step, but
+keeps the assignment, the perimeters and the per-district tallies in
+arrays indexed by tract, so no networkx graph or tract objects are built.
+Districts are numbered from 1 and 0 means a tract is still unoccupied.
+
+Whole-graph passes (finding islands, counting hops between districts) are
+vectorized over the CSR arrays with NumPy.  Growing a district touches one
+tract and its few neighbors at a time, where a NumPy call costs more than
+the work it does, so that loop runs over plain lists.
+"""
+
+from heapq import heappop, heappush
+from random import Random
+
+import numpy as np
+from gerrypy.scripts.assigndistrict import assign_gids
+from gerrypy.scripts.fish_scales import polsby_popper, split_components
+from gerrypy.scripts.refine import Refiner
+from gerrypy.scripts.snapshot import request_tract_graph
+
+
+UNOCCUPIED = 0
+NO_HOPS = np.iinfo(np.int64).max  # No district reaches the tract.
+
+
+def expand(offsets, neighbors, tracts):
+    """Return the neighbors of every tract in tracts, one slice after another."""
+    starts = offsets[tracts]
+    lengths = offsets[tracts + 1] - starts
+    ends = np.cumsum(lengths)
+    steps = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - lengths, lengths)
+    return neighbors[np.repeat(starts, lengths) + steps]
+
+
+def label_islands(offsets, neighbors):
+    """Number the connected pieces of the graph in order of their lowest tract."""
+    island = np.full(len(offsets) - 1, -1, dtype=np.int64)
+    label = 0
+    for root in range(len(island)):
+        if island[root] >= 0:
+            continue
+        island[root] = label
+        frontier = np.array([root], dtype=np.int64)
+        while len(frontier):
+            reached = expand(offsets, neighbors, frontier)
+            frontier = np.unique(reached[island[reached] < 0])
+            island[frontier] = label
+        label += 1
+    return island
+
+
+class ArrayState(object):
+    """Distributes tracts into districts with the State algorithm over arrays.
+
+    fill_state(self, criteria): builds every district, as State.fill_state
+    does, and stores the plan, keeping its id in planid.
+
+    build(self, criteria): builds every district and returns the district
+    of each tract, in gid order, without touching the database.
+
+    Besides State's criteria, ties='random' breaks rating ties by a random
+    ranking of the tracts, drawn from criteria['seed'], instead of by
+    which tract reached the perimeter first.
+
+    With criteria['refine'] set, build finishes with refine(), as
+    State.fill_state does, and keeps the Refinement in refinement.
+    """
+
+    def __init__(self, request, num_dst, tract_graph=None):
+        """Initialize the ArrayState Object."""
+        if tract_graph is None:
+            tract_graph = request_tract_graph(request)
+        self.request = request
+        self.num_dst = num_dst
+        self.tract_graph = tract_graph
+        self.gid = np.asarray(tract_graph.gid, dtype=np.int64)
+        self.offsets = np.asarray(tract_graph.offsets, dtype=np.int64)
+        self.neighbors = np.asarray(tract_graph.neighbors, dtype=np.int64)
+        flat = self.neighbors.tolist()
+        bounds = self.offsets.tolist()
+        self.adjacency = [flat[start:end] for start, end in zip(bounds, bounds[1:])]
+        lengths = list(tract_graph.lengths)
+        self.lengths = [lengths[start:end] for start, end in zip(bounds, bounds[1:])]
+        self.perimeter = list(tract_graph.perimeter)
+        self.tract_pop = list(tract_graph.tract_pop)  # Python numbers, so sums match State exactly.
+        self.shape_area = list(tract_graph.shape_area)
+        self.isborder = list(tract_graph.isborder)
+        counties, county = np.unique(np.asarray(tract_graph.county, dtype=np.int64), return_inverse=True)
+        self.county = county.tolist()
+        self.num_counties = len(counties)
+        self.island = label_islands(self.offsets, self.neighbors).tolist()
+        self.random = Random()
+        self.planid = None
+        self.refinement = None
+        self.reset()
+
+    def reset(self):
+        """Return every tract to the unoccupied districts."""
+        num_tracts = len(self.adjacency)
+        self.assignment = [UNOCCUPIED] * num_tracts
+        num_islands = max(self.island) + 1 if num_tracts else 0
+        self.unoccupied = list(range(num_islands))
+        self.unoc_population = [0] * num_islands
+        self.unoc_size = [0] * num_islands
+        for tract, island in enumerate(self.island):
+            self.unoc_population[island] += self.tract_pop[tract]
+            self.unoc_size[island] += 1
+        self.population = sum(self.unoc_population)
+        self.area = sum(self.shape_area)
+        self.unoc_seq = [-1] * num_tracts  # Position on the unoccupied perimeter, -1 when off it.
+        self.unoc_added = 0
+        for tract in range(num_tracts):
+            if self.isborder[tract] == 1:
+                self.unoc_seq[tract] = self.unoc_added
+                self.unoc_added += 1
+        self.populations = []
+        self.areas = []
+        self.boundaries = []  # Each district's outline length, as OccupiedDist.boundary.
+        self.cut_edges = []
+        self.hops = None
+
+    def fill_state(self, criteria):
+        """Build districts until all unoccupied tracts are claimed."""
+        self.build(criteria)
+        self.planid = assign_gids(self.request, zip(self.gid.tolist(), self.districtids()))
+
+    def build(self, criteria):
+        """Build every district and return the assignment as an array."""
+        self.reset()
+        self.random.seed(criteria.get('seed'))
+        self.tie_rank = None
+        if criteria.get('ties', 'first') == 'random':  # Rank tracts at random to break rating ties.
+            self.tie_rank = list(range(len(self.adjacency)))
+            self.random.shuffle(self.tie_rank)
+        for num in range(self.num_dst):
+            rem_pop = 0
+            for island in self.unoccupied:
+                rem_pop += self.unoc_population[island]
+            rem_dist = self.num_dst - len(self.populations)
+            tgt_population = rem_pop / rem_dist
+            self.build_district(tgt_population, num + 1, criteria)
+        if int(criteria.get('refine', 0)):
+            self.refine()
+        return np.array(self.assignment, dtype=np.int64)
+
+    def refine(self):
+        """Move border tracts between districts until their populations are as even as Refiner gets them."""
+        self.refinement = Refiner(self.tract_graph, self.assignment, self.num_dst).refine()
+        for tract, (old, new) in enumerate(zip(self.assignment, self.refinement.assignment)):
+            if old != new:
+                self.leave(old, tract)
+                self.assignment[tract] = new
+                self.join(new, tract)
+        return self.refinement
+
+    def leave(self, dist_num, tract):
+        """Take a moving tract out of dist_num's tallies, as OccupiedDist.rem_node does."""
+        inside, shared = self.tally_edges(dist_num, tract)
+        index = dist_num - 1
+        self.populations[index] -= self.tract_pop[tract]
+        self.areas[index] -= self.shape_area[tract]
+        self.boundaries[index] -= self.perimeter[tract] - 2 * shared
+        self.cut_edges[index] -= len(self.adjacency[tract]) - 2 * inside
+
+    def join(self, dist_num, tract):
+        """Add a moving tract to dist_num's tallies, as OccupiedDist.add_node does."""
+        inside, shared = self.tally_edges(dist_num, tract)
+        index = dist_num - 1
+        self.populations[index] += self.tract_pop[tract]
+        self.areas[index] += self.shape_area[tract]
+        self.boundaries[index] += self.perimeter[tract] - 2 * shared
+        self.cut_edges[index] += len(self.adjacency[tract]) - 2 * inside
+
+    def tally_edges(self, dist_num, tract):
+        """Return how many of tract's neighbors are in dist_num and the boundary it shares with them."""
+        inside = 0
+        shared = 0.0
+        for neighbor, length in zip(self.adjacency[tract], self.lengths[tract]):
+            if neighbor != tract and self.assignment[neighbor] == dist_num:
+                inside += 1
+                shared += length
+        return inside, shared
+
+    def districtids(self):
+        """Return each tract's district in gid order, None if unclaimed."""
+        return [districtid or None for districtid in self.assignment]
+
+    def polsby_popper(self):
+        """Return each district's Polsby-Popper score, in district order."""
+        return [polsby_popper(area, boundary) for area, boundary in zip(self.areas, self.boundaries)]
+
+    def build_district(self, tgt_population, dist_num, criteria):
+        """Grow district dist_num from a start tract toward tgt_population."""
+        num_tracts = len(self.adjacency)
+        self.dst_seq = [-1] * num_tracts  # Position on the district's perimeter, -1 when off it.
+        self.dst_added = 0
+        self.dst_perimeter = []
+        self.inside = [0] * num_tracts
+        self.shared = [0.0] * num_tracts  # Boundary each tract shares with the district.
+        self.dst_counties = [0] * self.num_counties
+        self.heap = []
+        self.weights = (int(criteria['compactness']), int(criteria['county']), int(criteria.get('polsby', 0)))
+        self.populations.append(0)
+        self.areas.append(0)
+        self.boundaries.append(0.0)
+        self.cut_edges.append(0)
+        start = self.find_start(criteria.get('seeding', 'border'))
+        self.swap(dist_num, start)
+        self.absorb_split(dist_num, start)
+        while True:
+            new_tract = self.select_next()
+            if new_tract is None:
+                for island in self.unoccupied:  # The same removal as State, skips and all.
+                    if not self.unoc_size[island]:
+                        self.unoccupied.remove(island)
+                break
+            population = self.populations[-1]
+            high_pop = self.tract_pop[new_tract] + population
+            if abs(high_pop - tgt_population) > abs(population - tgt_population):
+                break
+            self.swap(dist_num, new_tract)
+            self.absorb_split(dist_num, new_tract)
+        if self.hops is not None:
+            self.add_hop_sources(np.flatnonzero(np.array(self.assignment) == dist_num))
+
+    def unassigned_neighbors(self, tract):
+        """Return the tract's unoccupied neighbors in ascending order."""
+        assignment = self.assignment
+        return [neighbor for neighbor in self.adjacency[tract] if assignment[neighbor] == UNOCCUPIED]
+
+    def rating(self, tract):
+        """Rate a perimeter tract for the district, as Frontier does."""
+        compactness_weight, county_weight, polsby_weight = self.weights
+        same_county = 1 if self.dst_counties[self.county[tract]] else 0
+        rating = self.inside[tract] * compactness_weight + same_county * county_weight
+        if polsby_weight and self.perimeter[tract]:
+            rating += polsby_weight * self.shared[tract] / self.perimeter[tract]
+        return rating
+
+    def push(self, tract):
+        """Re-rate an unoccupied perimeter tract."""
+        heappush(self.heap, (-self.rating(tract), self.dst_seq[tract], tract))
+
+    def swap(self, dist_num, tract):
+        """Move tract from the first unoccupied district into dist_num."""
+        assignment = self.assignment
+        unoc_seq = self.unoc_seq
+        dst_seq = self.dst_seq
+        inside = self.inside
+        shared = self.shared
+        island = self.unoccupied[0]
+        self.unoc_population[island] -= self.tract_pop[tract]
+        self.unoc_size[island] -= 1
+        unoc_seq[tract] = -1
+        for neighbor in self.adjacency[tract]:  # Its neighbors now border the hole it leaves.
+            if assignment[neighbor] == UNOCCUPIED and unoc_seq[neighbor] < 0:
+                unoc_seq[neighbor] = self.unoc_added
+                self.unoc_added += 1
+
+        assignment[tract] = dist_num
+        dst_seq[tract] = -1
+        inside[tract] = 0
+        shared[tract] = 0.0
+        self.populations[-1] += self.tract_pop[tract]
+        self.areas[-1] += self.shape_area[tract]
+        county = self.county[tract]
+        self.dst_counties[county] += 1
+        if self.dst_counties[county] == 1:  # A new county raises every perimeter tract in it.
+            for neighbor in self.dst_perimeter:
+                if dst_seq[neighbor] >= 0 and assignment[neighbor] == UNOCCUPIED and self.county[neighbor] == county:
+                    self.push(neighbor)
+        neighbors = self.adjacency[tract]
+        joined = 0
+        boundary = self.perimeter[tract]
+        for neighbor, length in zip(neighbors, self.lengths[tract]):
+            if assignment[neighbor] == dist_num:
+                joined += 1
+                boundary -= 2 * length
+            else:
+                inside[neighbor] += 1
+                shared[neighbor] += length
+                if dst_seq[neighbor] < 0:
+                    dst_seq[neighbor] = self.dst_added if self.tie_rank is None else self.tie_rank[neighbor]
+                    self.dst_added += 1
+                    self.dst_perimeter.append(neighbor)
+                if assignment[neighbor] == UNOCCUPIED:
+                    self.push(neighbor)
+        self.boundaries[-1] += boundary
+        self.cut_edges[-1] += len(neighbors) - 2 * joined
+
+    def absorb_split(self, dist_num, tract):
+        """Give dist_num every piece of unoccupied land that tract's removal cut off from the largest."""
+        if not self.unoccupied:
+            return
+        sources = self.unassigned_neighbors(tract)
+        if len(sources) > 1:
+            pieces = split_components(sources, self.unassigned_neighbors, self.tract_pop.__getitem__)
+            for tracts, population in pieces:
+                for piece_tract in tracts:
+                    self.swap(dist_num, piece_tract)
+
+    def select_next(self):
+        """Return the best rated unoccupied tract bordering the district, or None.
+
+        Ties go to the tract that joined the perimeter first, or to the
+        lower random rank.  Outdated heap
+        entries are dropped when they reach the top.
+        """
+        heap = self.heap
+        while heap:
+            negative, position, tract = heap[0]
+            if (
+                self.assignment[tract] == UNOCCUPIED and self.dst_seq[tract] == position and
+                self.rating(tract) == -negative
+            ):
+                return tract if -negative > 0 else None
+            heappop(heap)
+        return None
+
+    def unoccupied_perimeter(self):
+        """Return the first unoccupied district's perimeter in the order tracts joined it."""
+        first = self.unoccupied[0]
+        island = self.island
+        perimeter = [tract for tract, seq in enumerate(self.unoc_seq) if seq >= 0 and island[tract] == first]
+        perimeter.sort(key=self.unoc_seq.__getitem__)
+        return perimeter
+
+    def add_hop_sources(self, tracts):
+        """Count hops from tracts too, stopping wherever no count shrinks."""
+        self.hops[tracts] = 0
+        frontier = tracts
+        hops = 0
+        while len(frontier):
+            hops += 1
+            reached = expand(self.offsets, self.neighbors, frontier)
+            frontier = np.unique(reached[self.hops[reached] > hops])
+            self.hops[frontier] = hops
+
+    def find_start(self, seeding='border'):
+        """Choose the start tract for a new district as State.find_start does."""
+        perimeter = self.unoccupied_perimeter()
+        if seeding == 'border':
+            assignment = self.assignment
+            best_count = 0
+            best = None
+            for tract in perimeter:
+                unique_dists = set(assignment[neighbor] for neighbor in self.adjacency[tract])
+                unique_dists.discard(UNOCCUPIED)
+                if len(unique_dists) > best_count or len(unique_dists) == 0:
+                    best_count = len(unique_dists)
+                    best = tract
+            return best
+        if seeding not in ('farthest', 'kmeans++'):
+            raise ValueError('Unknown seeding {!r}.'.format(seeding))
+        if self.hops is None:
+            self.hops = np.full(len(self.adjacency), NO_HOPS, dtype=np.int64)
+            self.add_hop_sources(np.flatnonzero(np.array(self.assignment) != UNOCCUPIED))
+        if not perimeter:
+            return None
+        hops = self.hops[perimeter].tolist()
+        if seeding == 'farthest':
+            return perimeter[hops.index(max(hops))]
+        weights = []
+        for tract, tract_hops in zip(perimeter, hops):
+            population = self.tract_pop[tract]
+            weights.append(population if tract_hops == NO_HOPS else population * tract_hops * tract_hops)
+        pick = self.random.random() * sum(weights)
+        for tract, weight in zip(perimeter, weights):
+            pick -= weight
+            if pick < 0:
+                return tract
+        return perimeter[0]
@@ -1,10 +1,99 @@
 """Use the graph to assign districts to tracts."""
-from gerrypy.models.mymodel import Tract
+import struct
+from array import array
+
+from zope.sqlalchemy import mark_changed
+
+from gerrypy.models.datasets import COLORADO
+from gerrypy.models.mymodel import Plan, PlanAssignment
+from gerrypy.scripts.bulkload import copy_rows
+
+
+DIFF_RECORD = struct.Struct('<IB')  # position in tract_gids, district
+KEEP_PLANS = 1000  # Newest plans kept when old ones are pruned.
 
 
 def assign_district(request, graph):
-    """Assign district IDs to all of the tracts in the tract table."""
-    for tract in graph.nodes():
-        tract_row = request.dbsession.query(Tract).get(tract.gid)
-        tract_row.districtid = tract.districtid
-        request.dbsession.flush()
+    """Store the districts of all of the tracts in the graph as a new plan and return its planid."""
+    return assign_gids(request, ((tract.gid, tract.districtid) for tract in graph.nodes()))
+
+
+def assign_gids(request, assignments, dataset=COLORADO):
+    """Store every (gid, districtid) pair as a new plan with one COPY and return its planid.
+
+    Only new rows are written, so plans built at the same time never wait on
+    each other's locks.  Pairs with no districtid are left out.  The gids
+    are tracts of dataset.
+    """
+    dbsession = request.dbsession
+    plan = Plan(dataset=dataset.name)
+    dbsession.add(plan)
+    dbsession.flush()  # Gets the planid.
+    copy_rows(
+        dbsession, PlanAssignment.__table__.name, ('planid', 'gid', 'districtid'),
+        ((plan.planid, gid, districtid) for gid, districtid in assignments if districtid is not None)
+    )
+    mark_changed(dbsession)  # The session can't see raw SQL, so tell the transaction to commit.
+    return plan.planid
+
+
+def prune_plans(dbsession, keep=KEEP_PLANS, referenced=()):
+    """Delete every plan but the newest keep and those in referenced, and return how many were deleted.
+
+    Every build stores a new plan, so without this plan_assignment grows by
+    a row per tract for every build ever asked for.
+    """
+    cutoff = dbsession.query(Plan.planid).order_by(Plan.planid.desc()).offset(keep).limit(1).scalar()
+    if cutoff is None:
+        return 0
+    referenced = sorted(referenced)
+    assignments = dbsession.query(PlanAssignment).filter(PlanAssignment.planid <= cutoff)
+    plans = dbsession.query(Plan).filter(Plan.planid <= cutoff)
+    if referenced:
+        assignments = assignments.filter(PlanAssignment.planid.notin_(referenced))
+        plans = plans.filter(Plan.planid.notin_(referenced))
+    assignments.delete(synchronize_session=False)
+    return plans.delete(synchronize_session=False)
+
+
+def keep_plans(request):
+    """Return how many of the newest plans pruning keeps, or 0 to keep every plan."""
+    registry = getattr(request, 'registry', None)
+    settings = getattr(registry, 'settings', None) or {}
+    return int(settings.get('gerrypy.keep_plans', KEEP_PLANS))
+
+
+def plan_assignments(dbsession, planid):
+    """Return the plan's (gid, districtid) pairs in gid order."""
+    query = dbsession.query(PlanAssignment.gid, PlanAssignment.districtid)
+    return [tuple(row) for row in query.filter(PlanAssignment.planid == planid).order_by(PlanAssignment.gid)]
+
+
+def plan_dataset(dbsession, planid):
+    """Return the name of the dataset a plan was drawn for, or None if there is no such plan."""
+    return dbsession.query(Plan.dataset).filter(Plan.planid == planid).scalar()
+
+
+def tract_gids(dbsession, dataset=COLORADO):
+    """Return every tract's gid in the dataset in order, the order packed plans give districts in."""
+    return [gid for gid, in dbsession.query(dataset.tract.gid).order_by(dataset.tract.gid)]
+
+
+def pack_districts(gids, assignment):
+    """Return one byte per gid in gids: its district in assignment, or 0 if it has none.
+
+    Raises OverflowError for districts past 255.
+    """
+    district_of = dict(assignment)
+    return array('B', (district_of.get(gid, 0) for gid in gids)).tobytes()
+
+
+def diff_districts(packed, base):
+    """Return DIFF_RECORDs for every tract whose district in packed differs from base.
+
+    Both are pack_districts results for the same gids.
+    """
+    return b''.join(
+        DIFF_RECORD.pack(position, district)
+        for position, (district, old) in enumerate(zip(packed, base)) if district != old
+    )
@@ -0,0 +1,184 @@
+"""
+Time the districting building blocks on the full state graph.
+
+usage: gerrypy_benchmark <config_uri> [snapshot=path] [repeat=3] [write_back=1]
+       [dissolve=1]
+
+The graph comes from the database named by DATABASE_URL, or from a graph
+snapshot file when snapshot= is given.  write_back=1 also times storing a
+plan in that database, row by row into a scratch table as assign_district
+once did and with assign_gids' COPY into plan_assignment, at tract
+through block-level row counts.  dissolve=1 times drawing a plan's
+districts with ST_Union and from the arc table.
+"""
+
+import os
+import sys
+import time
+from collections import deque
+from types import SimpleNamespace
+
+from pyramid.paster import get_appsettings, setup_logging
+from pyramid.scripts.common import parse_vars
+
+from sqlalchemy import text
+
+from gerrypy.scripts.assigndistrict import assign_gids
+from gerrypy.scripts.fish_scales import OccupiedDist, UnoccupiedDist
+from gerrypy.scripts.tractgraph import to_networkx
+
+
+def best_time(func, repeat=3):
+    """Return the fastest of repeat runs of func, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bfs_order(graph):
+    """Return every node of graph in breadth-first order from its first node."""
+    order = []
+    seen = set()
+    for root in graph.nodes():
+        if root in seen:
+            continue
+        seen.add(root)
+        queue = deque([root])
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for neighbor in graph.neighbors(node):
+                if neighbor not in seen:
+                    seen.add(neighbor)
+                    queue.append(neighbor)
+    return order
+
+
+def bench_district_growth(state_graph, repeat=3):
+    """Time filling the unoccupied district, swapping every tract out of it and back."""
+    order = bfs_order(state_graph)
+    results = {}
+
+    def fill():
+        return UnoccupiedDist(None, state_graph, tracts=order)
+    results['UnoccupiedDist fill'] = best_time(fill, repeat)
+
+    def swap_all():
+        unoc = fill()
+        dst = OccupiedDist(1, state_graph)
+        for tract in order:  # This is what State.swap does, tract by tract.
+            unoc.rem_node(tract, state_graph)
+            dst.add_node(tract, state_graph)
+        for tract in order:
+            dst.rem_node(tract, state_graph)
+    results['swap in and remove every tract'] = best_time(swap_all, repeat)
+    return results
+
+
+BENCHMARKS = [bench_district_growth]
+
+WRITE_BACK_SIZES = (1249, 10000, 100000, 250000)  # Colorado's tracts up to about its census blocks.
+ROW_BY_ROW_LIMIT = 10000  # Past this the old path takes minutes.
+
+
+def bench_write_back(dbsession, sizes=WRITE_BACK_SIZES, repeat=3):
+    """Time storing a plan of each size, row by row into a scratch table and with assign_gids."""
+    request = SimpleNamespace(dbsession=dbsession)
+    results = {}
+    for size in sizes:
+        dbsession.execute(text('DROP TABLE IF EXISTS write_back_bench'))
+        dbsession.execute(text('CREATE TEMP TABLE write_back_bench (gid integer PRIMARY KEY, districtid integer)'))
+        dbsession.execute(text(
+            'INSERT INTO write_back_bench SELECT gid, NULL FROM generate_series(1, :size) AS gid'
+        ), {'size': size})
+        plan = [(gid, gid % 7 + 1) for gid in range(1, size + 1)]
+
+        def bulk():
+            assign_gids(request, plan)
+        results['store a plan with COPY, {:>6} rows'.format(size)] = best_time(bulk, repeat)
+
+        def row_by_row():  # What assign_district did: a SELECT and an UPDATE per tract.
+            for gid, districtid in plan:
+                dbsession.execute(text('SELECT * FROM write_back_bench WHERE gid = :gid'), {'gid': gid})
+                dbsession.execute(text(
+                    'UPDATE write_back_bench SET districtid = :districtid WHERE gid = :gid'
+                ), {'gid': gid, 'districtid': districtid})
+        if size <= ROW_BY_ROW_LIMIT:
+            results['store a plan row by row, {:>6} rows'.format(size)] = best_time(row_by_row, 1)
+    return results
+
+
+def bench_dissolve(dbsession, repeat=3):
+    """Time turning a plan into district shapes with ST_Union and from arcs."""
+    from gerrypy.models.mymodel import plan_districts
+    from gerrypy.scripts.array_engine import ArrayState
+    from gerrypy.scripts.topology import dissolve_plan, load_topology
+    from gerrypy.scripts.tractgraph import load_tract_graph
+    tract_graph = load_tract_graph(dbsession)
+    state = ArrayState(None, 7, tract_graph=tract_graph)
+    assignment = state.build({'county': 1, 'compactness': 1})
+    request = SimpleNamespace(dbsession=dbsession)
+    planid = assign_gids(request, zip(tract_graph.gid, (int(district) or None for district in assignment)))
+    results = {}
+    results['dissolve with ST_Union'] = best_time(lambda: plan_districts(dbsession, planid).all(), repeat)
+    results['dissolve: read arc table'] = best_time(lambda: load_topology(dbsession), repeat)
+    topology = load_topology(dbsession)
+    results['dissolve from arcs'] = best_time(lambda: dissolve_plan(dbsession, planid, topology), repeat)
+    return results
+
+
+def session_factory(config_uri, options):
+    """Return a session factory for the database named by DATABASE_URL."""
+    from gerrypy.models import get_engine, get_session_factory
+    settings = get_appsettings(config_uri, options=options)
+    settings['sqlalchemy.url'] = os.environ['DATABASE_URL']
+    return get_session_factory(get_engine(settings))
+
+
+def load_graph(config_uri, options):
+    """Load the tract graph from a snapshot file or the configured database."""
+    if 'snapshot' in options:
+        from gerrypy.scripts.snapshot import read_snapshot
+        return read_snapshot(options['snapshot'])[1]
+    import transaction
+    from gerrypy.models import get_tm_session
+    from gerrypy.scripts.tractgraph import load_tract_graph
+    with transaction.manager:
+        return load_tract_graph(get_tm_session(session_factory(config_uri, options), transaction.manager))
+
+
+def run_rolled_back(benchmark, config_uri, options, repeat):
+    """Run a database benchmark in a transaction that is rolled back afterwards."""
+    import transaction
+    from gerrypy.models import get_tm_session
+    manager = transaction.TransactionManager()
+    manager.begin()
+    try:
+        return benchmark(get_tm_session(session_factory(config_uri, options), manager), repeat=repeat)
+    finally:
+        manager.abort()  # Nothing here is worth keeping.
+
+
+def main(argv=sys.argv):  # pragma: no cover
+    if len(argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    options = parse_vars(argv[2:])
+    setup_logging(argv[1])
+    tract_graph = load_graph(argv[1], options)
+    state_graph = to_networkx(tract_graph)
+    repeat = int(options.get('repeat', 3))
+    print('{} tracts, {} edges'.format(len(tract_graph), tract_graph.num_edges))
+    results = {}
+    for benchmark in BENCHMARKS:
+        results.update(benchmark(state_graph, repeat))
+    if options.get('write_back'):
+        results.update(run_rolled_back(bench_write_back, argv[1], options, repeat))
+    if options.get('dissolve'):
+        results.update(run_rolled_back(bench_dissolve, argv[1], options, repeat))
+    for name, seconds in sorted(results.items()):
+        print('{:<45} {:10.4f} s'.format(name, seconds))
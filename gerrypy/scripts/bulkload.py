@@ -0,0 +1,54 @@
+"""Stream rows into PostgreSQL with COPY."""
+
+
+class RowStream(object):
+    """A read-only file object that renders rows as COPY text on demand.
+
+    COPY pulls the data in fixed-size chunks, so only one chunk of rows is
+    ever held in memory no matter how many rows the iterable yields.
+    """
+
+    def __init__(self, rows):
+        """Initialize the RowStream Object."""
+        self._lines = (format_row(row) for row in rows)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        """Return up to size bytes of COPY text, or everything left if size < 0."""
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+
+def format_value(value):
+    """Render one value in COPY text format.  Bytes are sent as hex."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bytes):
+        return value.hex()
+    text = str(value)
+    return text.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def format_row(row):
+    """Render a row as one line of COPY text."""
+    return ('\t'.join(format_value(value) for value in row) + '\n').encode('utf-8')
+
+
+def copy_rows(dbsession, table, columns, rows):
+    """COPY rows into table within the session's current transaction."""
+    cursor = dbsession.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            'COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)),
+            RowStream(rows)
+        )
+    finally:
+        cursor.close()
+
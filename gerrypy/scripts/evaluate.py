@@ -0,0 +1,143 @@
+"""
+Score many districting plans at once over the CSR tract graph.
+
+metrics.py scores one plan at a time.  Here a batch is a K by N matrix,
+one row per plan and one column per tract in gid order, holding district
+numbers from 1 (0 for a tract no district claims), and every score is a
+NumPy expression over the whole matrix:
+
+- populations come from one bincount keyed by plan and district;
+- cut edges compare the two ends of every tract border in every plan;
+- county splits mark which (plan, county, district) triples occur;
+- contiguity is union-find over arrays.  Every tract of every plan starts
+  as its own root; each round hooks the larger root of each border inside
+  a district onto the smaller and then halves paths until every tract
+  points at its root, so a district is one piece when it has one root.
+
+Plans are scored CHUNK at a time to bound the memory the border matrices
+take.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+
+CHUNK = 64
+MAX_PLANS = 10000  # Most plans scored in one request.
+
+BatchMetrics = namedtuple('BatchMetrics', 'populations deviation county_splits cut_edges pieces contiguous')
+BatchMetrics.__doc__ = """Scores of a batch of plans, one row or entry per plan.
+
+populations and pieces are K by num_dst: each district's population and
+how many connected pieces its tracts form, 0 for a district with no
+tracts.  deviation, county_splits and cut_edges are as in PlanMetrics, and
+contiguous is whether every district is in one piece.
+"""
+
+
+def as_batch(assignments, num_tracts, num_dst):
+    """Return assignments as a K by num_tracts int64 matrix, one plan per row.
+
+    One plan may be given on its own.  Raises ValueError for plans of the
+    wrong length or districts outside 0 to num_dst.
+    """
+    batch = np.asarray(assignments)
+    if batch.ndim == 1:
+        batch = batch.reshape(1, -1)
+    if batch.ndim != 2 or batch.shape[1] != num_tracts:
+        raise ValueError('Plans must have one district for each of the {} tracts.'.format(num_tracts))
+    if batch.size and not np.issubdtype(batch.dtype, np.integer):
+        raise ValueError('Districts must be whole numbers.')
+    batch = batch.astype(np.int64, copy=False)
+    if batch.size and (batch.min() < 0 or batch.max() > num_dst):
+        raise ValueError('Districts must be numbered from 1 to {}, or 0 for none.'.format(num_dst))
+    return batch
+
+
+def tract_borders(tract_graph):
+    """Return the two ends of every tract border, each border once."""
+    offsets = np.asarray(tract_graph.offsets, dtype=np.int64)
+    neighbors = np.asarray(tract_graph.neighbors, dtype=np.int64)
+    sources = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    once = sources < neighbors
+    return sources[once], neighbors[once]
+
+
+def batch_populations(tract_pop, batch, num_dst):
+    """Return each plan's district populations, K by num_dst."""
+    plans, num_tracts = batch.shape
+    keys = batch + (num_dst + 1) * np.arange(plans)[:, None]
+    totals = np.bincount(keys.ravel(), weights=np.tile(tract_pop, plans), minlength=plans * (num_dst + 1))
+    return totals.reshape(plans, num_dst + 1)[:, 1:]
+
+
+def batch_county_splits(county, num_counties, batch, num_dst):
+    """Return how many counties each plan puts in more than one district."""
+    plans = len(batch)
+    keys = (np.arange(plans)[:, None] * num_counties + county) * (num_dst + 1) + batch
+    present = np.zeros(plans * num_counties * (num_dst + 1), dtype=bool)
+    present[keys.ravel()] = True
+    districts = present.reshape(plans, num_counties, num_dst + 1)[:, :, 1:].sum(axis=2)
+    return (districts > 1).sum(axis=1)
+
+
+def batch_pieces(sources, targets, batch, num_dst):
+    """Return how many connected pieces each plan's districts form, K by num_dst."""
+    plans, num_tracts = batch.shape
+    size = plans * num_tracts
+    index = np.int32 if size < 2 ** 31 else np.int64  # Half the memory to walk when it fits.
+    districts = batch.astype(np.min_scalar_type(num_dst))  # Gathered a byte at a time for most states.
+    ends = districts[:, sources]
+    inside = ((ends == districts[:, targets]) & (ends != 0)).ravel()
+    offset = (np.arange(plans, dtype=index) * num_tracts)[:, None]
+    low = (offset + sources.astype(index)).ravel()[inside]
+    high = (offset + targets.astype(index)).ravel()[inside]
+    parent = np.arange(size, dtype=index)
+    while len(low):
+        low, high = parent[low], parent[high]
+        joined = low != high
+        low, high = low[joined], high[joined]  # Borders whose ends share a root always will.
+        if not len(low):
+            break
+        parent[np.maximum(low, high)] = np.minimum(low, high)  # Any smaller root will do when several hook one root.
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+    flat = batch.ravel()
+    root = (parent == np.arange(size, dtype=index)) & (flat != 0)
+    keys = np.repeat(np.arange(plans), num_tracts)[root] * (num_dst + 1) + flat[root]
+    return np.bincount(keys, minlength=plans * (num_dst + 1)).reshape(plans, num_dst + 1)[:, 1:]
+
+
+def evaluate_plans(tract_graph, assignments, num_dst, chunk=CHUNK):
+    """Score a batch of plans, one row of districts per plan in gid order, and return the BatchMetrics."""
+    num_tracts = len(tract_graph.offsets) - 1
+    batch = as_batch(assignments, num_tracts, num_dst)
+    tract_pop = np.asarray(tract_graph.tract_pop, dtype=np.float64)
+    counties, county = np.unique(np.asarray(tract_graph.county, dtype=np.int64), return_inverse=True)
+    sources, targets = tract_borders(tract_graph)
+    ideal = tract_pop.sum() / num_dst  # As metrics.population_deviation has it.
+    parts = []
+    for start in range(0, max(len(batch), 1), chunk):
+        plans = batch[start:start + chunk]
+        populations = batch_populations(tract_pop, plans, num_dst)
+        pieces = batch_pieces(sources, targets, plans, num_dst)
+        parts.append(BatchMetrics(
+            populations.astype(np.int64),
+            np.abs(populations - ideal).max(axis=1) / ideal if ideal else np.zeros(len(plans)),
+            batch_county_splits(county, len(counties), plans, num_dst),
+            (plans[:, sources] != plans[:, targets]).sum(axis=1),
+            pieces,
+            (pieces <= 1).all(axis=1),
+        ))
+    return BatchMetrics(*(np.concatenate(field) for field in zip(*parts)))
+
+
+def max_plans(request):
+    """Return how many plans one request may have scored."""
+    registry = getattr(request, 'registry', None)
+    settings = getattr(registry, 'settings', None) or {}
+    return int(settings.get('gerrypy.evaluate_max_plans', MAX_PLANS))
@@ -4,23 +4,397 @@ compute new congressional districts based on criteria in request,
 and update the database.
 """
 
-from gerrypy.models.mymodel import Tract, Edge
+from collections import OrderedDict, deque
+from heapq import heapify, heappop, heappush
+from itertools import count, islice
+from math import pi
+from random import Random
+from types import SimpleNamespace
+
 import networkx as nx
+import numpy as np
+from gerrypy.models.datasets import COLORADO
 from gerrypy.scripts.assigndistrict import assign_district
+from gerrypy.scripts.refine import Refiner
+from gerrypy.scripts.snapshot import request_tract_graph
+from gerrypy.scripts.tractgraph import NO_COUNTY, TractNode, to_networkx
 
 
 def fill_graph(request):
-    """Build state graph from tract and edge databases."""
-    graph = nx.Graph()
-    tracts = request.dbsession.query(Tract).all()
-    edges = request.dbsession.query(Edge).all()
-    for tract in tracts:
-        graph.add_node(tract)
-    for edge in edges:
-        source = request.dbsession.query(Tract).get(edge.tract_source)
-        target = request.dbsession.query(Tract).get(edge.tract_target)
-        graph.add_edge(source, target)
-    return graph
+    """Build state graph from the tract graph snapshot."""
+    return to_networkx(request_tract_graph(request))
+
+
+class StateGraph(object):
+    """A State's own tract nodes over adjacency shared by every State.
+
+    adjacency lists each tract's neighbors by index, in gid order, as a
+    StateTemplate keeps it, and lengths the boundary shared with each.
+    Offers the parts of the networkx graph API that State and the
+    districts use, and iterates in gid order as the networkx graph does.
+    """
+
+    def __init__(self, nodes, adjacency, lengths=None):
+        """Initialize the StateGraph Object."""
+        self._nodes = nodes
+        self._adjacency = adjacency
+        self._lengths = lengths
+        self._index = {node: idx for idx, node in enumerate(nodes)}
+
+    def neighbors(self, node):
+        """Return node's neighbors in gid order."""
+        nodes = self._nodes
+        return [nodes[idx] for idx in self._adjacency[self._index[node]]]
+
+    def neighbor_lengths(self, node):
+        """Return (neighbor, shared boundary length) for each of node's neighbors, in gid order."""
+        nodes = self._nodes
+        idx = self._index[node]
+        if self._lengths is None:
+            return [(nodes[neighbor], 0.0) for neighbor in self._adjacency[idx]]
+        return [(nodes[neighbor], length) for neighbor, length in zip(self._adjacency[idx], self._lengths[idx])]
+
+    def degree(self, node):
+        """Return the number of node's neighbors."""
+        return len(self._adjacency[self._index[node]])
+
+    def nodes(self):
+        """Return every node in gid order."""
+        return list(self._nodes)
+
+    def __iter__(self):
+        """Iterate over the nodes in gid order."""
+        return iter(self._nodes)
+
+    def __len__(self):
+        """Return the number of nodes."""
+        return len(self._nodes)
+
+    def __contains__(self, node):
+        """Check membership."""
+        return node in self._index
+
+
+class Region(object):
+    """The tracts of an unoccupied district, as a view of the state graph.
+
+    A tract's neighbors in the region are its neighbors in the state graph
+    that are members, in the same order.  Offers the parts of the networkx
+    graph API that the districts use, and copying one copies only its set
+    of members.
+    """
+
+    def __init__(self, state_graph, tracts=()):
+        """Initialize the Region Object."""
+        self.state_graph = state_graph
+        self._members = set(tracts)
+
+    def add_node(self, tract):
+        """Add tract to the region."""
+        self._members.add(tract)
+
+    def remove_node(self, tract):
+        """Remove tract from the region."""
+        self._members.remove(tract)
+
+    def neighbors(self, tract):
+        """Return tract's neighbors in the region."""
+        members = self._members
+        return [neighbor for neighbor in self.state_graph.neighbors(tract) if neighbor in members]
+
+    def nodes(self):
+        """Return the region's tracts in the state graph's order."""
+        members = self._members
+        return [tract for tract in self.state_graph if tract in members]
+
+    def __iter__(self):
+        """Iterate over the region's tracts in the state graph's order."""
+        return iter(self.nodes())
+
+    def __len__(self):
+        """Return the number of tracts."""
+        return len(self._members)
+
+    def __contains__(self, tract):
+        """Check membership."""
+        return tract in self._members
+
+
+class Perimeter(object):
+    """An insertion-ordered set of tracts bordering a district.
+
+    Membership, add and remove are O(1).  Iteration follows insertion order,
+    as the list this replaces did, and append, indexing, sort and comparison
+    with lists still work.  position(tract) increases with iteration order.
+    """
+
+    def __init__(self, tracts=()):
+        """Initialize the Perimeter Object."""
+        self._tracts = OrderedDict()
+        self._added = count()
+        for tract in tracts:
+            self.add(tract)
+
+    def add(self, tract):
+        """Add tract at the end unless it is already here."""
+        if tract not in self._tracts:
+            self._tracts[tract] = next(self._added)
+
+    append = add
+
+    def remove(self, tract):
+        """Remove tract, raising ValueError if it isn't here."""
+        try:
+            del self._tracts[tract]
+        except KeyError:
+            raise ValueError('Tract is not in the perimeter.')
+
+    def discard(self, tract):
+        """Remove tract if it is here."""
+        self._tracts.pop(tract, None)
+
+    def position(self, tract):
+        """Return a number ordering tract against the others."""
+        return self._tracts[tract]
+
+    def sort(self, key=None, reverse=False):
+        """Reorder the tracts in place."""
+        tracts = sorted(self._tracts, key=key, reverse=reverse)
+        self._tracts = OrderedDict()
+        for tract in tracts:
+            self.add(tract)
+
+    def __contains__(self, tract):
+        """Check membership."""
+        return tract in self._tracts
+
+    def __iter__(self):
+        """Iterate in insertion order."""
+        return iter(self._tracts)
+
+    def __len__(self):
+        """Return the number of tracts."""
+        return len(self._tracts)
+
+    def __getitem__(self, idx):
+        """Return the tract at position idx."""
+        if idx < 0:
+            idx += len(self._tracts)
+        if not 0 <= idx < len(self._tracts):
+            raise IndexError('Perimeter index out of range.')
+        return next(islice(self._tracts, idx, None))
+
+    def __eq__(self, other):
+        """Compare in order with another perimeter or list."""
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        """Compare in order with another perimeter or list."""
+        return not self == other
+
+    def __repr__(self):
+        """Show the tracts."""
+        return 'Perimeter({!r})'.format(list(self._tracts))
+
+
+def neighbor_lengths(state_graph, node):
+    """Return (neighbor, shared boundary length) for node's neighbors in a StateGraph or networkx graph."""
+    if isinstance(state_graph, StateGraph):
+        return state_graph.neighbor_lengths(node)
+    return [(neighbor, data.get('length', 0.0)) for neighbor, data in state_graph[node].items()]
+
+
+def polsby_popper(area, boundary):
+    """Return 4 pi area over boundary squared: 1 for a circle, toward 0 for sprawling shapes."""
+    return 4 * pi * area / boundary ** 2 if boundary else 0.0
+
+
+def tract_population(tract):
+    """Return a tract node's population."""
+    return tract.tract_pop
+
+
+def tract_gid(tract):
+    """Return a tract node's gid."""
+    return tract.gid
+
+
+def sources_linked(sources, neighbors):
+    """Return True if the sources are connected through each other alone."""
+    remaining = set(sources[1:])
+    stack = [sources[0]]
+    while stack and remaining:
+        for neighbor in neighbors(stack.pop()):
+            if neighbor in remaining:
+                remaining.remove(neighbor)
+                stack.append(neighbor)
+    return not remaining
+
+
+def split_components(sources, neighbors, population):
+    """Find the pieces a region split into around a removed tract.
+
+    sources are the removed tract's neighbors in the region, and
+    neighbors(tract) yields a tract's neighbors in the region.  A search
+    runs from every source at once, always advancing whichever search has
+    claimed the fewest tracts, and searches that meet are merged.  Once at
+    most one search can still grow, every other search has exhausted its
+    piece, and no piece is larger than the one still growing.
+
+    Returns (tracts, population) for each piece cut off from the largest,
+    tracts in search order, or an empty list if the region is still whole.
+    Only the small pieces are walked in full, and nothing is searched when
+    the sources border one another directly.
+    """
+    if sources_linked(sources, neighbors):
+        return []
+    owner = {}
+    parent = list(range(len(sources)))
+    queues = []
+    claimed = []
+    totals = []
+    for label, source in enumerate(sources):
+        owner[source] = label
+        queues.append(deque([source]))
+        claimed.append([source])
+        totals.append(population(source))
+
+    def find(label):
+        while parent[label] != label:
+            parent[label] = parent[parent[label]]
+            label = parent[label]
+        return label
+
+    growing = [(1, label) for label in range(len(sources))]
+    active = len(sources)
+    while active > 1:
+        size, label = heappop(growing)
+        if find(label) != label or len(claimed[label]) != size:
+            continue  # Merged away, or re-queued since with a new size.
+        tract = queues[label].popleft()
+        for neighbor in neighbors(tract):
+            other = owner.get(neighbor)
+            if other is None:
+                owner[neighbor] = label
+                queues[label].append(neighbor)
+                claimed[label].append(neighbor)
+                totals[label] += population(neighbor)
+                continue
+            other = find(other)
+            if other == label:
+                continue
+            if not queues[other]:  # Can't happen: an exhausted search has no unexplored neighbors.
+                raise RuntimeError('Split search met an exhausted search.')
+            keep, gone = min(label, other), max(label, other)
+            parent[gone] = keep
+            queues[keep].extend(queues[gone])
+            claimed[keep].extend(claimed[gone])
+            totals[keep] += totals[gone]
+            queues[gone] = claimed[gone] = None
+            active -= 1
+            label = keep
+        if queues[label]:
+            heappush(growing, (len(claimed[label]), label))
+        else:
+            active -= 1
+    pieces = [label for label in range(len(sources)) if find(label) == label]
+    if len(pieces) < 2:
+        return []
+    largest = max(pieces, key=lambda label: (bool(queues[label]), len(claimed[label]), -label))
+    return [(claimed[label], totals[label]) for label in pieces if label != largest]
+
+
+class HopDistances(object):
+    """How many hops each tract is from the nearest tract already in a district.
+
+    Hops only ever shrink as districts are built, so each district is added
+    with a breadth-first search that stops wherever it no longer shortens
+    a tract's count.  Tracts no district can reach have no count.
+    """
+
+    def __init__(self, state_graph):
+        """Initialize the HopDistances Object."""
+        self.state_graph = state_graph
+        self.hops = {}
+
+    def add_sources(self, tracts):
+        """Count hops from tracts too."""
+        queue = deque()
+        for tract in tracts:
+            self.hops[tract] = 0
+            queue.append(tract)
+        while queue:
+            tract = queue.popleft()
+            hops = self.hops[tract] + 1
+            for neighbor in self.state_graph.neighbors(tract):
+                if self.hops.get(neighbor, hops + 1) > hops:
+                    self.hops[neighbor] = hops
+                    queue.append(neighbor)
+
+    def get(self, tract):
+        """Return the tract's hops to the nearest district, or None if none reach it."""
+        return self.hops.get(tract)
+
+
+class Frontier(object):
+    """A max-heap of a growing district's perimeter, keyed like select_next.
+
+    A tract's rating is compactness_weight times its neighbors in the
+    district, plus county_weight if its county is already in the district,
+    plus polsby_weight times the share of its boundary it has with the
+    district.  Taking the tracts that share the most boundary keeps the
+    district's Polsby-Popper score up.  Ties go to the tract earliest in
+    the perimeter, or with ranks, a dict of every tract's tie rank, to the
+    lowest ranked.  Whenever a rating may have changed the tract is pushed
+    again; outdated entries are dropped when they reach the top.
+    """
+
+    def __init__(self, dst, compactness_weight, county_weight, polsby_weight=0, ranks=None):
+        """Initialize the Frontier Object."""
+        self.dst = dst
+        self.weights = (compactness_weight, county_weight, polsby_weight)
+        self.ranks = ranks
+        self._pushed = count()
+        self.heap = [self._entry(tract) for tract in dst.perimeter]
+        heapify(self.heap)
+
+    def rating(self, tract):
+        """Rate a perimeter tract for the district."""
+        compactness_weight, county_weight, polsby_weight = self.weights
+        same_county = 1 if self.dst.counties.get(tract.county) else 0
+        rating = self.dst.inside[tract] * compactness_weight + same_county * county_weight
+        if polsby_weight and tract.perimeter:
+            rating += polsby_weight * self.dst.shared[tract] / tract.perimeter
+        return rating
+
+    def position(self, tract):
+        """Return the number breaking rating ties for tract."""
+        if self.ranks is not None:
+            return self.ranks[tract]
+        return self.dst.perimeter.position(tract)
+
+    def _entry(self, tract):
+        """Build the heap entry for tract as it stands now."""
+        return (-self.rating(tract), self.position(tract), next(self._pushed), tract)
+
+    def push(self, tracts):
+        """Re-rate tracts that are on the perimeter."""
+        for tract in tracts:
+            if tract in self.dst.perimeter:
+                heappush(self.heap, self._entry(tract))
+
+    def best(self):
+        """Return the best unassigned tract, or None if none rates above 0."""
+        perimeter = self.dst.perimeter
+        while self.heap:
+            negative, position, pushed, tract = self.heap[0]
+            if (
+                tract.districtid is None and tract in perimeter and
+                self.position(tract) == position and self.rating(tract) == -negative
+            ):
+                return tract if -negative > 0 else None
+            heappop(self.heap)
+        return None
 
 
 class OccupiedDist(object):
@@ -31,14 +405,28 @@ class OccupiedDist(object):
 
     rem_node(self, node): removes node from nodes and updates district
     properties accordingly
+
+    inside maps each perimeter tract to how many of its neighbors are in
+    the district and shared to how much boundary it has with it, and
+    counties counts the district's tracts per county, so both methods run
+    in O(degree).  boundary is the length of the district's outline and
+    cut_edges the number of tract borders it crosses, which give its
+    polsby_popper score without looking at its shape.  While the district
+    grows, frontier holds its Frontier and is kept up to date.
     """
 
     def __init__(self, districtID, state_graph, tracts=None):
         """Initialize the OccupiedDist Object."""
         self.nodes = nx.Graph()
-        self.perimeter = []
+        self.perimeter = Perimeter()
+        self.inside = {}
+        self.shared = {}
+        self.counties = {}
+        self.frontier = None
         self.population = 0
         self.area = 0
+        self.boundary = 0.0
+        self.cut_edges = 0
         self.districtID = districtID
         if tracts:
             try:
@@ -47,41 +435,76 @@ class OccupiedDist(object):
             except TypeError:
                 raise TypeError('Tracts must be iterable.')
 
+    @property
+    def polsby_popper(self):
+        """Return the district's Polsby-Popper score."""
+        return polsby_popper(self.area, self.boundary)
+
     def add_node(self, node, state_graph):
         """Add node to nodes and updates district properties."""
         node.districtid = self.districtID
         self.nodes.add_node(node)
-        neighbors = state_graph.neighbors(node)
-        if node in self.perimeter:
-            self.perimeter.remove(node)
-        for neighbor in neighbors:  # After node is added, make the edge connections within the occupied district.
-            if neighbor in self.nodes.nodes():
+        self.perimeter.discard(node)
+        self.inside.pop(node, None)
+        self.shared.pop(node, None)
+        outside = []
+        inside = 0
+        shared = 0.0
+        neighbors = neighbor_lengths(state_graph, node)
+        for neighbor, length in neighbors:  # After node is added, make the edge connections within the occupied district.
+            if neighbor in self.nodes:
                 self.nodes.add_edge(neighbor, node)
-            if neighbor not in self.nodes.nodes() and neighbor not in self.perimeter:
-                self.perimeter.append(neighbor)
+                inside += 1
+                shared += length
+            else:  # Every outside neighbor is now on the perimeter.
+                self.inside[neighbor] = self.inside.get(neighbor, 0) + 1
+                self.shared[neighbor] = self.shared.get(neighbor, 0.0) + length
+                self.perimeter.add(neighbor)
+                outside.append(neighbor)
+        self.boundary += node.perimeter - 2 * shared  # Boundary shared with the district is now inside it.
+        self.cut_edges += len(neighbors) - 2 * inside
         self.population += node.tract_pop
         self.area += node.shape_area
+        self.counties[node.county] = self.counties.get(node.county, 0) + 1
+        if self.frontier:
+            if self.counties[node.county] == 1:  # A new county raises every perimeter tract in it.
+                self.frontier.push(tract for tract in self.perimeter if tract.county == node.county)
+            self.frontier.push(outside)
 
     def rem_node(self, node, state_graph):
         """Remove node from nodes and updates district properties."""
         self.population -= node.tract_pop
         self.nodes.remove_node(node)
         self.area -= node.shape_area
-        neighbors = state_graph.neighbors(node)
-        to_perimeter = False
-        for neighbor in neighbors:  # Decide whether to remove nodes from the district perimeter.
-            takeout = True
-            if neighbor in self.perimeter:  # if its a perimeter node,
-                neighborneighbors = state_graph.neighbors(neighbor)
-                for neighborneighbor in neighborneighbors:  # check its neighbors
-                    if neighborneighbor in self.nodes.nodes():  # if it has a neighbor in the district
-                        takeout = False  # it should remain in the perimeter list.
-                if takeout:  # If it should be removed,
-                    self.perimeter.remove(neighbor)  # Remove it!
-            elif neighbor in self.nodes.nodes():  # If the removed node neighbors the district (which it should)
-                to_perimeter = True  # mark it to be added to the perimeter
-        if to_perimeter:  # If its marked,
-            self.perimeter.append(node)  # add it to the perimeter
+        self.counties[node.county] -= 1
+        if not self.counties[node.county]:
+            del self.counties[node.county]
+        inside = 0
+        shared = 0.0
+        outside = [node]
+        neighbors = neighbor_lengths(state_graph, node)
+        for neighbor, length in neighbors:
+            if neighbor in self.nodes:  # The removed node still borders the district here.
+                inside += 1
+                shared += length
+            elif neighbor in self.inside:  # A perimeter tract loses a district neighbor,
+                self.inside[neighbor] -= 1
+                self.shared[neighbor] -= length
+                outside.append(neighbor)
+                if not self.inside[neighbor]:  # and leaves the perimeter if it was the last one.
+                    del self.inside[neighbor]
+                    del self.shared[neighbor]
+                    self.perimeter.discard(neighbor)
+        self.boundary -= node.perimeter - 2 * shared
+        self.cut_edges -= len(neighbors) - 2 * inside
+        if inside:
+            self.inside[node] = inside
+            self.shared[node] = shared
+            self.perimeter.add(node)
+        if self.frontier:
+            if node.county not in self.counties:  # Losing a county lowers every perimeter tract in it.
+                self.frontier.push(tract for tract in self.perimeter if tract.county == node.county)
+            self.frontier.push(outside)
 
 
 class UnoccupiedDist(OccupiedDist):
@@ -92,12 +515,17 @@ class UnoccupiedDist(OccupiedDist):
 
     rem_node(self, node): removes node from nodes and updates district
     properties accordingly
+
+    inside maps each tract in the district to how many of its neighbors are
+    also in it; a tract is on the perimeter while that is below its degree.
+    nodes is a Region of the state graph rather than a graph of its own.
     """
 
     def __init__(self, districtID, state_graph, tracts=None):
         """Initialize the UnoccupiedDist Object."""
-        self.nodes = nx.Graph()
-        self.perimeter = []
+        self.nodes = Region(state_graph)
+        self.perimeter = Perimeter()
+        self.inside = {}
         self.population = 0
         self.area = 0
         self.districtID = districtID
@@ -112,39 +540,133 @@ class UnoccupiedDist(OccupiedDist):
         """Add node to nodes and updates district properties accordingly."""
         node.districtid = None
         self.nodes.add_node(node)
-        for neighbor in state_graph.neighbors(node):
-            if neighbor in self.nodes:
-                self.nodes.add_edge(neighbor, node)
         self.population += node.tract_pop
         self.area += node.shape_area
-        neighbors = state_graph.neighbors(node)
-        to_add = False
-        for neighbor in neighbors:  # Handling which nodes to add or remove from the perimeter. 
-            takeout = True
-            if neighbor in self.perimeter:
-                neighborneighbors = state_graph.neighbors(neighbor)
-                for neighborneighbor in neighborneighbors:
-                    if neighborneighbor not in self.nodes:
-                        takeout = False
-                if takeout:
-                    self.perimeter.remove(neighbor)
-            if neighbor not in self.nodes:
-                to_add = True
-        if to_add:
-            self.perimeter.append(node)
+        inside = 0
+        for neighbor in state_graph.neighbors(node):  # Handling which nodes to add or remove from the perimeter.
+            if neighbor in self.nodes:
+                inside += 1
+                self.inside[neighbor] += 1
+                if self.inside[neighbor] == state_graph.degree(neighbor):  # Surrounded now, so off the perimeter.
+                    self.perimeter.discard(neighbor)
+        self.inside[node] = inside
+        if inside < state_graph.degree(node):
+            self.perimeter.add(node)
 
     def rem_node(self, node, state_graph):
         """Remove node from nodes and updates district properties accordingly."""
         self.population -= node.tract_pop
         self.area -= node.shape_area
-        if node in self.perimeter:
-            self.perimeter.remove(node)
-        neighbors = self.nodes.neighbors(node) 
-        for neighbor in neighbors:
-            if neighbor not in self.perimeter:
-                self.perimeter.append(neighbor)
+        self.perimeter.discard(node)
+        del self.inside[node]
+        for neighbor in self.nodes.neighbors(node):  # Its neighbors now border the hole it leaves.
+            self.inside[neighbor] -= 1
+            self.perimeter.add(neighbor)
         self.nodes.remove_node(node)
 
+    def copy(self, state_graph, nodes):
+        """Return this district over another State's tracts.
+
+        nodes maps each of this district's tracts to the other State's.
+        """
+        unoc = UnoccupiedDist(self.districtID, state_graph)
+        unoc.nodes = Region(state_graph, (nodes[tract] for tract in self.nodes._members))
+        unoc.perimeter = Perimeter(nodes[tract] for tract in self.perimeter)
+        unoc.inside = {nodes[tract]: inside for tract, inside in self.inside.items()}
+        unoc.population = self.population
+        unoc.area = self.area
+        return unoc
+
+
+class StateTemplate(object):
+    """The starting point of every State over one tract graph.
+
+    Built once per tract graph and never changed: the adjacency, and the
+    unoccupied district of each island with the border tracts on its
+    perimeter, over tracts of its own.  clone() gives each State fresh
+    tracts and copies of those districts, sharing the rest, so a State
+    costs a pass over the tracts instead of a graph build and a walk of
+    every island.
+    """
+
+    def __init__(self, tract_graph):
+        """Initialize the StateTemplate Object."""
+        self.tract_graph = tract_graph
+        self.adjacency = tuple(tuple(tract_graph.neighbors_of(idx)) for idx in range(len(tract_graph)))
+        self.lengths = tuple(tuple(tract_graph.lengths_of(idx)) for idx in range(len(tract_graph)))
+        self.state_graph = StateGraph(self.new_nodes(), self.adjacency, self.lengths)
+        self.unoccupied = []
+        self.population = 0
+        self.area = 0
+        for island in self.islands():
+            tracts = [self.state_graph._nodes[idx] for idx in island]  # In gid order, so plans repeat.
+            unoc = UnoccupiedDist(None, self.state_graph, tracts=tracts)
+            for tract in tracts:
+                if tract.isborder == 1:  # This is a hardcoded field for Colorado.  A challenge of adding more states is finding these automatically.
+                    unoc.perimeter.append(tract)  # begin with all border tracts in the perimeter.
+            self.population += unoc.population
+            self.area += unoc.area
+            self.unoccupied.append(unoc)
+
+    def new_nodes(self):
+        """Return a fresh TractNode for every tract, in gid order."""
+        graph = self.tract_graph
+        return [
+            TractNode(
+                graph.gid[idx], graph.tract_pop[idx], graph.shape_area[idx],
+                None if graph.county[idx] == NO_COUNTY else graph.county[idx], graph.isborder[idx],
+                perimeter=graph.perimeter[idx],
+            )
+            for idx in range(len(graph))
+        ]
+
+    def islands(self):
+        """Return the tract indexes of each connected piece of land, in order of their lowest gid."""
+        seen = [False] * len(self.adjacency)
+        islands = []
+        for root in range(len(self.adjacency)):
+            if seen[root]:
+                continue
+            seen[root] = True
+            island = [root]
+            for idx in island:
+                for neighbor in self.adjacency[idx]:
+                    if not seen[neighbor]:
+                        seen[neighbor] = True
+                        island.append(neighbor)
+            islands.append(sorted(island))
+        return islands
+
+    def clone(self):
+        """Return a new StateGraph and unoccupied districts for a State to build on."""
+        nodes = self.new_nodes()
+        state_graph = StateGraph(nodes, self.adjacency, self.lengths)
+        mapping = dict(zip(self.state_graph._nodes, nodes))
+        return state_graph, [unoc.copy(state_graph, mapping) for unoc in self.unoccupied]
+
+
+def get_state_template(request, dataset=COLORADO):
+    """Return the StateTemplate for the dataset's current tract graph, built once per graph.
+
+    The template is kept on the graph, so it goes when the graph is dropped
+    from memory or replaced by one for newer tables.
+    """
+    tract_graph = request_tract_graph(request, dataset)
+    template = getattr(tract_graph, 'state_template', None)
+    if template is None:
+        template = tract_graph.state_template = StateTemplate(tract_graph)
+    return template
+
+
+def warm_state_template(registry):
+    """Build the StateTemplate when the app starts, so no request waits for it."""
+    import transaction
+    from gerrypy.models import get_tm_session
+    manager = transaction.TransactionManager()
+    with manager:
+        dbsession = get_tm_session(registry['dbsession_factory'], manager)
+        get_state_template(SimpleNamespace(registry=registry, dbsession=dbsession))
+
 
 class State(object):
     """Manages how tracts are distributed into districts in a particular state.
@@ -152,30 +674,46 @@ class State(object):
     build_district(self, start, population):
     creates a new district stemming from the start node with a given population
 
-    fill_state(self, request): continues to build districts until all unoccupied tracts are claimed
+    fill_state(self, request): continues to build districts until all unoccupied tracts are claimed,
+    then stores them as a new plan whose id is kept in planid
+
+    refine(self): moves border tracts between districts to even out their
+    populations, as fill_state does when criteria['refine'] is set, and
+    keeps the Refinement in refinement
+
+    Every State starts as a clone of the StateTemplate for the current
+    tract graph, or of template when one is given.
     """
 
-    def __init__(self, request, num_dst):
+    def __init__(self, request, num_dst, template=None):
         """Initialize the State Object."""
-        self.unoccupied = []
+        if template is None:
+            template = get_state_template(request)
         self.districts = []
-        self.population = 0
-        self.area = 0
         self.num_dst = num_dst # The Number of districts alotted for that state (7 for Colorado)
         self.request = request
-        self.state_graph = fill_graph(self.request)
-        landmass = nx.connected_components(self.state_graph)  # Returns all of the connected/contiguous areas of land for a state.
-        for island in landmass:
-            unoc = UnoccupiedDist(None, self.state_graph, tracts=island)  # needs the state graph for its edges
-            for tract in unoc.nodes.nodes():
-                if tract.isborder == 1:  # This is a hardcoded field for Colorado.  A challenge of adding more states is finding these automatically.
-                    unoc.perimeter.append(tract)  # begin with all border tracts in the perimeter.
-            self.population += unoc.population
-            self.unoccupied.append(unoc)
-            self.area += unoc.area
+        self.hops = None  # Built the first time a seeding mode needs it.
+        self.random = Random()
+        self.planid = None
+        self.refinement = None
+        self.tie_rank = None
+        self.tract_graph = template.tract_graph
+        self.state_graph, self.unoccupied = template.clone()  # Every island starts as one unoccupied district.
+        self.population = template.population
+        self.area = template.area
 
     def fill_state(self, criteria):
         """Build districts until all unoccupied tracts are claimed."""
+        self.build(criteria)
+        self.planid = assign_district(self.request, self.state_graph)
+
+    def build(self, criteria):
+        """Build every district and return the assignment, in gid order, as an array."""
+        self.random.seed(criteria.get('seed'))
+        if criteria.get('ties', 'first') == 'random':  # Rank tracts at random to break rating ties, as ArrayState does.
+            ranks = list(range(len(self.state_graph)))
+            self.random.shuffle(ranks)
+            self.tie_rank = dict(zip(self.state_graph.nodes(), ranks))
         for num in range(self.num_dst):
             rem_pop = 0
             for unoc in self.unoccupied:
@@ -183,19 +721,35 @@ class State(object):
             rem_dist = self.num_dst - len(self.districts)
             tgt_population = rem_pop / rem_dist  # Average available population is the target population.  It helps ensure the State gets totally filled.
             self.build_district(tgt_population, num + 1, criteria)
-        assign_district(self.request, self.state_graph)
+        if int(criteria.get('refine', 0)):
+            self.refine()
+        return np.array([node.districtid or 0 for node in self.state_graph.nodes()], dtype=np.int64)
+
+    def refine(self):
+        """Move border tracts between districts until their populations are as even as Refiner gets them."""
+        nodes = self.state_graph.nodes()
+        assignment = [node.districtid or 0 for node in nodes]
+        self.refinement = Refiner(self.tract_graph, assignment, self.num_dst).refine()
+        for dst in self.districts:
+            dst.frontier = None  # Done growing, so nothing to re-rate.
+        for node, old, new in zip(nodes, assignment, self.refinement.assignment):
+            if old != new:
+                self.districts[old - 1].rem_node(node, self.state_graph)
+                self.districts[new - 1].add_node(node, self.state_graph)
+        return self.refinement
 
     def build_district(self, tgt_population, dist_num, criteria):
         """Create a new district stemming from the start node with a given population."""
         dst = OccupiedDist(dist_num, self.state_graph)
         self.districts.append(dst)
-        start = self.find_start()
+        start = self.find_start(criteria.get('seeding', 'border'))
         self.swap(dst, start)  # if state is full, this wont work
+        self.absorb_split(dst, start)
         while True:
             new_tract = self.select_next(dst, criteria)
             if new_tract is None:  # If there are no more nodes in unoccupied, this will be None
                 for unoc in self.unoccupied:  # This ends the building process
-                    if not len(unoc.nodes.nodes()):
+                    if not len(unoc.nodes):
                         self.unoccupied.remove(unoc)
                 break
             high_pop = (new_tract.tract_pop + dst.population)  # Population including the next tract.
@@ -203,23 +757,21 @@ class State(object):
                 break  # We stop building that district
             else:
                 self.swap(dst, new_tract)  # Swap removes the tract from its unoccupied district and adds it to the occupied district.
-                neighbors = self.state_graph.neighbors(new_tract)
-                unassigned_neighbors = [neighbor for neighbor in neighbors if neighbor in self.unoccupied[0].nodes]  # Grab the new nodes unassigned neighbors
-                if len(unassigned_neighbors) > 1:  # If there is more than one, than a split is possible.
-                    for i in range(len(unassigned_neighbors)):
-                        if not nx.has_path(    # We check each node and its previous neighbor to ensure they're connected. (thanks, nx)
-                            self.unoccupied[0].nodes,
-                            unassigned_neighbors[i],
-                            unassigned_neighbors[i - 1]
-                        ):  # If there is a split in the unoccupied district...
-                            unoc_neighbors = [x for x in nx.connected_components(self.unoccupied[0].nodes)]  # Identify each of the distinct unoccupied districts.
-                            biggest = max(unoc_neighbors, key=lambda x: len(x))
-                            unoc_neighbors.remove(biggest)    # Ignore the largest (This should be highest pop, fixed in different version)
-                            # All unoccupied districts will be bordering, because as soon as there is a split, we do this.
-                            for neigh in unoc_neighbors:  # Consume all of the rest (usually one small one)
-                                for tract in neigh:  # This sometimes gives us a district that is too large, and is the major focus of improving the algorithm.
-                                    self.swap(dst, tract)
-                            break
+                self.absorb_split(dst, new_tract)
+        if self.hops is not None:
+            self.hops.add_sources(dst.nodes.nodes())
+
+    def absorb_split(self, dst, new_tract):
+        """Give dst every piece of unoccupied land that new_tract's removal cut off from the largest."""
+        if not self.unoccupied:
+            return
+        unoc = self.unoccupied[0]
+        unassigned_neighbors = [neighbor for neighbor in self.state_graph.neighbors(new_tract) if neighbor in unoc.nodes]  # Grab the new nodes unassigned neighbors
+        if len(unassigned_neighbors) > 1:  # If there is more than one, than a split is possible.
+            pieces = split_components(unassigned_neighbors, unoc.nodes.neighbors, tract_population)
+            for tracts, population in pieces:  # Consume every piece but the largest (usually one small one)
+                for tract in tracts:  # This sometimes gives us a district that is too large, and is the major focus of improving the algorithm.
+                    self.swap(dst, tract)
 
     def swap(self, dst, new_tract):
         """Exchange tract from unoccupied district to district."""
@@ -227,41 +779,60 @@ class State(object):
         dst.add_node(new_tract, self.state_graph)
 
     def select_next(self, dst, criteria):
-        """Choose the next best tract to add to growing district."""
-        best_rating = 0
-        best = None  # We're building a score for each node based on our criteria, and saving the best.
-        for perimeter_tract in dst.perimeter:  # dst.perimeter is every node bordering that district.
-            if perimeter_tract.districtid is None:  # Grab those without a district assigned
-                count = 0    # Check how many tracts that tract borders that are ALREADY in the district.  More borders gets more points
-                for neighbor in self.state_graph.neighbors(perimeter_tract):
-                    if neighbor.districtid == dst.districtID:
-                        count += 1
-                counties = set()    # If the tracts county is in the district already, it gets a point.
-                for node in dst.nodes:
-                    counties.add(node.county)
-                same_county = 0
-                if perimeter_tract.county in counties:
-                    same_county = 1
-                rating = count * int(criteria['compactness']) + same_county * int(criteria['county'])  # Calculate score based on criteria.
-                if rating > best_rating:
-                    best_rating = rating
-                    best = perimeter_tract
-        return best
-
-    def find_start(self):
+        """Choose the next best tract to add to growing district.
+
+        Tracts are rated by how many of their neighbors are already in the
+        district, by whether their county already is and, with a polsby
+        weight, by how much of their boundary the district has; dst.frontier
+        keeps them in a heap so each pick is O(log P).
         """
-        Choose best starting tract for a new district.
-        Based on number of bordering districts.
+        weights = (int(criteria['compactness']), int(criteria['county']), int(criteria.get('polsby', 0)))
+        if dst.frontier is None or dst.frontier.weights != weights:
+            dst.frontier = Frontier(dst, *weights, ranks=self.tie_rank)
+        return dst.frontier.best()
+
+    def find_start(self, seeding='border'):
         """
-        best_set = set()
-        best = None
-        for tract in self.unoccupied[0].perimeter:
-            unique_dists = set()
-            for neighbor in self.state_graph.neighbors(tract):
-                for dst in self.districts:
-                    if neighbor in dst.nodes.nodes():
-                        unique_dists.add(dst)
-            if len(unique_dists) > len(best_set) or len(unique_dists) == 0:
-                best_set = unique_dists
-                best = tract
-        return best
+        Choose best starting tract for a new district from the unoccupied perimeter.
+
+        'border' takes the tract bordering the most districts.  'farthest'
+        takes the tract the most hops from every district, and 'kmeans++'
+        draws one at random, weighted by population times hops squared.
+        """
+        perimeter = self.unoccupied[0].perimeter
+        if seeding == 'border':
+            best_count = 0
+            best = None
+            for tract in perimeter:
+                unique_dists = set(neighbor.districtid for neighbor in self.state_graph.neighbors(tract))
+                unique_dists.discard(None)  # Unclaimed neighbors border no district.
+                if len(unique_dists) > best_count or len(unique_dists) == 0:
+                    best_count = len(unique_dists)
+                    best = tract
+            return best
+        if seeding not in ('farthest', 'kmeans++'):
+            raise ValueError('Unknown seeding {!r}.'.format(seeding))
+        if self.hops is None:
+            self.hops = HopDistances(self.state_graph)
+            for dst in self.districts:
+                self.hops.add_sources(dst.nodes.nodes())
+        if seeding == 'farthest':
+            best_hops = -1
+            best = None
+            for tract in perimeter:
+                hops = self.hops.get(tract)
+                hops = float('inf') if hops is None else hops
+                if hops > best_hops:
+                    best_hops = hops
+                    best = tract
+            return best
+        weights = []
+        for tract in perimeter:
+            hops = self.hops.get(tract)
+            weights.append(tract.tract_pop if hops is None else tract.tract_pop * hops * hops)
+        pick = self.random.random() * sum(weights)
+        for tract, weight in zip(perimeter, weights):
+            pick -= weight
+            if pick < 0:
+                return tract
+        return perimeter[0] if len(perimeter) else None
@@ -1,8 +1,20 @@
-"""Initialize the database with the District table."""
+"""Initialize the database and load the tract table from a shapefile.
+
+The shapefile is read a record at a time and every table is loaded with
+COPY.  Matching boundaries spills the segments to temporary files in
+buckets=16 parts, so a pass holds one part at a time; what stays in memory
+is a total per tract and per pair of neighbors.  Raise buckets for states
+whose segments don't fit in a sixteenth of the memory.
+
+Tables made by an older GerryPy are brought up to date first: columns the
+models have gained since are added to them, empty until the load fills them.
+"""
 
 import os
 import sys
 import transaction
+from sqlalchemy import inspect, text
+from zope.sqlalchemy import mark_changed
 from pyramid.paster import (
     get_appsettings,
     setup_logging
@@ -15,13 +27,142 @@ from ..models import (
     get_engine,
     get_session_factory,
     get_tm_session)
-# from ..models import District
+from ..models.datasets import COLORADO, parse_datasets
+from .adjacency import DEFAULT_BUCKETS, build_adjacency
+from .bulkload import copy_rows
+from .shapefile import read_shapefile, rings_to_polygons, multipolygon_ewkb
+from .topology import StreamedTopology
+
+
+DEFAULT_SHAPEFILE = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'data', 'Colorado_tracts', 'Colorado_tracts'
+)
+DEFAULT_SRID = 4269
+
+# Tract column -> shapefile field (matched case-insensitively).
+TRACT_FIELDS = {
+    'shape_area': 'shape_area',
+    'tract_pop': 'tract_pop',
+    'county': 'county',
+}
+
+
+def tract_rings(shapefile):
+    """Yield (gid, rings) for every record in the shapefile."""
+    for number, attributes, rings in read_shapefile(shapefile):
+        yield number, rings
+
+
+def tract_rows(shapefile, srid, adjacency=None):
+    """Yield a tract table row for every record in the shapefile.
+
+    gid is the shapefile record number, as shp2pgsql assigns it.  isborder
+    and perimeter come from the adjacency when one is given.
+    """
+    for number, attributes, rings in read_shapefile(shapefile):
+        fields = {name.lower(): value for name, value in attributes.items()}
+        county = fields.get(TRACT_FIELDS['county'])
+        yield (
+            number,
+            fields.get(TRACT_FIELDS['shape_area']),
+            fields.get(TRACT_FIELDS['tract_pop']),
+            None if county in (None, '') else int(county),
+            adjacency.isborder(number) if adjacency else 0,
+            adjacency.perimeter.get(number, 0.0) if adjacency else None,
+            multipolygon_ewkb(rings_to_polygons(rings), srid),
+        )
+
+
+def add_missing_columns(engine, metadata=Base.metadata):
+    """Add the columns the models declare to existing tables that lack them, and return their names.
+
+    create_all makes missing tables but leaves the ones it finds alone.
+    """
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    compiler = engine.dialect.ddl_compiler(engine.dialect, None)
+    added = []
+    with engine.begin() as connection:
+        for table in metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            existing = set(column['name'] for column in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name not in existing:
+                    connection.execute(text('ALTER TABLE {} ADD COLUMN IF NOT EXISTS {}'.format(
+                        table.name, compiler.get_column_specification(column)
+                    )))
+                    added.append('{}.{}'.format(table.name, column.name))
+    return added
+
+
+def load_tracts(dbsession, shapefile, srid=DEFAULT_SRID, adjacency=None, dataset=COLORADO):
+    """Replace the contents of the dataset's tract table with the shapefile's records."""
+    table = dataset.tract.__table__.name
+    dbsession.execute(text('TRUNCATE {}'.format(table)))
+    copy_rows(
+        dbsession, table,
+        ('gid', 'shape_area', 'tract_pop', 'county', 'isborder', 'perimeter', 'geom'),
+        tract_rows(shapefile, srid, adjacency)
+    )
+    dbsession.execute(text(  # Keep the gid sequence ahead of the copied ids.
+        "SELECT setval(pg_get_serial_sequence('{0}', 'gid'), coalesce(max(gid), 1)) FROM {0}".format(table)
+    ))
+    mark_changed(dbsession)  # The session can't see raw SQL, so tell the transaction to commit.
+
+
+def load_edges(dbsession, adjacency, dataset=COLORADO):
+    """Replace the contents of the dataset's edge table with the adjacency's edges."""
+    table = dataset.edge.__table__.name
+    dbsession.execute(text('TRUNCATE {}'.format(table)))
+    copy_rows(dbsession, table, ('edgeid', 'tract_source', 'tract_target', 'length'), adjacency.edge_rows())
+    dbsession.execute(text(
+        "SELECT setval(pg_get_serial_sequence('{0}', 'edgeid'), coalesce(max(edgeid), 1)) FROM {0}".format(table)
+    ))
+    mark_changed(dbsession)
+
+
+def load_arcs(dbsession, topology, srid=DEFAULT_SRID, dataset=COLORADO):
+    """Replace the contents of the dataset's arc tables with the topology's arcs, at every level.
+
+    topology is a Topology or a StreamedTopology.
+    """
+    table = dataset.arc.__table__.name
+    level_table = dataset.arc_level.__table__.name
+    dbsession.execute(text('TRUNCATE {}, {}'.format(table, level_table)))
+    copy_rows(dbsession, table, ('arcid', 'tract_gid', 'other_gid', 'geom'), topology.arc_rows(srid))
+    copy_rows(dbsession, level_table, ('arcid', 'level', 'geom'), topology.level_rows(srid))
+    dbsession.execute(text(
+        "SELECT setval(pg_get_serial_sequence('{0}', 'arcid'), coalesce(max(arcid), 1)) FROM {0}".format(table)
+    ))
+    mark_changed(dbsession)
+
+
+def unpaired_edges(dbsession, dataset=COLORADO):
+    """Return the (source, target) pairs, lower gid first, with a border in the edge table but no arc between them.
+
+    Tracts in the same district whose shared boundary has no arc would be
+    dissolved with a sliver between them, so main reports any it finds.
+    """
+    edge = dataset.edge.__table__.name
+    arc = dataset.arc.__table__.name
+    rows = dbsession.execute(text(
+        'SELECT tract_source, tract_target FROM {0} WHERE tract_source < tract_target AND length > 0 '
+        'AND NOT EXISTS (SELECT 1 FROM {1} WHERE (tract_gid = tract_source AND other_gid = tract_target) '
+        'OR (tract_gid = tract_target AND other_gid = tract_source)) '
+        'ORDER BY tract_source, tract_target'.format(edge, arc)
+    ))
+    return [(source, target) for source, target in rows]
 
 
 def usage(argv): #pragma: no cover
     cmd = os.path.basename(argv[0])
-    print('usage: %s <config_uri> [var=value]\n'
-          '(example: "%s development.ini")' % (cmd, cmd))
+    print('usage: %s <config_uri> [shapefile=path] [srid=4269] [workers=1] [buckets=16] [dataset=colorado]\n'
+          '       [var=value]\n'
+          '(example: "%s development.ini")\n'
+          'Replaces the dataset\'s tract, edge and arc tables with the shapefile\'s\n'
+          'tracts, the borders between them and their boundaries cut into arcs.\n'
+          'Datasets other than colorado must be listed in gerrypy.datasets.' % (cmd, cmd))
     sys.exit(1)
 
 
@@ -33,11 +174,29 @@ def main(argv=sys.argv):#pragma: no cover
     setup_logging(config_uri)
     settings = get_appsettings(config_uri, options=options)
     settings["sqlalchemy.url"] = os.environ["DATABASE_URL"]
+    dataset = parse_datasets(settings.get('gerrypy.datasets')).get(options.get('dataset', COLORADO.name))
+    if dataset is None:
+        usage(argv)
 
-    engine = get_engine(settings)
+    engine = get_engine(settings)  # The dataset's tables were declared when the datasets were parsed.
     Base.metadata.create_all(engine)
+    for name in add_missing_columns(engine):
+        print('Added column {}'.format(name))
 
     session_factory = get_session_factory(engine)
 
     with transaction.manager:
         dbsession = get_tm_session(session_factory, transaction.manager)
+        shapefile = options.get('shapefile', DEFAULT_SHAPEFILE)
+        buckets = int(options.get('buckets', DEFAULT_BUCKETS))
+        adjacency = build_adjacency(tract_rings(shapefile), workers=int(options.get('workers', 1)), buckets=buckets)
+        srid = int(options.get('srid', DEFAULT_SRID))
+        load_tracts(dbsession, shapefile, srid, adjacency, dataset)
+        load_edges(dbsession, adjacency, dataset)
+        with StreamedTopology(lambda: tract_rings(shapefile), buckets) as topology:
+            load_arcs(dbsession, topology, srid, dataset)
+        unpaired = unpaired_edges(dbsession, dataset)
+        if unpaired:
+            print('Warning: {} tract pairs share an edge but no arc, so their districts may show slivers: {}'.format(
+                len(unpaired), ', '.join('{}-{}'.format(*pair) for pair in unpaired[:10])
+            ))
@@ -0,0 +1,253 @@
+"""
+Build plans in a process pool, in the background of the web app.
+
+A plan build holds the GIL for as long as it runs, so built in a request
+thread it stalls every other request, and a slow one outlasts the
+platform's request timeout.  Instead the map page submits a Job and polls
+it.  Each start of a job is built by the engine it asks for in a worker
+process over the tract graph snapshot, as multistart does.  When the last
+start finishes, the best plan is stored by a thread of the web process,
+outside any request.
+
+The pool limits how many starts run at once, and submit refuses new jobs
+once max_jobs are waiting or running.  Jobs live in the memory of the
+process that took them; the plans they store are kept like any other.
+"""
+
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from gerrypy.scripts.multistart import build_plan, start_criteria
+from gerrypy.scripts.snapshot import pin_snapshot, unpin_snapshot
+
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+MAX_JOBS = 16
+MAX_STARTS = 64  # Most starts one job may build.
+KEEP_JOBS = 256  # Finished jobs remembered for polling.
+
+_queues = {}
+_lock = threading.Lock()
+
+
+def describe(error):
+    """Return the one line an exception prints as."""
+    return ''.join(traceback.format_exception_only(type(error), error)).strip()
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while max_jobs are already waiting or running."""
+
+
+class Job(object):
+    """A plan build in the queue.
+
+    status is one of QUEUED, RUNNING, DONE, FAILED and CANCELLED.  progress
+    is the fraction of its starts built, and planid is set once the best
+    plan has been stored.
+    """
+
+    def __init__(self, jobid, key, starts, path=None):
+        """Initialize the Job Object."""
+        self.jobid = jobid
+        self.key = key
+        self.starts = starts
+        self.path = path
+        self.built = 0
+        self.futures = []
+        self.planid = None
+        self.error = None
+        self.cancelled = False
+        self.submitted = time.time()
+        self.finished = None
+
+    @property
+    def status(self):
+        """Return where the job is."""
+        if self.cancelled:
+            return CANCELLED
+        if self.error is not None:
+            return FAILED
+        if self.planid is not None:
+            return DONE
+        if self.built or any(future.running() for future in self.futures):
+            return RUNNING
+        return QUEUED
+
+    @property
+    def progress(self):
+        """Return the fraction of starts built."""
+        return self.built / self.starts
+
+    def as_dict(self):
+        """Return the job's state for JSON."""
+        return OrderedDict([
+            ('jobid', self.jobid),
+            ('status', self.status),
+            ('progress', self.progress),
+            ('planid', self.planid),
+            ('error', self.error),
+        ])
+
+
+class JobQueue(object):
+    """Runs Jobs' starts in a process pool and stores their best plans.
+
+    submit(self, key, path, num_dst, criteria, starts, store, engine): queues a job,
+    or returns the job already building the plan with that cache key.
+    get(self, jobid) and cancel(self, jobid) look a job up and stop it.
+    """
+
+    def __init__(self, workers=None, max_jobs=MAX_JOBS, keep=KEEP_JOBS):
+        """Initialize the JobQueue Object."""
+        self.workers = workers or os.cpu_count() or 1
+        self.max_jobs = max_jobs
+        self.keep = keep
+        self._pool = None
+        self._storer = ThreadPoolExecutor(1)  # Stores finished plans one at a time, off the request threads.
+        self._jobs = OrderedDict()  # jobid -> Job, oldest first.
+        self._active = {}  # cache key -> Job still building it.
+        self._lock = threading.Lock()
+
+    def submit(self, key, path, num_dst, criteria, starts, store, engine='array'):
+        """Queue starts builds by engine over the snapshot at path and return the Job.
+
+        store(assignment) is called with the best plan's assignment, in a
+        thread of this process, and returns the stored plan's planid.
+        Raises QueueFull if max_jobs jobs are already waiting or running.
+        The snapshot is pinned until the job finishes.
+        """
+        with self._lock:
+            if key is not None and key in self._active:
+                return self._active[key]
+            if sum(1 for job in self._jobs.values() if job.finished is None) >= self.max_jobs:
+                raise QueueFull('{} plans are already being built.'.format(self.max_jobs))
+            job = Job(uuid.uuid4().hex, key, starts, path)
+            pin_snapshot(path)
+            self._jobs[job.jobid] = job
+            if key is not None:
+                self._active[key] = job
+            self._forget_finished()
+            jobs = [criteria] if starts == 1 else start_criteria(criteria, starts)  # One start builds what State would.
+            for start in jobs:
+                job.futures.append(self._submit(build_plan, path, num_dst, start, engine))
+        for future in job.futures:  # Added once every start is in, and outside the lock: a done future calls back at once.
+            future.add_done_callback(lambda future, job=job: self._built(job, future, store))
+        return job
+
+    def get(self, jobid):
+        """Return the job with jobid, or None."""
+        with self._lock:
+            return self._jobs.get(jobid)
+
+    def cancel(self, jobid):
+        """Stop the job with jobid and return it, or None if there is no such job.
+
+        Starts that haven't begun are dropped.  Ones already running in a
+        worker finish, but nothing is stored.
+        """
+        with self._lock:
+            job = self._jobs.get(jobid)
+            if job is None or job.finished is not None:
+                return job
+            job.cancelled = True
+            self._finish(job)
+        for future in job.futures:
+            future.cancel()
+        return job
+
+    def _submit(self, func, *args):
+        """Submit func to the pool, starting a new pool if there is none or a worker died."""
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers)
+        try:
+            return self._pool.submit(func, *args)
+        except BrokenProcessPool:
+            self._pool = ProcessPoolExecutor(self.workers)
+            return self._pool.submit(func, *args)
+
+    def _built(self, job, future, store):
+        """Count a finished start, and hand the plans to store once all of them are in."""
+        if future.cancelled():
+            return
+        with self._lock:
+            if job.finished is not None:
+                return
+            error = future.exception()
+            if error is not None:
+                job.error = describe(error)
+                self._finish(job)
+                failed = True
+            else:
+                job.built += 1
+                failed = False
+            if not failed and job.built < job.starts:
+                return
+        if failed:
+            for other in job.futures:
+                other.cancel()
+            return
+        self._storer.submit(self._store, job, store)
+
+    def _store(self, job, store):
+        """Store the job's best plan."""
+        plans = [future.result() for future in job.futures]
+        best = min(plans, key=lambda plan: (plan.metrics.deviation, plan.seed))
+        try:
+            planid = store(best.assignment)
+        except Exception as error:
+            with self._lock:
+                if job.finished is None:
+                    job.error = describe(error)
+                    self._finish(job)
+            return
+        with self._lock:
+            if job.finished is None:
+                job.planid = planid
+                self._finish(job)
+
+    def _finish(self, job):
+        """Mark job finished and free its key and snapshot.  Call with the lock held."""
+        job.finished = time.time()
+        unpin_snapshot(job.path)
+        if self._active.get(job.key) is job:
+            del self._active[job.key]
+
+    def _forget_finished(self):
+        """Drop the oldest finished jobs past keep.  Call with the lock held."""
+        finished = [jobid for jobid, job in self._jobs.items() if job.finished is not None]
+        for jobid in finished[:max(0, len(finished) - self.keep)]:
+            del self._jobs[jobid]
+
+    def shutdown(self):
+        """Stop the pool and the storing thread, waiting for what they are doing."""
+        if self._pool is not None:
+            self._pool.shutdown()
+        self._storer.shutdown()
+
+
+def max_starts(request):
+    """Return how many starts one job may build."""
+    registry = getattr(request, 'registry', None)
+    settings = getattr(registry, 'settings', None) or {}
+    return int(settings.get('gerrypy.max_starts', MAX_STARTS))
+
+
+def get_job_queue(request):
+    """Return this process's job queue, sized from the app's settings."""
+    registry = getattr(request, 'registry', None)
+    settings = getattr(registry, 'settings', None) or {}
+    with _lock:
+        if 'queue' not in _queues:
+            workers = settings.get('gerrypy.workers')
+            _queues['queue'] = JobQueue(
+                int(workers) if workers else None,
+                int(settings.get('gerrypy.max_jobs', MAX_JOBS)),
+            )
+        return _queues['queue']
@@ -0,0 +1,85 @@
+"""Score a districting plan over the CSR tract graph."""
+
+from collections import namedtuple
+
+import numpy as np
+
+
+PlanMetrics = namedtuple('PlanMetrics', 'deviation county_splits cut_edges')
+PlanMetrics.__doc__ = """How far a plan is from ideal; lower is better in every field.
+
+deviation is the largest relative distance of a district's population from
+an equal share, county_splits the number of counties in more than one
+district, and cut_edges the number of neighboring tract pairs in different
+districts, a stand-in for compactness.
+"""
+
+
+def population_deviation(tract_graph, assignment, num_dst):
+    """Return the largest relative distance of a district's population from an equal share."""
+    tract_pop = np.asarray(tract_graph.tract_pop, dtype=np.float64)
+    populations = np.bincount(assignment, weights=tract_pop, minlength=num_dst + 1)[1:num_dst + 1]
+    ideal = tract_pop.sum() / num_dst
+    return float(np.abs(populations - ideal).max() / ideal) if ideal else 0.0
+
+
+def county_splits(tract_graph, assignment):
+    """Return the number of counties whose tracts fall in more than one district."""
+    county = np.asarray(tract_graph.county, dtype=np.int64)
+    claimed = assignment != 0
+    pairs = np.unique(np.stack([county[claimed], assignment[claimed]]), axis=1)
+    counties, pieces = np.unique(pairs[0], return_counts=True)
+    return int((pieces > 1).sum())
+
+
+def cut_edges(tract_graph, assignment):
+    """Return the number of neighboring tract pairs assigned to different districts."""
+    offsets = np.asarray(tract_graph.offsets, dtype=np.int64)
+    neighbors = np.asarray(tract_graph.neighbors, dtype=np.int64)
+    sources = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    return int((assignment[sources] != assignment[neighbors]).sum() // 2)
+
+
+def polsby_popper(tract_graph, assignment, num_dst):
+    """Return each district's Polsby-Popper score, 4 pi area over boundary squared, in district order.
+
+    A district's boundary is its tracts' perimeters less twice the borders
+    between them, so no shapes are needed.
+    """
+    assignment = np.asarray(assignment, dtype=np.int64)
+    offsets = np.asarray(tract_graph.offsets, dtype=np.int64)
+    neighbors = np.asarray(tract_graph.neighbors, dtype=np.int64)
+    lengths = np.asarray(tract_graph.lengths, dtype=np.float64)
+    sources = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    internal = assignment[sources] == assignment[neighbors]  # Both directions, so each border counts twice.
+    area = np.bincount(assignment, weights=np.asarray(tract_graph.shape_area, dtype=np.float64), minlength=num_dst + 1)
+    boundary = np.bincount(assignment, weights=np.asarray(tract_graph.perimeter, dtype=np.float64), minlength=num_dst + 1)
+    boundary -= np.bincount(assignment[sources[internal]], weights=lengths[internal], minlength=num_dst + 1)
+    area, boundary = area[1:num_dst + 1], boundary[1:num_dst + 1]
+    scores = np.zeros(num_dst)
+    np.divide(4 * np.pi * area, boundary ** 2, out=scores, where=boundary > 0)
+    return scores
+
+
+def plan_metrics(tract_graph, assignment, num_dst):
+    """Score an assignment array, one district number per tract in gid order."""
+    assignment = np.asarray(assignment, dtype=np.int64)
+    return PlanMetrics(
+        population_deviation(tract_graph, assignment, num_dst),
+        county_splits(tract_graph, assignment),
+        cut_edges(tract_graph, assignment),
+    )
+
+
+def pareto_front(plans, key=lambda plan: plan.metrics):
+    """Return the plans that no other plan is at least as good as on every metric and better on one."""
+    scores = [tuple(key(plan)) for plan in plans]
+    front = []
+    for idx, score in enumerate(scores):
+        dominated = any(
+            other != score and all(mine >= theirs for mine, theirs in zip(score, other))
+            for other in scores
+        )
+        if not dominated:
+            front.append(plans[idx])
+    return front
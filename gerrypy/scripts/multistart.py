@@ -0,0 +1,112 @@
+"""
+Draw many randomized plans in a process pool and keep the best.
+
+Every start is a build by one of the ENGINES with its own seed, which
+breaks rating ties at random and drives the kmeans++ seeding when that is
+asked for; both engines draw the same plan for the same seed.  Workers map
+the same tract graph snapshot, so they share its pages through the OS
+cache rather than each querying the database or unpickling a copy.
+"""
+
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from gerrypy.scripts.array_engine import ArrayState
+from gerrypy.scripts.assigndistrict import assign_gids
+from gerrypy.scripts.fish_scales import State, StateTemplate
+from gerrypy.scripts.metrics import pareto_front, plan_metrics
+from gerrypy.scripts.snapshot import read_snapshot, request_tract_graph
+
+
+Plan = namedtuple('Plan', 'seed assignment metrics')
+
+ENGINES = {'networkx': State, 'array': ArrayState}
+
+_graphs = {}  # snapshot path -> tract graph, one per worker process.
+_states = {}  # (snapshot path, num_dst) -> ArrayState, one per worker process.
+
+
+def start_criteria(criteria, starts):
+    """Return the criteria for each of starts randomized builds."""
+    first = int(criteria.get('seed') or 0)
+    return [dict(criteria, seed=first + start, ties='random') for start in range(starts)]
+
+
+def _worker_state(path, num_dst, engine='array'):
+    """Return a state of engine over the snapshot at path, ready to build.
+
+    An ArrayState resets itself for every build, so this process keeps one.
+    A State builds once, so a new one is cloned from the graph's template.
+    """
+    if engine not in ENGINES:
+        raise ValueError('Unknown engine {!r}.'.format(engine))
+    if path not in _graphs:
+        _graphs[path] = read_snapshot(path)[1]
+    tract_graph = _graphs[path]
+    if engine == 'networkx':
+        template = getattr(tract_graph, 'state_template', None)
+        if template is None:
+            template = tract_graph.state_template = StateTemplate(tract_graph)
+        return State(None, num_dst, template=template)
+    key = (path, num_dst)
+    if key not in _states:
+        _states[key] = ArrayState(None, num_dst, tract_graph=tract_graph)
+    return _states[key]
+
+
+def build_plan(path, num_dst, criteria, engine='array'):
+    """Build and score one plan with engine over the snapshot at path."""
+    state = _worker_state(path, num_dst, engine)
+    assignment = state.build(criteria)
+    return Plan(criteria['seed'], assignment, plan_metrics(state.tract_graph, assignment, num_dst))
+
+
+def multistart(path, num_dst, criteria, starts, workers=None, engine='array'):
+    """Build starts randomized plans with engine over the snapshot at path, in parallel.
+
+    Returns every Plan, best population deviation first.  workers defaults
+    to one per CPU; with a single worker the plans are built in this process.
+    """
+    jobs = start_criteria(criteria, starts)
+    workers = min(workers or os.cpu_count() or 1, starts)
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            plans = list(pool.map(
+                build_plan, [path] * starts, [num_dst] * starts, jobs, [engine] * starts,
+                chunksize=max(1, starts // (4 * workers))
+            ))
+    else:
+        plans = [build_plan(path, num_dst, job, engine) for job in jobs]
+    return sorted(plans, key=lambda plan: (plan.metrics.deviation, plan.seed))
+
+
+class MultiStart(object):
+    """Fills a state with the best of many randomized plans.
+
+    fill_state(self, criteria): builds starts plans and stores the one with
+    the lowest population deviation, keeping its id in planid.  Every plan
+    is kept in plans, and front() returns the ones on the Pareto front of
+    deviation, county splits and cut edges.
+    """
+
+    def __init__(self, request, num_dst, starts, workers=None, engine='array'):
+        """Initialize the MultiStart Object."""
+        self.request = request
+        self.num_dst = num_dst
+        self.starts = starts
+        self.workers = workers
+        self.engine = engine
+        self.tract_graph = request_tract_graph(request)
+        self.plans = []
+        self.planid = None
+
+    def fill_state(self, criteria):
+        """Build every start and assign the best plan's districts."""
+        self.plans = multistart(self.tract_graph.snapshot_path, self.num_dst, criteria, self.starts, self.workers, self.engine)
+        best = self.plans[0]
+        self.planid = assign_gids(self.request, zip(self.tract_graph.gid, (int(district) or None for district in best.assignment)))
+
+    def front(self):
+        """Return the plans on the Pareto front of deviation, county splits and cut edges."""
+        return pareto_front(self.plans)
@@ -0,0 +1,287 @@
+"""
+Cache built plans by the inputs that decide them.
+
+A plan depends only on the weights, the seeding, the seed, whether it is
+refined, the number of districts, the number of starts and the tract and
+edge tables, so the result of a build can be reused by every later request
+that asks for the same thing.  Results are kept in a least recently used dict in this
+process and in files in a directory, which outlive the process and are
+shared with other workers.  Both tiers evict the least recently used plans
+once they pass their size limit.  Plans in memory also count against the
+budget the process holds tract graphs and arcs under, in snapshot.py, and
+are dropped when that budget drops them.
+
+Identical requests that arrive while a plan is being built wait for that
+build instead of starting their own.
+"""
+
+import hashlib
+import os
+import struct
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict, namedtuple
+
+from gerrypy.scripts.snapshot import GRAPH_MEMORY_BYTES, hold, let_go, memory_budget
+
+
+MAGIC = b'GPYPLAN\0'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIqQ')  # magic, format version, planid, tracts
+MEMORY_BYTES = 64 * 2 ** 20
+DISK_BYTES = 512 * 2 ** 20
+
+CachedPlan = namedtuple('CachedPlan', 'planid assignment geojson')
+CachedPlan.__doc__ = """A built plan: its planid, (gid, districtid) pairs in gid order and its GeoJSON."""
+
+_caches = {}
+_lock = threading.Lock()
+
+
+def plan_key(fingerprint, num_dst, criteria, starts=1, engine='array'):
+    """Return the cache key for a build, or None if the build is random."""
+    seed = criteria.get('seed')
+    if seed is None and starts == 1 and criteria.get('seeding') == 'kmeans++':
+        return None  # Seeded from the clock, so every build differs.
+    inputs = (
+        fingerprint, num_dst, starts, int(criteria['county']), int(criteria['compactness']),
+        int(criteria.get('polsby', 0)), criteria.get('seeding', 'border'), None if seed is None else str(seed),
+        int(criteria.get('refine', 0)), engine,
+    )
+    return hashlib.sha1(repr(inputs).encode('utf-8')).hexdigest()
+
+
+def plan_size(plan):
+    """Return roughly how many bytes a plan takes."""
+    return len(plan.geojson) + 16 * len(plan.assignment)
+
+
+def write_plan(path, plan):
+    """Write plan to path, replacing any existing file atomically."""
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as the_file:
+            the_file.write(HEADER.pack(MAGIC, FORMAT_VERSION, plan.planid, len(plan.assignment)))
+            the_file.write(array('q', (gid for gid, districtid in plan.assignment)).tobytes())
+            the_file.write(array('q', (districtid for gid, districtid in plan.assignment)).tobytes())
+            the_file.write(plan.geojson.encode('utf-8'))
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def read_plan(path):
+    """Read the plan at path."""
+    with open(path, 'rb') as the_file:
+        data = the_file.read()
+    magic, version, planid, num_tracts = HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError('{} is not a version {} cached plan.'.format(path, FORMAT_VERSION))
+    position = HEADER.size
+    gids = array('q', data[position:position + 8 * num_tracts])
+    position += 8 * num_tracts
+    districtids = array('q', data[position:position + 8 * num_tracts])
+    position += 8 * num_tracts
+    return CachedPlan(planid, list(zip(gids, districtids)), data[position:].decode('utf-8'))
+
+
+class PlanCache(object):
+    """A two-tier, single-flight cache of built plans.
+
+    get(self, key, build): returns the plan cached under key, calling build
+    to make it if neither tier has it; lookup(self, key) returns None
+    instead.  find(self, planid) looks a plan up in memory by its id, through
+    an index kept alongside the memory tier, and planids() lists every
+    cached plan's id.  stats() returns the hit, miss and eviction counters.
+    budget_bytes is the process's budget the memory tier also counts against.
+    """
+
+    def __init__(self, directory, memory_bytes=MEMORY_BYTES, disk_bytes=DISK_BYTES, budget_bytes=GRAPH_MEMORY_BYTES):
+        """Initialize the PlanCache Object."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.budget_bytes = budget_bytes
+        self._memory = OrderedDict()  # key -> plan, least recently used first.
+        self._planids = {}  # planid -> key of every plan in memory.
+        self._memory_used = 0
+        self._building = {}  # key -> Event set when its build finishes.
+        self._lock = threading.Lock()
+        self.counters = OrderedDict(
+            (name, 0) for name in ('memory_hits', 'disk_hits', 'misses', 'coalesced', 'evictions')
+        )
+
+    def find(self, planid):
+        """Return the plan with planid if it is in memory, or None."""
+        with self._lock:
+            key = self._planids.get(planid)
+            return None if key is None else self._memory[key]
+
+    def planids(self):
+        """Return the ids of every plan in memory or on disk, which pruning must spare."""
+        with self._lock:
+            planids = set(self._planids)
+        for name in os.listdir(self.directory):
+            if name.startswith('plan-') and name.endswith('.bin'):
+                try:
+                    with open(os.path.join(self.directory, name), 'rb') as the_file:
+                        magic, version, planid, num_tracts = HEADER.unpack(the_file.read(HEADER.size))
+                except (OSError, struct.error):
+                    continue
+                if magic == MAGIC and version == FORMAT_VERSION:
+                    planids.add(planid)
+        return planids
+
+    def path(self, key):
+        """Return the file a plan is cached in."""
+        return os.path.join(self.directory, 'plan-{}.bin'.format(key))
+
+    def stats(self):
+        """Return a copy of the counters."""
+        with self._lock:
+            return OrderedDict(self.counters)
+
+    def get(self, key, build):
+        """Return the plan cached under key, building it at most once at a time."""
+        while True:
+            with self._lock:
+                plan = self._memory.get(key)
+                if plan is not None:
+                    self._memory.move_to_end(key)
+                    self.counters['memory_hits'] += 1
+                    return plan
+                building = self._building.get(key)
+                if building is None:
+                    building = self._building[key] = threading.Event()
+                    break
+                self.counters['coalesced'] += 1
+            building.wait()  # Then look again; if that build failed, this request builds instead.
+        try:
+            plan = self._read(key)
+            if plan is None:
+                with self._lock:
+                    self.counters['misses'] += 1
+                plan = build()
+                self._write(key, plan)
+            else:
+                with self._lock:
+                    self.counters['disk_hits'] += 1
+            with self._lock:
+                evicted = self._remember(key, plan)
+            self._hold(key, plan, evicted)
+            return plan
+        finally:
+            with self._lock:
+                del self._building[key]
+            building.set()
+
+    def lookup(self, key):
+        """Return the plan cached under key in either tier, or None, without building it."""
+        with self._lock:
+            plan = self._memory.get(key)
+            if plan is not None:
+                self._memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return plan
+        plan = self._read(key)
+        if plan is not None:
+            with self._lock:
+                self.counters['disk_hits'] += 1
+                if key in self._memory:
+                    return plan
+                evicted = self._remember(key, plan)
+            self._hold(key, plan, evicted)
+        return plan
+
+    def _remember(self, key, plan):
+        """Put plan in memory, drop the least recently used plans past the limit and return their keys."""
+        self._memory[key] = plan
+        self._planids[plan.planid] = key
+        self._memory_used += plan_size(plan)
+        evicted = []
+        while self._memory_used > self.memory_bytes and len(self._memory) > 1:
+            old_key, old_plan = self._memory.popitem(last=False)
+            self._drop(old_key, old_plan)
+            evicted.append(old_key)
+        return evicted
+
+    def _drop(self, key, plan):
+        """Account for plan, just taken out of memory."""
+        if self._planids.get(plan.planid) == key:
+            del self._planids[plan.planid]
+        self._memory_used -= plan_size(plan)
+        self.counters['evictions'] += 1
+
+    def _hold(self, key, plan, evicted):
+        """Count plan against the process's budget in place of the evicted plans.  Called outside the lock."""
+        for old_key in evicted:
+            let_go(('plan', self.directory, old_key))
+        hold(('plan', self.directory, key), None, plan, plan_size(plan), self.budget_bytes, lambda: self._forget(key, plan))
+
+    def _forget(self, key, plan):
+        """Take plan out of memory, if it is still there, once the process's budget drops it."""
+        with self._lock:
+            if self._memory.get(key) is plan:
+                del self._memory[key]
+                self._drop(key, plan)
+
+    def _read(self, key):
+        """Return the plan cached on disk under key, or None."""
+        path = self.path(key)
+        try:
+            plan = read_plan(path)
+            os.utime(path)  # Mark it recently used.
+        except (OSError, ValueError, struct.error):
+            return None
+        return plan
+
+    def _write(self, key, plan):
+        """Save plan to disk and delete the least recently used files past the limit."""
+        write_plan(self.path(key), plan)
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('plan-') and name.endswith('.bin'):
+                try:
+                    status = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((status.st_mtime, name, status.st_size))
+        used = sum(size for mtime, name, size in entries)
+        for mtime, name, size in sorted(entries):
+            if used <= self.disk_bytes or name == os.path.basename(self.path(key)):
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            used -= size
+            with self._lock:
+                self.counters['evictions'] += 1
+
+
+def plan_cache_dir(request):
+    """Return the plan cache directory configured for this app."""
+    registry = getattr(request, 'registry', None)
+    settings = getattr(registry, 'settings', None) or {}
+    return settings.get('gerrypy.plan_cache_dir') or os.path.join(tempfile.gettempdir(), 'gerrypy', 'plans')
+
+
+def get_plan_cache(request):
+    """Return this process's plan cache for the configured directory."""
+    registry = getattr(request, 'registry', None)
+    settings = getattr(registry, 'settings', None) or {}
+    directory = plan_cache_dir(request)
+    with _lock:
+        if directory not in _caches:
+            _caches[directory] = PlanCache(
+                directory,
+                int(settings.get('gerrypy.plan_cache_memory_bytes', MEMORY_BYTES)),
+                int(settings.get('gerrypy.plan_cache_disk_bytes', DISK_BYTES)),
+                memory_budget(request),
+            )
+        return _caches[directory]
@@ -0,0 +1,269 @@
+"""
+Sample an ensemble of plans with the ReCom Markov chain.
+
+usage: gerrypy_ensemble <config_uri> [snapshot=path] [steps=10000] [districts=7]
+       [epsilon=0.05] [seed=0] [county=1] [compactness=1]
+
+Each step picks a random cut edge, merges the two districts on either side,
+draws a uniform random spanning tree of the merged region with Wilson's
+algorithm and cuts one of its edges that leaves both halves balanced.  Cut
+edges, district populations and county splits are updated only for the
+tracts that change district, so a step costs time in the size of the
+merged region rather than the state.
+
+main() starts the chain from the State plan for the given weights and
+reports where that plan falls in the ensemble.
+"""
+
+import sys
+from collections import namedtuple
+from random import Random
+
+from pyramid.paster import setup_logging
+from pyramid.scripts.common import parse_vars
+
+from gerrypy.scripts.array_engine import ArrayState
+from gerrypy.scripts.benchmarks import load_graph
+from gerrypy.scripts.metrics import plan_metrics
+
+
+ChainStep = namedtuple('ChainStep', 'accepted deviation county_splits cut_edges')
+
+
+class Recom(object):
+    """A ReCom chain over the CSR tract graph.
+
+    assignment gives each tract's district, in gid order, numbered from 1;
+    tracts numbered 0 are left out of the chain.  A split is balanced when
+    both halves are within epsilon of an equal share of the population, or
+    no further from it than the worse of the two districts they replace, so
+    a chain started from an unbalanced plan only moves toward balance.
+    """
+
+    def __init__(self, tract_graph, assignment, epsilon=0.05, seed=None, max_trees=10):
+        """Initialize the Recom Object."""
+        offsets = list(tract_graph.offsets)
+        flat = list(tract_graph.neighbors)
+        self.adjacency = [flat[start:end] for start, end in zip(offsets, offsets[1:])]
+        self.tract_pop = list(tract_graph.tract_pop)
+        self.county = list(tract_graph.county)
+        self.assignment = [int(district) for district in assignment]
+        self.num_dst = max(self.assignment)
+        self.epsilon = epsilon
+        self.max_trees = max_trees
+        self.random = Random(seed)
+        self.members = [[] for _ in range(self.num_dst + 1)]
+        self.populations = [0] * (self.num_dst + 1)
+        for tract, district in enumerate(self.assignment):
+            self.members[district].append(tract)
+            self.populations[district] += self.tract_pop[tract]
+        self.ideal = sum(self.populations[1:]) / self.num_dst
+        self.cut = {}  # (tract, tract) -> position in cut_list, for O(1) removal and random choice.
+        self.cut_list = []
+        self.pieces = {}  # county -> {district: tracts}
+        self.county_splits = 0
+        for tract, district in enumerate(self.assignment):
+            if district:
+                self._add_to_county(tract, district)
+                for neighbor in self.adjacency[tract]:
+                    if tract < neighbor and self.assignment[neighbor] and self.assignment[neighbor] != district:
+                        self._add_cut(tract, neighbor)
+        self.stamp = [0] * len(self.adjacency)  # Marks tracts seen in the current step.
+        self.next_step = [0] * len(self.adjacency)  # Where each tract's random walk last went.
+        self.step_count = 0
+
+    @property
+    def cut_edges(self):
+        """Return the number of neighboring tract pairs in different districts."""
+        return len(self.cut_list)
+
+    def deviation(self):
+        """Return the largest relative distance of a district's population from an equal share."""
+        return max(abs(population - self.ideal) for population in self.populations[1:]) / self.ideal
+
+    def _add_cut(self, tract, neighbor):
+        """Record a cut edge."""
+        edge = (tract, neighbor) if tract < neighbor else (neighbor, tract)
+        self.cut[edge] = len(self.cut_list)
+        self.cut_list.append(edge)
+
+    def _remove_cut(self, tract, neighbor):
+        """Forget a cut edge by moving the last one into its place."""
+        edge = (tract, neighbor) if tract < neighbor else (neighbor, tract)
+        position = self.cut.pop(edge)
+        last = self.cut_list.pop()
+        if last != edge:
+            self.cut_list[position] = last
+            self.cut[last] = position
+
+    def _add_to_county(self, tract, district):
+        """Count tract in its county's piece for district."""
+        pieces = self.pieces.setdefault(self.county[tract], {})
+        pieces[district] = pieces.get(district, 0) + 1
+        if pieces[district] == 1 and len(pieces) == 2:
+            self.county_splits += 1
+
+    def _remove_from_county(self, tract, district):
+        """Uncount tract from its county's piece for district."""
+        pieces = self.pieces[self.county[tract]]
+        pieces[district] -= 1
+        if not pieces[district]:
+            del pieces[district]
+            if len(pieces) == 1:
+                self.county_splits -= 1
+
+    def move(self, tract, district):
+        """Reassign tract and update every tally it touches."""
+        old = self.assignment[tract]
+        self.assignment[tract] = district
+        self.populations[old] -= self.tract_pop[tract]
+        self.populations[district] += self.tract_pop[tract]
+        self._remove_from_county(tract, old)
+        self._add_to_county(tract, district)
+        for neighbor in self.adjacency[tract]:
+            other = self.assignment[neighbor]
+            if not other:
+                continue
+            if other == old:
+                self._add_cut(tract, neighbor)
+            elif other == district:
+                self._remove_cut(tract, neighbor)
+
+    def random_spanning_tree(self, region, neighbors):
+        """Draw a uniform spanning tree of region with Wilson's algorithm.
+
+        Returns (root, parent) with parent[tract] the next tract toward the root.
+        """
+        random = self.random.random  # Much cheaper per call than randrange.
+        stamp = self.stamp
+        step = self.next_step
+        mark = self.step_count
+        root = region[int(random() * len(region))]
+        stamp[root] = mark  # In the tree.
+        parent = {root: None}
+        for start in region:
+            tract = start
+            while stamp[tract] != mark:  # Random walk until it hits the tree; revisits overwrite, erasing loops.
+                adjacent = neighbors[tract]
+                step[tract] = adjacent[int(random() * len(adjacent))]
+                tract = step[tract]
+            tract = start
+            while stamp[tract] != mark:
+                stamp[tract] = mark
+                parent[tract] = step[tract]
+                tract = step[tract]
+        return root, parent
+
+    def balanced_cuts(self, root, parent, region_pop, limit):
+        """Return (children, tracts) whose subtree population leaves both halves within limit."""
+        children = {tract: [] for tract in parent}
+        for tract, above in parent.items():
+            if above is not None:
+                children[above].append(tract)
+        order = [root]
+        for tract in order:
+            order.extend(children[tract])
+        subtree = {tract: self.tract_pop[tract] for tract in order}
+        for tract in reversed(order[1:]):
+            subtree[parent[tract]] += subtree[tract]
+        balanced = [
+            tract for tract in order[1:]
+            if abs(subtree[tract] - self.ideal) <= limit and abs(region_pop - subtree[tract] - self.ideal) <= limit
+        ]
+        return children, balanced
+
+    def step(self):
+        """Take one step of the chain and return True if the plan changed."""
+        self.step_count += 1
+        if not self.cut_list:
+            return False
+        tract, neighbor = self.cut_list[int(self.random.random() * len(self.cut_list))]
+        first, second = self.assignment[tract], self.assignment[neighbor]
+        region = self.members[first] + self.members[second]
+        pair = (first, second)
+        neighbors = {}
+        for member in region:
+            neighbors[member] = [other for other in self.adjacency[member] if self.assignment[other] in pair]
+        if not self._connected(region, neighbors):
+            return False
+        region_pop = self.populations[first] + self.populations[second]
+        limit = max(
+            self.epsilon * self.ideal,
+            abs(self.populations[first] - self.ideal), abs(self.populations[second] - self.ideal)
+        )
+        for _ in range(self.max_trees):
+            self.step_count += 1  # A fresh stamp for each tree.
+            root, parent = self.random_spanning_tree(region, neighbors)
+            children, balanced = self.balanced_cuts(root, parent, region_pop, limit)
+            if balanced:
+                break
+        else:
+            return False
+        cut_at = balanced[int(self.random.random() * len(balanced))]
+        side = [cut_at]
+        for member in side:
+            side.extend(children[member])
+        inside = set(side)
+        rest = [member for member in region if member not in inside]
+        kept = sum(1 for member in side if self.assignment[member] == first)
+        kept += len(self.members[second]) - (len(side) - kept)
+        if kept * 2 < len(region):
+            side, rest = rest, side  # Swap labels when that moves fewer tracts.
+        self.members[first] = side
+        self.members[second] = rest
+        for member in self.members[first]:
+            if self.assignment[member] != first:
+                self.move(member, first)
+        for member in self.members[second]:
+            if self.assignment[member] != second:
+                self.move(member, second)
+        return True
+
+    def _connected(self, region, neighbors):
+        """Return True if region is connected through neighbors."""
+        self.step_count += 1
+        mark = self.step_count
+        self.stamp[region[0]] = mark
+        stack = [region[0]]
+        seen = 1
+        while stack:
+            for other in neighbors[stack.pop()]:
+                if self.stamp[other] != mark:
+                    self.stamp[other] = mark
+                    stack.append(other)
+                    seen += 1
+        return seen == len(region)
+
+    def run(self, steps):
+        """Take steps steps and return a ChainStep for each."""
+        history = []
+        for _ in range(steps):
+            accepted = self.step()
+            history.append(ChainStep(accepted, self.deviation(), self.county_splits, self.cut_edges))
+        return history
+
+
+def rank(value, values):
+    """Return the fraction of values at or below value."""
+    return sum(1 for other in values if other <= value) / len(values) if values else 0.0
+
+
+def main(argv=sys.argv):  # pragma: no cover
+    if len(argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    options = parse_vars(argv[2:])
+    setup_logging(argv[1])
+    tract_graph = load_graph(argv[1], options)
+    num_dst = int(options.get('districts', 7))
+    criteria = {'county': options.get('county', 1), 'compactness': options.get('compactness', 1)}
+    start = ArrayState(None, num_dst, tract_graph=tract_graph).build(criteria)
+    chain = Recom(tract_graph, start, float(options.get('epsilon', 0.05)), int(options.get('seed', 0)))
+    history = chain.run(int(options.get('steps', 10000)))
+    initial = plan_metrics(tract_graph, start, num_dst)
+    print('{} of {} steps accepted'.format(sum(step.accepted for step in history), len(history)))
+    for field in ChainStep._fields[1:]:
+        values = [getattr(step, field) for step in history]
+        print('{:<15} start {:10.4f}  ensemble {:10.4f} .. {:10.4f}  start rank {:.3f}'.format(
+            field, getattr(initial, field), min(values), max(values), rank(getattr(initial, field), values)
+        ))
@@ -0,0 +1,257 @@
+"""
+Even out district populations by moving tracts across district borders.
+
+The State algorithm stops each district greedily and hands it every piece
+of land its last tract cut off, so the last districts drawn are often far
+from an equal share.  Refiner works on the finished assignment in passes,
+Fiduccia-Mattheyses style:
+
+1. Every tract on a border between districts a and b can move from a to b.
+   Those moves sit in a bucket for (a, b), ordered by the tract's
+   population.  Moving population p changes the sum of squared district
+   deviations by 2p(p + Pb - Pa), so the best move out of a bucket is the
+   tract nearest (Pa - Pb) / 2, found by bisection.
+2. The best move over all buckets is made even if it makes things worse,
+   and the tract is locked for the rest of the pass.  Only the moved
+   tract's neighbors change buckets, and the district populations change
+   by p, so each move costs the tract's degree plus a look at each bucket.
+3. At the end of the pass the moves after the best largest deviation seen
+   are undone.  Passes repeat until one finds nothing better.
+
+A tract may only leave a district that stays in one piece without it.
+That is checked by a search from one of its neighbors in the district for
+the others, which gives up, and refuses the move, after max_search tracts.
+"""
+
+import bisect
+from collections import namedtuple
+
+
+Refinement = namedtuple('Refinement', 'assignment deviation before moves passes')
+Refinement.__doc__ = """A refined plan: the district of each tract in gid order, its largest
+population deviation, the deviation it started from, and how many tract
+moves and passes it took."""
+
+MAX_PASSES = 20
+PATIENCE = 16  # Moves a pass makes past its best without finding a better one.
+MAX_SEARCH = 128  # Tracts the contiguity check visits before refusing a move.
+CANDIDATES = 8  # Moves tried around the best population in a bucket before passing it over.
+
+
+class Refiner(object):
+    """Moves border tracts between districts to lower the largest population deviation.
+
+    assignment gives each tract's district, in gid order, numbered from 1;
+    tracts numbered 0 are left where they are.  refine() runs the passes
+    and returns a Refinement.
+    """
+
+    def __init__(self, tract_graph, assignment, num_dst, max_search=MAX_SEARCH, patience=PATIENCE):
+        """Initialize the Refiner Object."""
+        offsets = list(tract_graph.offsets)
+        flat = list(tract_graph.neighbors)
+        self.adjacency = [flat[start:end] for start, end in zip(offsets, offsets[1:])]
+        self.tract_pop = list(tract_graph.tract_pop)
+        self.assignment = [int(district) for district in assignment]
+        self.num_dst = num_dst
+        self.max_search = max_search
+        self.patience = patience
+        self.populations = [0] * (num_dst + 1)
+        self.sizes = [0] * (num_dst + 1)
+        for tract, district in enumerate(self.assignment):
+            self.populations[district] += self.tract_pop[tract]
+            self.sizes[district] += 1
+        self.ideal = sum(self.tract_pop) / num_dst  # As metrics.population_deviation has it.
+        self.counts = [{} for _ in self.assignment]  # Each tract's neighbors per district.
+        for tract, neighbors in enumerate(self.adjacency):
+            counts = self.counts[tract]
+            for neighbor in neighbors:
+                district = self.assignment[neighbor]
+                counts[district] = counts.get(district, 0) + 1
+        self.versions = [0] * (num_dst + 1)  # Bumped whenever a district gains or loses a tract.
+        self.connected = {}  # (tract, district) -> (the district's version, stays_connected) when last checked.
+        self.buckets = {}
+        self.locked = set()
+
+    def deviation(self):
+        """Return the largest relative distance of a district's population from an equal share."""
+        if not self.ideal:
+            return 0.0
+        return max(abs(population - self.ideal) for population in self.populations[1:]) / self.ideal
+
+    def score(self):
+        """Return what a pass minimizes: the largest deviation, then the sum of squared deviations."""
+        return self.deviation(), sum((population - self.ideal) ** 2 for population in self.populations[1:])
+
+    def _movable(self, tract, to):
+        """Check whether tract belongs in the bucket for moving it into district to."""
+        district = self.assignment[tract]
+        return (
+            district and to and to != district and tract not in self.locked and
+            self.counts[tract].get(to, 0) > 0
+        )
+
+    def _bucket_add(self, tract, to):
+        """Put tract's move into to in its bucket."""
+        bucket = self.buckets.setdefault((self.assignment[tract], to), [])
+        bisect.insort(bucket, (self.tract_pop[tract], tract))
+
+    def _bucket_remove(self, tract, to):
+        """Take tract's move into to out of its bucket."""
+        bucket = self.buckets[self.assignment[tract], to]
+        del bucket[bisect.bisect_left(bucket, (self.tract_pop[tract], tract))]
+
+    def _fill_buckets(self):
+        """Put every unlocked border tract's moves in their buckets."""
+        self.buckets = {}
+        for tract, counts in enumerate(self.counts):
+            for to in sorted(counts):
+                if self._movable(tract, to):
+                    self._bucket_add(tract, to)
+
+    def stays_connected(self, tract):
+        """Check, locally, that tract's district stays in one piece without it.
+
+        Most border tracts' neighbors in the district touch one another, so
+        they are joined through the tract's own neighbors first; only when
+        they aren't does the search go further afield.  The answer holds
+        until the district changes.
+        """
+        district = self.assignment[tract]
+        version, connected = self.connected.get((tract, district), (None, False))
+        if version != self.versions[district]:
+            connected = self._stays_connected(tract, district)
+            self.connected[tract, district] = (self.versions[district], connected)
+        return connected
+
+    def _stays_connected(self, tract, district):
+        """Search for a way around tract between its neighbors in district."""
+        if self.sizes[district] < 2:
+            return False  # Every district keeps a tract.
+        assignment = self.assignment
+        ring = set(neighbor for neighbor in self.adjacency[tract] if assignment[neighbor] == district)
+        if len(ring) < 2:
+            return True
+        start = next(iter(ring))
+        reached = {start}
+        queue = [start]
+        for current in queue:  # Within the ring first.
+            for neighbor in self.adjacency[current]:
+                if neighbor in ring and neighbor not in reached:
+                    reached.add(neighbor)
+                    queue.append(neighbor)
+        if len(reached) == len(ring):
+            return True
+        targets = ring - reached
+        seen = reached | {tract}
+        for current in queue:
+            for neighbor in self.adjacency[current]:
+                if neighbor not in seen and assignment[neighbor] == district:
+                    targets.discard(neighbor)
+                    if not targets:
+                        return True
+                    seen.add(neighbor)
+                    queue.append(neighbor)
+            if len(seen) > self.max_search:
+                return False
+        return False
+
+    def gain(self, tract, to):
+        """Return how much moving tract into to lowers the sum of squared district deviations."""
+        population = self.tract_pop[tract]
+        return 2 * population * (self.populations[self.assignment[tract]] - self.populations[to] - population)
+
+    def best_move(self):
+        """Return (gain, tract, to) for the best move that keeps its district whole, or None."""
+        best = None
+        for (source, to), bucket in sorted(self.buckets.items()):
+            if not bucket:
+                continue
+            target = (self.populations[source] - self.populations[to]) / 2
+            middle = bisect.bisect_left(bucket, (target, -1))
+            low, high = middle - 1, middle
+            tried = 0
+            while tried < CANDIDATES and (low >= 0 or high < len(bucket)):  # Outward from the best population.
+                if high >= len(bucket) or (low >= 0 and target - bucket[low][0] <= bucket[high][0] - target):
+                    population, tract = bucket[low]
+                    low -= 1
+                else:
+                    population, tract = bucket[high]
+                    high += 1
+                tried += 1
+                gain = self.gain(tract, to)
+                if best is not None and gain <= best[0]:
+                    continue
+                if self.stays_connected(tract):
+                    best = (gain, tract, to)
+                    break
+        return best
+
+    def move(self, tract, to, track=True):
+        """Move tract into district to, updating populations, neighbor counts and, with track, the buckets."""
+        source = self.assignment[tract]
+        if track:
+            for district in list(self.counts[tract]):
+                if self._movable(tract, district):
+                    self._bucket_remove(tract, district)
+        self.assignment[tract] = to
+        self.populations[source] -= self.tract_pop[tract]
+        self.populations[to] += self.tract_pop[tract]
+        self.sizes[source] -= 1
+        self.sizes[to] += 1
+        self.versions[source] += 1
+        self.versions[to] += 1
+        for neighbor in self.adjacency[tract]:
+            counts = self.counts[neighbor]
+            was = {district: self._movable(neighbor, district) for district in (source, to)} if track else None
+            counts[source] -= 1
+            if not counts[source]:
+                del counts[source]
+            counts[to] = counts.get(to, 0) + 1
+            if track:
+                for district in (source, to):
+                    now = self._movable(neighbor, district)
+                    if was[district] and not now:
+                        self._bucket_remove(neighbor, district)
+                    elif now and not was[district]:
+                        self._bucket_add(neighbor, district)
+
+    def refine_pass(self):
+        """Make one pass of moves, keep the best prefix and return how many moves were kept."""
+        self.locked = set()
+        self._fill_buckets()
+        best_score = self.score()
+        moves = []
+        kept = 0
+        while len(moves) - kept < self.patience:
+            move = self.best_move()
+            if move is None:
+                break
+            gain, tract, to = move
+            moves.append((tract, self.assignment[tract]))
+            self.move(tract, to)
+            self.locked.add(tract)
+            score = self.score()
+            if score < best_score:
+                best_score = score
+                kept = len(moves)
+        for tract, source in reversed(moves[kept:]):  # Undo the moves past the best point.
+            self.move(tract, source, track=False)
+        return kept
+
+    def refine(self, max_passes=MAX_PASSES):
+        """Run passes until one keeps no moves and return the Refinement."""
+        before = self.deviation()
+        moves = passes = 0
+        while passes < max_passes:
+            passes += 1
+            kept = self.refine_pass()
+            moves += kept
+            if not kept:
+                break
+        return Refinement(list(self.assignment), self.deviation(), before, moves, passes)
+
+
+def refine_plan(tract_graph, assignment, num_dst, max_passes=MAX_PASSES):
+    """Refine an assignment, one district number per tract in gid order, and return the Refinement."""
+    return Refiner(tract_graph, assignment, num_dst).refine(max_passes)
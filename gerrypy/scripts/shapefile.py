@@ -0,0 +1,184 @@
+"""
+Read ESRI shapefiles one record at a time.
+
+Only what GerryPy needs is supported: polygon shapes (plain, Z and M, whose
+extra dimensions are skipped) and the common dBase field types.  Every
+reader is a generator that holds a single record in memory, so files of
+any size are read in constant memory.
+"""
+
+import os
+import struct
+
+
+NULL_SHAPE = 0
+POLYGON_TYPES = (5, 15, 25)  # Polygon, PolygonZ, PolygonM
+
+FILE_HEADER = struct.Struct('>i20xi')  # file code, file length in 16-bit words
+SHAPE_TYPE = struct.Struct('<i')
+VERSION_AND_TYPE = struct.Struct('<ii')
+RECORD_HEADER = struct.Struct('>ii')  # record number, content length in 16-bit words
+POLYGON_HEADER = struct.Struct('<i4dii')  # shape type, bbox, number of parts, number of points
+DBF_HEADER = struct.Struct('<B3BIHH20x')  # version, date, records, header length, record length
+DBF_FIELD = struct.Struct('<11sc4xBB14x')  # name, type, length, decimal count
+
+
+def shapefile_paths(base):
+    """Return the .shp, .shx and .dbf paths for a shapefile base name."""
+    base = os.path.splitext(base)[0] if base.endswith('.shp') else base
+    return base + '.shp', base + '.shx', base + '.dbf'
+
+
+def count_records(shx_file):
+    """Return the number of records listed in a .shx index."""
+    file_code, length = FILE_HEADER.unpack(shx_file.read(FILE_HEADER.size))
+    return (length * 2 - 100) // 8
+
+
+def read_polygon(content):
+    """Parse polygon record content into a list of rings of (x, y) tuples."""
+    shape_type, xmin, ymin, xmax, ymax, num_parts, num_points = POLYGON_HEADER.unpack_from(content)
+    position = POLYGON_HEADER.size
+    parts = struct.unpack_from('<{}i'.format(num_parts), content, position)
+    position += 4 * num_parts
+    coords = struct.unpack_from('<{}d'.format(2 * num_points), content, position)
+    points = list(zip(coords[0::2], coords[1::2]))
+    bounds = list(parts[1:]) + [num_points]
+    return [points[start:end] for start, end in zip(parts, bounds)]
+
+
+def read_shp(shp_file):
+    """Yield (record number, rings) for every record of a .shp file.
+
+    Null shapes yield an empty list of rings.
+    """
+    file_code, length = FILE_HEADER.unpack(shp_file.read(FILE_HEADER.size))
+    version, shape_type = VERSION_AND_TYPE.unpack(shp_file.read(VERSION_AND_TYPE.size))
+    if shape_type not in POLYGON_TYPES:
+        raise ValueError('Shape type {} is not a polygon type.'.format(shape_type))
+    shp_file.seek(100)
+    while True:
+        header = shp_file.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        number, content_length = RECORD_HEADER.unpack(header)
+        content = shp_file.read(content_length * 2)
+        record_type, = SHAPE_TYPE.unpack_from(content)
+        if record_type == NULL_SHAPE:
+            yield number, []
+        else:
+            yield number, read_polygon(content)
+
+
+def _parse_value(field_type, decimals, raw):
+    """Convert a raw dBase value to a Python value."""
+    text = raw.decode('latin-1').strip()
+    if field_type in 'NF':
+        if not text or text.startswith('*'):
+            return None
+        return int(text) if decimals == 0 and '.' not in text else float(text)
+    if field_type == 'L':
+        return None if text in ('', '?') else text in 'YyTt'
+    return text
+
+
+def read_dbf(dbf_file):
+    """Yield a dict of field values for every record of a .dbf file.
+
+    Deleted records yield None so records stay aligned with the .shp file.
+    """
+    version, year, month, day, num_records, header_length, record_length = DBF_HEADER.unpack(
+        dbf_file.read(DBF_HEADER.size)
+    )
+    fields = []
+    while dbf_file.tell() < header_length - 1:
+        raw = dbf_file.read(DBF_FIELD.size)
+        if raw[0:1] == b'\r':
+            break
+        name, field_type, length, decimals = DBF_FIELD.unpack(raw)
+        fields.append((name.split(b'\0')[0].decode('ascii'), field_type.decode('ascii'), length, decimals))
+    dbf_file.seek(header_length)
+    for _ in range(num_records):
+        record = dbf_file.read(record_length)
+        if record[0:1] == b'*':
+            yield None
+            continue
+        values = {}
+        position = 1  # Skip the deletion flag.
+        for name, field_type, length, decimals in fields:
+            values[name] = _parse_value(field_type, decimals, record[position:position + length])
+            position += length
+        yield values
+
+
+def read_shapefile(base):
+    """Yield (record number, attributes, rings) for every live shapefile record."""
+    shp_path, shx_path, dbf_path = shapefile_paths(base)
+    with open(shx_path, 'rb') as shx_file:
+        expected = count_records(shx_file)
+    with open(shp_path, 'rb') as shp_file, open(dbf_path, 'rb') as dbf_file:
+        count = 0
+        for (number, rings), attributes in zip(read_shp(shp_file), read_dbf(dbf_file)):
+            count += 1
+            if attributes is not None:
+                yield number, attributes, rings
+    if count != expected:
+        raise ValueError('{} has {} records but its index lists {}.'.format(shp_path, count, expected))
+
+
+def signed_area(ring):
+    """Return the shoelace area of a ring; negative when it runs clockwise."""
+    total = 0.0
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+        total += x1 * y2 - x2 * y1
+    return total / 2
+
+
+def point_in_ring(point, ring):
+    """Return True if point falls inside ring (even-odd rule)."""
+    x, y = point
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+
+def rings_to_polygons(rings):
+    """Group shapefile rings into polygons of [shell, hole, ...].
+
+    Shells run clockwise and holes counter-clockwise; each hole goes to the
+    first shell that contains it.
+    """
+    polygons = []
+    holes = []
+    for ring in rings:
+        if signed_area(ring) <= 0:
+            polygons.append([ring])
+        else:
+            holes.append(ring)
+    for hole in holes:
+        for polygon in polygons:
+            if point_in_ring(hole[0], polygon[0]):
+                polygon.append(hole)
+                break
+        else:  # An orphan hole is really a shell wound the wrong way.
+            polygons.append([hole])
+    return polygons
+
+
+def multipolygon_ewkb(polygons, srid):
+    """Encode polygons as a little-endian EWKB MultiPolygon with an SRID."""
+    chunks = [struct.pack('<BIII', 1, 6 | 0x20000000, srid, len(polygons))]
+    for polygon in polygons:
+        chunks.append(struct.pack('<BII', 1, 3, len(polygon)))
+        for ring in polygon:
+            chunks.append(struct.pack('<I', len(ring)))
+            chunks.append(struct.pack('<{}d'.format(2 * len(ring)), *[c for point in ring for c in point]))
+    return b''.join(chunks)
+
+
+def linestring_ewkb(points, srid):
+    """Encode points as a little-endian EWKB LineString with an SRID."""
+    header = struct.pack('<BIII', 1, 2 | 0x20000000, srid, len(points))
+    return header + struct.pack('<{}d'.format(2 * len(points)), *[c for point in points for c in point])
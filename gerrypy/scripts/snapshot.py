@@ -0,0 +1,289 @@
+"""
+Keep a binary snapshot of the tract graph on disk.
+
+A snapshot holds the CSR adjacency and the per-tract attribute arrays of a
+TractGraph, keyed by a fingerprint of the tract and edge tables.  Snapshots
+are read back through mmap, so the arrays are memoryviews over the file
+and are shared by every thread and every forked worker that opens them.
+When the tables change, the fingerprint changes and a new snapshot is
+written the next time the graph is asked for.  Hashing the tables takes
+time in proportion to their rows, so requests use current_fingerprint,
+which hashes them again only once the last hash is FINGERPRINT_SECONDS
+old; a new snapshot is always named for a fresh hash.
+
+Each state dataset has its own snapshots.  A process keeps the graphs it
+has mapped in a least recently used dict, and drops the least recently
+used ones once they pass the gerrypy.graph_memory_bytes budget, so states
+are only held while they are being asked for.  What else is built per
+dataset and held between requests, the arcs, the tile sources and the
+plans cached in memory, is held in the same dict through hold and recall,
+so one budget bounds all of it.
+
+Worker processes open a snapshot by its path some time after a job is
+queued, so a job pins the path until it finishes and stale snapshots
+are only deleted once nothing in the process has them pinned.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import Text, cast, func, literal_column
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from gerrypy.models.datasets import COLORADO
+from gerrypy.scripts.tractgraph import TractGraph, load_tract_graph
+
+
+MAGIC = b'GPYGRAPH'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<8sIQQ40s')  # magic, format version, tracts, neighbor entries, fingerprint
+ALIGN = 8
+
+# (attribute, typecode) in file order.  Typecodes are fixed width so the
+# file reads back the same on every platform.
+LAYOUT = (
+    ('gid', 'q'),
+    ('tract_pop', 'q'),
+    ('shape_area', 'd'),
+    ('county', 'q'),
+    ('isborder', 'b'),
+    ('offsets', 'q'),
+    ('neighbors', 'q'),
+    ('perimeter', 'd'),
+    ('lengths', 'd'),
+)
+
+GRAPH_MEMORY_BYTES = 256 * 2 ** 20
+TRACT_BYTES = 896  # Roughly what the StateTemplate built from a graph adds per tract.
+FINGERPRINT_SECONDS = 30  # How long a hash of the tables is trusted before they are hashed again.
+
+Held = namedtuple('Held', 'fingerprint value size release')
+
+_held = OrderedDict()  # key -> Held, least recently used first.
+_pins = {}  # snapshot path -> how many pending jobs will open it.
+_lock = threading.Lock()
+_fingerprints = {}  # (database url, dataset name) -> (fingerprint, time.monotonic() it was taken)
+_fingerprint_lock = threading.Lock()
+
+
+def _table_digest(dbsession, columns, order_by):
+    """Return the md5 of every row's values of columns, in order_by order, or None for an empty table."""
+    row = func.concat_ws(',', *(func.coalesce(cast(column, Text), '') for column in columns))
+    return dbsession.query(func.md5(func.string_agg(row, aggregate_order_by(literal_column("';'"), order_by)))).scalar()
+
+
+def table_fingerprint(dbsession, dataset=COLORADO):
+    """Hash the columns of the dataset's tract and edge tables that the graph is built from.
+
+    The rows themselves are hashed, so any change to them, even one that
+    keeps every total the same, gives a new fingerprint.
+    """
+    Tract, Edge = dataset.tract, dataset.edge
+    tracts = _table_digest(
+        dbsession,
+        (Tract.gid, Tract.tract_pop, Tract.shape_area, Tract.county, Tract.isborder, Tract.perimeter),
+        Tract.gid,
+    )
+    edges = _table_digest(dbsession, (Edge.edgeid, Edge.tract_source, Edge.tract_target, Edge.length), Edge.edgeid)
+    summary = repr((FORMAT_VERSION, dataset.name, tracts, edges))
+    return hashlib.sha1(summary.encode('utf-8')).hexdigest()
+
+
+def fresh_fingerprint(dbsession, dataset=COLORADO):
+    """Hash the dataset's tables now, and remember the hash for current_fingerprint."""
+    fingerprint = table_fingerprint(dbsession, dataset)
+    with _fingerprint_lock:
+        _fingerprints[str(dbsession.get_bind().engine.url), dataset.name] = (fingerprint, time.monotonic())
+    return fingerprint
+
+
+def current_fingerprint(dbsession, dataset=COLORADO, seconds=FINGERPRINT_SECONDS):
+    """Return the dataset's table fingerprint, hashing the tables again only once the last hash is seconds old.
+
+    So a change to the tables is seen within seconds, not at once.
+    """
+    with _fingerprint_lock:
+        fingerprint, taken = _fingerprints.get((str(dbsession.get_bind().engine.url), dataset.name), (None, None))
+    if fingerprint is not None and time.monotonic() - taken < seconds:
+        return fingerprint
+    return fresh_fingerprint(dbsession, dataset)
+
+
+def _padding(size):
+    """Return the number of bytes needed to align size."""
+    return -size % ALIGN
+
+
+def write_snapshot(path, tract_graph, fingerprint):
+    """Write tract_graph to path, replacing any existing file atomically."""
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, len(tract_graph), len(tract_graph.neighbors),
+        fingerprint.encode('ascii')
+    )
+    handle, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as the_file:
+            the_file.write(header)
+            the_file.write(b'\0' * _padding(len(header)))
+            for attribute, typecode in LAYOUT:
+                data = array(typecode, getattr(tract_graph, attribute)).tobytes()
+                the_file.write(data)
+                the_file.write(b'\0' * _padding(len(data)))
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def read_snapshot(path):
+    """Map the snapshot at path and return (fingerprint, TractGraph).
+
+    The graph's arrays are memoryviews over the mapped file; nothing is copied.
+    """
+    with open(path, 'rb') as the_file:
+        mapped = mmap.mmap(the_file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, num_tracts, num_neighbors, fingerprint = HEADER.unpack_from(mapped)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        mapped.close()
+        raise ValueError('{} is not a version {} graph snapshot.'.format(path, FORMAT_VERSION))
+    lengths = {'offsets': num_tracts + 1, 'neighbors': num_neighbors, 'lengths': num_neighbors}
+    view = memoryview(mapped)
+    position = HEADER.size + _padding(HEADER.size)
+    arrays = {}
+    for attribute, typecode in LAYOUT:
+        size = lengths.get(attribute, num_tracts) * struct.calcsize(typecode)
+        arrays[attribute] = view[position:position + size].cast(typecode)
+        position += size + _padding(size)
+    graph = TractGraph(**arrays)
+    graph._mmap = mapped  # Keep the mapping open for as long as the graph lives.
+    graph.snapshot_path = path
+    return fingerprint.decode('ascii'), graph
+
+
+def snapshot_dir(request):
+    """Return the snapshot directory configured for this app."""
+    registry = getattr(request, 'registry', None)
+    settings = getattr(registry, 'settings', None) or {}
+    return settings.get('gerrypy.snapshot_dir') or os.path.join(tempfile.gettempdir(), 'gerrypy')
+
+
+def graph_size(tract_graph):
+    """Return roughly how many bytes a mapped graph and what is built from it take."""
+    return (
+        sum(len(getattr(tract_graph, attribute)) * struct.calcsize(typecode) for attribute, typecode in LAYOUT)
+        + TRACT_BYTES * len(tract_graph)
+    )
+
+
+def memory_budget(request):
+    """Return the bytes this process may hold graphs and what is built from them in."""
+    registry = getattr(request, 'registry', None)
+    settings = getattr(registry, 'settings', None) or {}
+    return int(settings.get('gerrypy.graph_memory_bytes', GRAPH_MEMORY_BYTES))
+
+
+def recall(key, fingerprint=None):
+    """Return what is held under key for fingerprint, marking it recently used, or None."""
+    with _lock:
+        held = _held.get(key)
+        if held is None or held.fingerprint != fingerprint:
+            return None
+        _held.move_to_end(key)
+        return held.value
+
+
+def hold(key, fingerprint, value, size, memory_bytes=GRAPH_MEMORY_BYTES, release=None):
+    """Hold value, about size bytes, under key and return it.
+
+    Whatever was held under key before is replaced, and the least recently
+    used things held are dropped until the rest fit in memory_bytes; the
+    newest is kept even if it doesn't fit on its own.  release, if given, is
+    called once value is dropped, outside the lock.  Callers still using a
+    dropped value keep it until they finish.
+    """
+    with _lock:
+        dropped = [_held.pop(key)] if key in _held else []
+        _held[key] = Held(fingerprint, value, size, release)
+        used = sum(held.size for held in _held.values())
+        while used > memory_bytes and len(_held) > 1:
+            old_key, old = _held.popitem(last=False)
+            used -= old.size
+            dropped.append(old)
+    for old in dropped:
+        if old.release is not None:
+            old.release()
+    return value
+
+
+def let_go(key):
+    """Stop holding whatever is held under key, without calling its release."""
+    with _lock:
+        _held.pop(key, None)
+
+
+def pin_snapshot(path):
+    """Keep the snapshot at path on disk until it is unpinned as many times."""
+    with _lock:
+        _pins[path] = _pins.get(path, 0) + 1
+
+
+def unpin_snapshot(path):
+    """Let the snapshot at path be deleted once it is stale, if nothing else pins it."""
+    with _lock:
+        _pins[path] -= 1
+        if not _pins[path]:
+            del _pins[path]
+
+
+def _remove_stale(directory, prefix, current):
+    """Delete unpinned snapshots starting with prefix other than current.  Open mappings stay valid."""
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith(prefix) and name.endswith('.graph') and path != current and path not in _pins:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def get_tract_graph(dbsession, directory, dataset=COLORADO, memory_bytes=GRAPH_MEMORY_BYTES):
+    """Return the dataset's current tract graph, from memory, disk or the database.
+
+    The tables' current_fingerprint is taken on every call.  A graph
+    already mapped for that fingerprint is returned as is; otherwise the
+    snapshot for it is mapped from disk.  If it is missing the tables are
+    hashed afresh, so the snapshot built from them is named for what it
+    holds.  Graphs and whatever else is held past memory_bytes are dropped,
+    least recently used first.
+    """
+    fingerprint = current_fingerprint(dbsession, dataset)
+    key = ('graph', directory, dataset.name)
+    graph = recall(key, fingerprint)
+    if graph is not None:
+        return graph
+    prefix = 'tracts-{}-'.format(dataset.name)
+    path = os.path.join(directory, '{}{}.graph'.format(prefix, fingerprint))
+    if not os.path.exists(path):
+        fingerprint = fresh_fingerprint(dbsession, dataset)
+        path = os.path.join(directory, '{}{}.graph'.format(prefix, fingerprint))
+    with _lock:
+        if not os.path.exists(path):
+            write_snapshot(path, load_tract_graph(dbsession, dataset), fingerprint)
+            _remove_stale(directory, prefix, path)
+    graph = read_snapshot(path)[1]
+    return hold(key, fingerprint, graph, graph_size(graph), memory_bytes)
+
+
+def request_tract_graph(request, dataset=COLORADO):
+    """Return the dataset's tract graph, with the snapshot directory and memory budget the app is configured with."""
+    return get_tract_graph(request.dbsession, snapshot_dir(request), dataset, memory_budget(request))
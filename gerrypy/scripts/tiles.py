@@ -0,0 +1,339 @@
+"""
+Cut tract geometry into Mapbox Vector Tiles and color them by plan.
+
+usage: gerrypy_tiles <config_uri> [minzoom=4] [maxzoom=10] [dataset=colorado]
+
+A tile's geometry depends only on the tract tables, so each tile's features
+are cut once, encoded, and kept on disk under the tables' fingerprint.
+Serving a tile for a plan only adds each feature's district to those
+stored bytes.  main() cuts every tile over the state ahead of time.
+
+Tiles follow version 2 of the vector tile spec: one layer, "tracts", with
+a feature per tract whose id is the tract's gid and whose "district" tag
+is its district in the plan.  The protocol buffer encoding is written out
+by hand, since a tile needs only a few of its wire types.
+"""
+
+import math
+import os
+import sys
+import tempfile
+
+from pyramid.paster import get_appsettings, setup_logging
+from pyramid.scripts.common import parse_vars
+
+from gerrypy.models.datasets import COLORADO
+from gerrypy.scripts.snapshot import GRAPH_MEMORY_BYTES, hold, recall
+from gerrypy.scripts.topology import STATE_EDGE, dissolve_polygons, get_topology, pixel_size, resolution
+
+
+EXTENT = 4096
+BUFFER = 64  # Tile units drawn past each edge, so strokes don't stop at tile seams.
+LAYER = 'tracts'
+MAX_LATITUDE = 85.0511287798  # Where web mercator is square.
+
+VARINT, LENGTH = 0, 2  # Protocol buffer wire types.
+MOVE_TO, LINE_TO, CLOSE_PATH = 1, 2, 7
+POLYGON = 3
+
+
+def varint(value):
+    """Encode a non-negative integer as a protocol buffer varint."""
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def zigzag(value):
+    """Map a signed integer onto the unsigned ones, small magnitudes first."""
+    return (value << 1) ^ (value >> 63)
+
+
+def field(number, wire_type, payload):
+    """Encode one field: a varint for VARINT, bytes for LENGTH."""
+    key = varint(number << 3 | wire_type)
+    if wire_type == VARINT:
+        return key + varint(payload)
+    return key + varint(len(payload)) + payload
+
+
+def packed(number, values):
+    """Encode a packed repeated uint32 field."""
+    return field(number, LENGTH, b''.join(varint(value) for value in values))
+
+
+def mercator(lon, lat):
+    """Project a longitude and latitude onto the unit web mercator square."""
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    sin = math.sin(math.radians(lat))
+    return (lon + 180.0) / 360.0, 0.5 - math.log((1 + sin) / (1 - sin)) / (4 * math.pi)
+
+
+def tile_bounds(z, x, y):
+    """Return the tile's (west, south, east, north) in degrees."""
+    n = 2.0 ** z
+
+    def latitude(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+    return x / n * 360.0 - 180.0, latitude(y + 1), (x + 1) / n * 360.0 - 180.0, latitude(y)
+
+
+def clip_ring(ring, low, high):
+    """Clip a closed ring to the square [low, high] on both axes (Sutherland-Hodgman)."""
+    points = ring[:-1]
+    for axis, bound, keep_below in ((0, low, False), (0, high, True), (1, low, False), (1, high, True)):
+        if not points:
+            break
+        clipped = []
+        previous = points[-1]
+        for point in points:
+            inside = point[axis] <= bound if keep_below else point[axis] >= bound
+            was_inside = previous[axis] <= bound if keep_below else previous[axis] >= bound
+            if inside != was_inside:
+                t = (bound - previous[axis]) / (point[axis] - previous[axis])
+                crossing = [previous[0] + t * (point[0] - previous[0]), previous[1] + t * (point[1] - previous[1])]
+                crossing[axis] = bound
+                clipped.append(tuple(crossing))
+            if inside:
+                clipped.append(point)
+            previous = point
+        points = clipped
+    return points
+
+
+def ring_area(points):
+    """Return the shoelace area of an open ring."""
+    total = 0
+    for idx, (x1, y1) in enumerate(points):
+        x2, y2 = points[idx - 1]
+        total += x2 * y1 - x1 * y2
+    return total
+
+
+def polygon_geometry(polygons, z, x, y):
+    """Encode a tract's polygons as tile geometry commands, or return None if none of it shows.
+
+    Shells run clockwise in degrees, so with y pointing down they have the
+    positive area the spec asks of exterior rings.
+    """
+    scale = 2 ** z * EXTENT
+    commands = []
+    cursor_x = cursor_y = 0
+    for polygon in polygons:
+        for position, ring in enumerate(polygon):
+            projected = []
+            for lon, lat in ring:
+                mx, my = mercator(lon, lat)
+                projected.append((mx * scale - x * EXTENT, my * scale - y * EXTENT))
+            points = []
+            for px, py in clip_ring(projected, -BUFFER, EXTENT + BUFFER):
+                point = (int(round(px)), int(round(py)))
+                if not points or points[-1] != point:
+                    points.append(point)
+            if len(points) > 1 and points[0] == points[-1]:
+                points.pop()
+            if len(points) < 3 or not ring_area(points):
+                if position == 0:
+                    break  # No shell, so no holes either.
+                continue
+            commands.append(MOVE_TO | 1 << 3)
+            for idx, (px, py) in enumerate(points):
+                if idx == 1:
+                    commands.append(LINE_TO | (len(points) - 1) << 3)
+                commands.append(zigzag(px - cursor_x))
+                commands.append(zigzag(py - cursor_y))
+                cursor_x, cursor_y = px, py
+            commands.append(CLOSE_PATH | 1 << 3)
+    return b''.join(varint(command) for command in commands) if commands else None
+
+
+class TileSource(object):
+    """Tract polygons at one level of simplification, with their bounding boxes."""
+
+    def __init__(self, topology):
+        """Initialize the TileSource Object."""
+        self.size = topology.size()  # Its rings hold the arcs' points, and keep them once the arcs are dropped.
+        gids = (set(topology.tract) | set(topology.other)) - {STATE_EDGE}
+        self.polygons = dissolve_polygons(topology, {gid: gid for gid in gids})
+        self.bounds = {}
+        for gid, polygons in self.polygons.items():
+            xs = [lon for polygon in polygons for lon, lat in polygon[0]]
+            ys = [lat for polygon in polygons for lon, lat in polygon[0]]
+            if xs:
+                self.bounds[gid] = (min(xs), min(ys), max(xs), max(ys))
+
+    def features(self, z, x, y):
+        """Return (gid, geometry) for every tract that shows in the tile, in gid order."""
+        west, south, east, north = tile_bounds(z, x, y)
+        pad_x = (east - west) * BUFFER / EXTENT
+        pad_y = (north - south) * BUFFER / EXTENT
+        features = []
+        for gid in sorted(self.bounds):
+            min_x, min_y, max_x, max_y = self.bounds[gid]
+            if max_x < west - pad_x or min_x > east + pad_x or max_y < south - pad_y or min_y > north + pad_y:
+                continue
+            geometry = polygon_geometry(self.polygons[gid], z, x, y)
+            if geometry is not None:
+                features.append((gid, geometry))
+        return features
+
+
+def write_features(path, features):
+    """Write a tile's (gid, geometry) pairs to path, replacing any existing file atomically."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)  # Other threads may be cutting tiles of the same column.
+    handle, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as the_file:
+            for gid, geometry in features:
+                the_file.write(varint(gid) + varint(len(geometry)) + geometry)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def _read_varint(data, position):
+    """Decode the varint at position and return (value, next position)."""
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def read_features(path):
+    """Read a tile's (gid, geometry) pairs."""
+    with open(path, 'rb') as the_file:
+        data = the_file.read()
+    features = []
+    position = 0
+    while position < len(data):
+        gid, position = _read_varint(data, position)
+        length, position = _read_varint(data, position)
+        features.append((gid, data[position:position + length]))
+        position += length
+    return features
+
+
+def encode_tile(features, district_of):
+    """Encode a tile of (gid, geometry) features with each tract's district as a tag."""
+    values = sorted(set(district_of.get(gid) for gid, geometry in features) - {None})
+    value_index = {district: idx for idx, district in enumerate(values)}
+    layer = [field(15, VARINT, 2), field(1, LENGTH, LAYER.encode('utf-8'))]
+    for gid, geometry in features:
+        feature = field(1, VARINT, gid)
+        district = district_of.get(gid)
+        if district is not None:
+            feature += packed(2, (0, value_index[district]))
+        feature += field(3, VARINT, POLYGON) + field(4, LENGTH, geometry)
+        layer.append(field(2, LENGTH, feature))
+    layer.append(field(3, LENGTH, b'district'))
+    for district in values:
+        layer.append(field(4, LENGTH, field(5, VARINT, district)))  # uint_value
+    layer.append(field(5, VARINT, EXTENT))
+    return field(3, LENGTH, b''.join(layer)) if features else b''
+
+
+def tile_dir(request):
+    """Return the tile cache directory configured for this app."""
+    registry = getattr(request, 'registry', None)
+    settings = getattr(registry, 'settings', None) or {}
+    return settings_tile_dir(settings)
+
+
+def settings_tile_dir(settings):
+    """Return the tile cache directory named in settings, or the default one."""
+    return settings.get('gerrypy.tile_dir') or os.path.join(tempfile.gettempdir(), 'gerrypy', 'tiles')
+
+
+def get_tile_source(dbsession, fingerprint, level, dataset=COLORADO, memory_bytes=GRAPH_MEMORY_BYTES):
+    """Return the TileSource for the dataset's tables with this fingerprint, built once while held.
+
+    Sources are held with the tract graphs, under the same memory_bytes budget.
+    """
+    key = ('tiles', dataset.name, level)
+    source = recall(key, fingerprint)
+    if source is not None:
+        return source
+    topology = get_topology(dbsession, fingerprint, level, dataset, memory_bytes)
+    if topology is None:
+        return None
+    source = TileSource(topology)
+    return hold(key, fingerprint, source, source.size, memory_bytes)
+
+
+def tile_features(dbsession, fingerprint, directory, z, x, y, dataset=COLORADO, memory_bytes=GRAPH_MEMORY_BYTES):
+    """Return the tile's (gid, geometry) pairs, cutting and saving them the first time.
+
+    fingerprint is the dataset's, so each state's tiles are kept apart.
+    """
+    path = os.path.join(directory, fingerprint, str(z), str(x), '{}.bin'.format(y))
+    try:
+        return read_features(path)
+    except OSError:
+        pass
+    source = get_tile_source(dbsession, fingerprint, resolution(pixel_size(z))[0], dataset, memory_bytes)
+    if source is None:
+        return []
+    features = source.features(z, x, y)
+    write_features(path, features)
+    return features
+
+
+def tile_range(bounds, z):
+    """Return the (x, y) of every tile at zoom z over (west, south, east, north)."""
+    west, south, east, north = bounds
+    n = 2 ** z
+    left, top = mercator(west, north)
+    right, bottom = mercator(east, south)
+    return [
+        (x, y) for x in range(int(left * n), min(n - 1, int(right * n)) + 1)
+        for y in range(int(top * n), min(n - 1, int(bottom * n)) + 1)
+    ]
+
+
+def precut(dbsession, directory, minzoom, maxzoom, dataset=COLORADO):
+    """Cut and save every tile over the state from minzoom to maxzoom; return how many."""
+    from gerrypy.scripts.snapshot import table_fingerprint
+    fingerprint = table_fingerprint(dbsession, dataset)
+    source = get_tile_source(dbsession, fingerprint, 0, dataset)
+    if source is None:
+        return 0
+    bounds = [box for box in source.bounds.values()]
+    state = (min(box[0] for box in bounds), min(box[1] for box in bounds),
+             max(box[2] for box in bounds), max(box[3] for box in bounds))
+    count = 0
+    for z in range(minzoom, maxzoom + 1):
+        for x, y in tile_range(state, z):
+            tile_features(dbsession, fingerprint, directory, z, x, y, dataset)
+            count += 1
+    return count
+
+
+def main(argv=sys.argv):  # pragma: no cover
+    if len(argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    import transaction
+    from gerrypy.models import get_tm_session
+    from gerrypy.models.datasets import parse_datasets
+    from gerrypy.scripts.benchmarks import session_factory
+    options = parse_vars(argv[2:])
+    setup_logging(argv[1])
+    settings = get_appsettings(argv[1], options=options)
+    directory = settings_tile_dir(settings)
+    dataset = parse_datasets(settings.get('gerrypy.datasets')).get(options.get('dataset', COLORADO.name))
+    if dataset is None:
+        print('No dataset named {!r} in gerrypy.datasets.'.format(options['dataset']))
+        sys.exit(1)
+    with transaction.manager:
+        dbsession = get_tm_session(session_factory(argv[1], options), transaction.manager)
+        count = precut(dbsession, directory, int(options.get('minzoom', 4)), int(options.get('maxzoom', 10)), dataset)
+    print('{} tiles cut into {}'.format(count, directory))
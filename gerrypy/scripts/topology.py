@@ -0,0 +1,675 @@
+"""
+Split tract boundaries into shared arcs and dissolve districts from them.
+
+At ingest every tract ring is cut into arcs: runs of boundary with the same
+tract on the far side.  Each arc is stored once, in the direction of the
+ring of the tract it was taken from, with the tract across it (0 on the
+state's edge).  A district's outline is then every arc with the district on
+exactly one side.  Those arcs, turned to run the way the district's own
+tracts' rings do, join end to end into closed rings, so a plan is dissolved
+in one pass over the arcs instead of a polygon union per district.
+build_topology cuts the arcs in memory; StreamedTopology cuts the same
+arcs from segments spilled to disk, for states too big for that.  Both
+first split boundary that two tracts share without identical segments,
+where build_adjacency's overlap pass finds it, so the arcs pair the same
+tracts the edge table does.
+
+Each arc is also simplified at a few tolerances at ingest.  Both sides of a
+boundary are drawn from the same simplified arc, so districts stay flush
+against each other at every level, with no gaps or slivers between them.
+Simplifying arcs one at a time can still make one cross another, or make
+the two arcs around a tract between two nodes both fold down to the same
+chord, so every level is checked: an arc whose segments cross, touch or
+overlap its own or another arc's is simplified again at half the
+tolerance, and after MAX_HALVINGS halvings is kept whole.
+Coordinates are rounded to the precision the zoom can show, and since both
+sides round the same points the same way that keeps them flush too.
+"""
+
+import json
+import math
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+from collections import defaultdict, namedtuple
+
+from sqlalchemy import func
+
+from gerrypy.models.datasets import COLORADO
+from gerrypy.models.mymodel import plan_districts, plan_totals
+from gerrypy.scripts.adjacency import (
+    DEFAULT_BUCKETS, DEFAULT_TOLERANCE, BucketFiles, overlap_splits, read_records, segment_key
+)
+from gerrypy.scripts.assigndistrict import plan_assignments
+from gerrypy.scripts.shapefile import linestring_ewkb, rings_to_polygons
+from gerrypy.scripts.snapshot import GRAPH_MEMORY_BYTES, current_fingerprint, hold, recall
+
+
+STATE_EDGE = 0
+TOLERANCES = (0.0001, 0.0005, 0.002, 0.008)  # Degrees; level n is simplified to TOLERANCES[n - 1], level 0 not at all.
+TILE_PIXELS = 256
+VIEWPORT_PIXELS = 1024  # How wide a bounding box is assumed to be drawn.
+MAX_ZOOM = 24
+RING_CHUNK = 4096  # Rings whose far sides StreamedTopology reads back at once.
+RING_SEGMENT = struct.Struct('<qqq4d')  # ring number, position in the ring, gid, segment key
+RING_SIDE = struct.Struct('<qqq')  # ring number, position in the ring, far side
+RING_POINTS = 4  # Fewest points in a closed ring, the first repeated last.
+MAX_HALVINGS = 4  # Times an arc's tolerance is halved to clear its neighbors before it is kept whole.
+TILE_DEGREES = 0.25  # Cells StreamedTopology files arcs under to check neighbors against each other.
+POINT_BYTES = 128  # Roughly what a point of a read arc takes: a tuple of two floats and its slot.
+
+District = namedtuple('District', 'districtid area population geojson')
+TractShape = namedtuple('TractShape', 'gid area population geojson')
+
+
+class Topology(object):
+    """Tract boundaries as arcs.
+
+    Arc i runs through points[i] along a ring of tract[i], with other[i]
+    on its far side, or STATE_EDGE.  An arc whose first and last points
+    are the same is a whole ring.
+    """
+
+    def __init__(self, tract, other, points):
+        """Initialize the Topology Object."""
+        self.tract = tract
+        self.other = other
+        self.points = points
+
+    def __len__(self):
+        """Return the number of arcs."""
+        return len(self.points)
+
+    def size(self):
+        """Return roughly how many bytes the arcs take."""
+        return POINT_BYTES * sum(len(points) for points in self.points)
+
+    def arc_rows(self, srid):
+        """Yield (arcid, tract_gid, other_gid, geom) rows for the arc table."""
+        for arcid, (tract, other, points) in enumerate(zip(self.tract, self.other, self.points), 1):
+            yield arcid, tract, other, linestring_ewkb(points, srid)
+
+    def _groups(self):
+        """Return every arc, by arcid, as the one group settle_arcs checks."""
+        return [dict(enumerate(self.points, 1))]
+
+    def level_rows(self, srid, tolerances=TOLERANCES):
+        """Yield (arcid, level, geom) rows for the arc_level table."""
+        for level, tolerance in enumerate(tolerances, 1):
+            halvings = settle_arcs(self._groups, tolerance)
+            for arcid, points in enumerate(self.points, 1):
+                yield arcid, level, linestring_ewkb(halved(points, tolerance, halvings.get(arcid, 0)), srid)
+
+    def simplified(self, tolerance):
+        """Return a Topology with every arc simplified to tolerance, as level_rows does it."""
+        halvings = settle_arcs(self._groups, tolerance)
+        return Topology(self.tract, self.other, [
+            halved(points, tolerance, halvings.get(arcid, 0)) for arcid, points in enumerate(self.points, 1)
+        ])
+
+
+def _distance(point, start, end):
+    """Return the distance from point to the segment from start to end."""
+    (x, y), (x1, y1), (x2, y2) = point, start, end
+    dx, dy = x2 - x1, y2 - y1
+    length = dx * dx + dy * dy
+    if length:
+        t = max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / length))
+        x1, y1 = x1 + t * dx, y1 + t * dy
+    return math.hypot(x - x1, y - y1)
+
+
+def simplify_points(points, tolerance):
+    """Simplify a line with Douglas-Peucker, keeping its end points.
+
+    A closed arc keeps its farthest point from the start as well, so it
+    stays a ring of at least four points.
+    """
+    last = len(points) - 1
+    if last < 2:
+        return list(points)
+    keep = [False] * len(points)
+    keep[0] = keep[last] = True
+    stack = [(0, last)]
+    if points[0] == points[last]:
+        far = max(range(1, last), key=lambda idx: math.hypot(points[idx][0] - points[0][0], points[idx][1] - points[0][1]))
+        keep[far] = True
+        stack = [(0, far), (far, last)]
+    while stack:
+        first, final = stack.pop()
+        best, best_distance = None, tolerance
+        for idx in range(first + 1, final):
+            distance = _distance(points[idx], points[first], points[final])
+            if distance > best_distance:
+                best, best_distance = idx, distance
+        if best is not None:
+            keep[best] = True
+            stack.append((first, best))
+            stack.append((best, final))
+    simple = [point for point, kept in zip(points, keep) if kept]
+    if simple[0] == simple[-1] and len(simple) < RING_POINTS:  # Too small to simplify into a ring.
+        return list(points)
+    return simple
+
+
+def halved(points, tolerance, halvings):
+    """Simplify points to tolerance halved halvings times, or not at all past MAX_HALVINGS."""
+    if halvings > MAX_HALVINGS:
+        return list(points)
+    return simplify_points(points, tolerance / 2 ** halvings)
+
+
+def _turn(start, end, point):
+    """Return twice the signed area of the triangle start, end, point: positive turning left."""
+    return (end[0] - start[0]) * (point[1] - start[1]) - (end[1] - start[1]) * (point[0] - start[0])
+
+
+def _within(start, end, point):
+    """Check whether point, on the line through start and end, lies between them."""
+    return (
+        min(start[0], end[0]) <= point[0] <= max(start[0], end[0]) and
+        min(start[1], end[1]) <= point[1] <= max(start[1], end[1])
+    )
+
+
+def segments_conflict(first, second):
+    """Check whether two segments meet anywhere but at an end they share, or lie along each other."""
+    (a, b), (c, d) = first, second
+    shared = {a, b} & {c, d}
+    if len(shared) == 2:
+        return True
+    if shared:
+        point = shared.pop()
+        mine, theirs = b if a == point else a, d if c == point else c
+        same_way = (mine[0] - point[0]) * (theirs[0] - point[0]) + (mine[1] - point[1]) * (theirs[1] - point[1]) > 0
+        return _turn(point, mine, theirs) == 0 and same_way
+    turns = _turn(c, d, a), _turn(c, d, b), _turn(a, b, c), _turn(a, b, d)
+    if turns[0] * turns[1] < 0 and turns[2] * turns[3] < 0:
+        return True
+    return (
+        (turns[0] == 0 and _within(c, d, a)) or (turns[1] == 0 and _within(c, d, b)) or
+        (turns[2] == 0 and _within(a, b, c)) or (turns[3] == 0 and _within(a, b, d))
+    )
+
+
+def arc_conflicts(arcs, among=None):
+    """Return the arcids in arcs, a dict of arcid to points, with a segment in conflict with another.
+
+    Segments are filed in a grid of about one per cell, so only segments
+    sharing a cell, with bounding boxes that meet, are compared.  With
+    among, a set of arcids, only conflicts involving those arcs are found.
+    """
+    segments = []
+    for arcid, points in arcs.items():
+        for (x1, y1), (x2, y2) in zip(points, points[1:]):
+            segments.append((arcid, ((x1, y1), (x2, y2)), min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)))
+    if not segments:
+        return set()
+    west, south = min(segment[2] for segment in segments), min(segment[3] for segment in segments)
+    span = max(max(segment[4] for segment in segments) - west, max(segment[5] for segment in segments) - south)
+    cell = span / int(math.sqrt(len(segments))) or 1.0
+    grid = defaultdict(list)
+    for idx, (arcid, segment, left, bottom, right, top) in enumerate(segments):
+        for column in range(int((left - west) / cell), int((right - west) / cell) + 1):
+            for row in range(int((bottom - south) / cell), int((top - south) / cell) + 1):
+                grid[column, row].append(idx)
+    conflicts = set()
+    compared = set()
+    for members in grid.values():
+        for position, first in enumerate(members):
+            arcid, segment, left, bottom, right, top = segments[first]
+            for second in members[position + 1:]:
+                other = segments[second]
+                if left > other[4] or other[2] > right or bottom > other[5] or other[3] > top:
+                    continue
+                if among is not None and arcid not in among and other[0] not in among:
+                    continue
+                if (first, second) in compared:
+                    continue
+                compared.add((first, second))  # Long segments share more than one cell.
+                if segments_conflict(segment, other[1]):
+                    conflicts.update((arcid, other[0]))
+    return conflicts
+
+
+def settle_arcs(groups, tolerance):
+    """Return {arcid: halvings} for the arcs that must be simplified finer than tolerance.
+
+    groups() yields dicts of arcid to points, and any two arcs whose
+    bounding boxes meet must share one.  A simplified arc can only meet what
+    its original's bounding box holds, so arcs are only compared within a
+    group.  Each round halves the tolerance of every arc in conflict that
+    dropped points, until no such arc is left; then the other groups holding
+    an arc that changed are checked again, and so on.  groups() must yield
+    the same groups in the same order every time.
+    """
+    halvings = {}
+    changed, changed_in = None, {}
+    while True:
+        settled = {}  # group number -> arcs simplified again in it
+        for number, arcs in enumerate(groups()):
+            among = None if changed is None else (changed - changed_in.get(number, set())).intersection(arcs)
+            if among is not None and not among:
+                continue  # Arcs that haven't changed since this group was last settled still don't meet.
+            simple = {arcid: halved(points, tolerance, halvings.get(arcid, 0)) for arcid, points in arcs.items()}
+            while True:
+                conflicts = set(arcid for arcid in arc_conflicts(simple, among) if len(simple[arcid]) < len(arcs[arcid]))
+                if not conflicts:
+                    break
+                for arcid in conflicts:
+                    halvings[arcid] = halvings.get(arcid, 0) + 1
+                    simple[arcid] = halved(arcs[arcid], tolerance, halvings[arcid])
+                settled.setdefault(number, set()).update(conflicts)
+                among = conflicts
+        if not settled:
+            return halvings
+        changed, changed_in = set().union(*settled.values()), settled
+
+
+def ring_segments(ring):
+    """Return the ring's non-degenerate segments."""
+    return [(start, end) for start, end in zip(ring, ring[1:]) if start != end]
+
+
+def unmatched_segments(owners):
+    """Return (gid, start, end) for every segment not shared by exactly two tracts, as build_adjacency leaves them."""
+    return [
+        (gid, key[0], key[1]) for key, gids in owners.items()
+        if not (len(gids) == 2 and gids[0] != gids[1]) for gid in gids
+    ]
+
+
+def split_ring(gid, ring, splits):
+    """Return gid's ring with the points overlap_splits found for its segments put in."""
+    if not splits:
+        return ring
+    points = [ring[0]]
+    for start, end in zip(ring, ring[1:]):
+        inside = splits.get((gid, segment_key(start, end)))
+        if inside:
+            points.extend(sorted(inside, key=lambda point: math.hypot(point[0] - start[0], point[1] - start[1])))
+        points.append(end)
+    return points
+
+
+def segment_owners(rings):
+    """Return {segment key: gids of the rings that have it} for (gid, ring) pairs."""
+    owners = {}
+    for gid, ring in rings:
+        for start, end in ring_segments(ring):
+            owners.setdefault(segment_key(start, end), []).append(gid)
+    return owners
+
+
+def far_side(gid, gids):
+    """Return the tract across a segment of gid's ring, given every tract whose ring has the segment."""
+    if len(gids) == 2:
+        return gids[1] if gids[0] == gid else gids[0]
+    return STATE_EDGE if len(gids) == 1 else gid  # Boundary shared three ways is never drawn.
+
+
+def ring_sides(gid, ring, owners):
+    """Return the ring's segments and the tract across each one."""
+    segments = ring_segments(ring)
+    return segments, [far_side(gid, owners[segment_key(start, end)]) for start, end in segments]
+
+
+def ring_arcs(gid, segments, sides):
+    """Yield (gid, other, points) for each arc gid's ring is cut into and keeps.
+
+    Each shared arc is kept from the lower gid's ring.
+    """
+    if not segments:
+        return
+    turn = next((idx for idx in range(len(sides)) if sides[idx] != sides[idx - 1]), 0)
+    segments = segments[turn:] + segments[:turn]  # Start where the far side changes, so no arc wraps around.
+    sides = sides[turn:] + sides[:turn]
+    first = 0
+    for idx in range(1, len(sides) + 1):
+        if idx < len(sides) and sides[idx] == sides[first]:
+            continue
+        side = sides[first]
+        if side == STATE_EDGE or side > gid:
+            yield gid, side, [segments[first][0]] + [end for start, end in segments[first:idx]]
+        first = idx
+
+
+def build_topology(tracts, tolerance=DEFAULT_TOLERANCE):
+    """Cut every tract ring into arcs and return the Topology.
+
+    tracts is an iterable of (gid, rings), as build_adjacency takes.  Shared
+    boundary is matched by identical segments, which is how the Census
+    files are drawn, once the collinear overlaps build_adjacency finds
+    within tolerance are split into identical segments.  Every ring and
+    segment is held in memory at once; StreamedTopology cuts the same arcs
+    in bounded memory.
+    """
+    rings = [(gid, ring) for gid, tract_rings in tracts for ring in tract_rings]
+    owners = segment_owners(rings)
+    splits = overlap_splits(unmatched_segments(owners), tolerance)
+    if splits:
+        rings = [(gid, split_ring(gid, ring, splits)) for gid, ring in rings]
+        owners = segment_owners(rings)
+    arcs = [arc for gid, ring in rings for arc in ring_arcs(gid, *ring_sides(gid, ring, owners))]
+    return Topology(*(list(column) for column in zip(*arcs))) if arcs else Topology([], [], [])
+
+
+class StreamedTopology(object):
+    """The arcs build_topology cuts, found without holding every ring at once.
+
+    read_tracts() returns the (gid, rings) iterable, and is called once to
+    find the far side of every segment and again on every pass over the
+    arcs.  Segments are spilled to temporary bucket files by a hash of their
+    endpoints, as build_adjacency does, so the tracts sharing a segment are
+    found one bucket at a time; the far sides are then spilled again in
+    ring order, ring_chunk rings to a file, to be read back alongside the
+    rings.  Iterating yields (tract, other, points) for each arc, and
+    arc_rows and level_rows stream the arc tables' rows as Topology's do.
+    To check simplified arcs against their neighbors, level_rows spills each
+    arc under every TILE_DEGREES cell its bounding box meets, to a file per
+    bucket of cells, and settles one file at a time.  Used as a context
+    manager, the files are deleted on the way out.
+
+    The segments no other tract shares exactly are kept in memory, as
+    build_adjacency keeps them, to find collinear overlaps; if there are
+    any, the segments are spilled again with the overlaps split.
+    """
+
+    def __init__(self, read_tracts, buckets=DEFAULT_BUCKETS, directory=None, ring_chunk=RING_CHUNK,
+                 tolerance=DEFAULT_TOLERANCE):
+        """Initialize the StreamedTopology Object."""
+        self.read_tracts = read_tracts
+        self.buckets = buckets
+        self.ring_chunk = ring_chunk
+        self.directory = tempfile.mkdtemp(prefix='gerrypy-', dir=directory)
+        self.chunks = 0
+        self.splits = {}
+        self.splits = overlap_splits(self._spill_sides(), tolerance)
+        if self.splits:
+            self._spill_sides()
+
+    def _spill_sides(self):
+        """Write the far side of every segment to the chunk files, and return the unmatched segments."""
+        buckets, ring_chunk = self.buckets, self.ring_chunk
+        unmatched = []
+        with BucketFiles(RING_SEGMENT, buckets, self.directory) as segment_files:
+            for number, (gid, ring) in enumerate(self._rings()):
+                for position, (start, end) in enumerate(ring_segments(ring)):
+                    key = segment_key(start, end)
+                    segment_files.add(
+                        hash(key) % buckets, number, position, gid, key[0][0], key[0][1], key[1][0], key[1][1]
+                    )
+                self.chunks = number // ring_chunk + 1
+            segment_files.close()
+            side_files = [open(self._chunk_path(chunk), 'wb') for chunk in range(self.chunks)]
+            try:
+                for path in segment_files.paths:
+                    records = read_records(path, RING_SEGMENT.format)
+                    owners = defaultdict(list)
+                    for number, position, gid, x1, y1, x2, y2 in records:
+                        owners[(x1, y1), (x2, y2)].append(gid)
+                    for number, position, gid, x1, y1, x2, y2 in records:
+                        side = far_side(gid, owners[(x1, y1), (x2, y2)])
+                        side_files[number // ring_chunk].write(RING_SIDE.pack(number, position, side))
+                    unmatched.extend(unmatched_segments(owners))
+            finally:
+                for the_file in side_files:
+                    the_file.close()
+        return unmatched
+
+    def _rings(self):
+        """Yield (gid, ring) for every ring, in the same order on every call."""
+        for gid, tract_rings in self.read_tracts():
+            for ring in tract_rings:
+                yield gid, split_ring(gid, ring, self.splits)
+
+    def _chunk_path(self, chunk):
+        """Return the file holding the far sides of a chunk's rings."""
+        return os.path.join(self.directory, 'sides-{}.bin'.format(chunk))
+
+    def _sides(self, chunk):
+        """Return {ring number: far sides in segment order} for a chunk."""
+        sides = defaultdict(list)
+        for number, position, side in sorted(read_records(self._chunk_path(chunk), RING_SIDE.format)):
+            sides[number].append(side)
+        return sides
+
+    def __iter__(self):
+        """Yield (tract, other, points) for every arc, in build_topology's order."""
+        chunk, sides = None, None
+        for number, (gid, ring) in enumerate(self._rings()):
+            if number // self.ring_chunk != chunk:
+                chunk = number // self.ring_chunk
+                sides = self._sides(chunk)
+            for arc in ring_arcs(gid, ring_segments(ring), sides.pop(number, [])):
+                yield arc
+
+    def arc_rows(self, srid):
+        """Yield (arcid, tract_gid, other_gid, geom) rows for the arc table."""
+        for arcid, (tract, other, points) in enumerate(self, 1):
+            yield arcid, tract, other, linestring_ewkb(points, srid)
+
+    def _spill_tiles(self):
+        """Write every arc to the tile file of each bucket of cells its bounding box meets, and return the paths."""
+        paths = [os.path.join(self.directory, 'tiles-{}.pickle'.format(bucket)) for bucket in range(self.buckets)]
+        tile_files = [open(path, 'wb') for path in paths]
+        try:
+            for arcid, (tract, other, points) in enumerate(self, 1):
+                xs, ys = zip(*points)
+                buckets = set(
+                    hash((column, row)) % self.buckets
+                    for column in range(int(math.floor(min(xs) / TILE_DEGREES)), int(math.floor(max(xs) / TILE_DEGREES)) + 1)
+                    for row in range(int(math.floor(min(ys) / TILE_DEGREES)), int(math.floor(max(ys) / TILE_DEGREES)) + 1)
+                )
+                for bucket in buckets:
+                    pickle.dump((arcid, points), tile_files[bucket], pickle.HIGHEST_PROTOCOL)
+        finally:
+            for the_file in tile_files:
+                the_file.close()
+        return paths
+
+    def level_rows(self, srid, tolerances=TOLERANCES):
+        """Yield (arcid, level, geom) rows for the arc_level table, every level of an arc in turn."""
+        paths = self._spill_tiles()
+
+        def groups():
+            return (read_tile(path) for path in paths)
+
+        halvings = [settle_arcs(groups, tolerance) for tolerance in tolerances]
+        for arcid, (tract, other, points) in enumerate(self, 1):
+            for level, tolerance in enumerate(tolerances, 1):
+                yield arcid, level, linestring_ewkb(halved(points, tolerance, halvings[level - 1].get(arcid, 0)), srid)
+
+    def close(self):
+        """Delete the files."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        """Return the StreamedTopology."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Delete the files."""
+        self.close()
+
+
+def read_tile(path):
+    """Return {arcid: points} for the arcs spilled to a tile file."""
+    arcs = {}
+    with open(path, 'rb') as the_file:
+        while True:
+            try:
+                arcid, points = pickle.load(the_file)
+            except EOFError:
+                return arcs
+            arcs[arcid] = points
+
+
+def dissolve(topology, district_of):
+    """Return {district: rings} for the districts in district_of, a dict of gid to district.
+
+    Rings run the way shapefile rings do: shells clockwise, holes counter-clockwise.
+    """
+    starts = defaultdict(lambda: defaultdict(list))  # district -> first point -> arcs
+    for tract, other, points in zip(topology.tract, topology.other, topology.points):
+        inside = district_of.get(tract)
+        outside = district_of.get(other) if other != STATE_EDGE else None
+        if inside == outside:
+            continue
+        if inside is not None:
+            starts[inside][points[0]].append(points)
+        if outside is not None:
+            reverse = points[::-1]
+            starts[outside][reverse[0]].append(reverse)
+    rings = {}
+    for district, by_start in starts.items():
+        district_rings = []
+        for first_point in list(by_start):
+            while by_start[first_point]:
+                ring = list(by_start[first_point].pop())
+                while ring[-1] != ring[0]:
+                    following = by_start.get(ring[-1])
+                    if not following:
+                        raise ValueError('District {} has an outline that does not close.'.format(district))
+                    ring.extend(following.pop()[1:])
+                district_rings.append(ring)
+        rings[district] = district_rings
+    return rings
+
+
+def dissolve_polygons(topology, district_of, decimals=None):
+    """Return {district: polygons}, each polygon a list of [shell, hole, ...].
+
+    With decimals, coordinates are rounded to that many places and rings
+    that collapse are dropped.
+    """
+    polygons = {}
+    for district, rings in dissolve(topology, district_of).items():
+        if decimals is not None:
+            rings = [ring for ring in (quantize_ring(ring, decimals) for ring in rings) if len(ring) >= RING_POINTS]
+        polygons[district] = rings_to_polygons(rings)
+    return polygons
+
+
+def quantize_ring(ring, decimals):
+    """Round a ring's points to decimals places, dropping repeats."""
+    quantized = []
+    for x, y in ring:
+        point = (round(x, decimals), round(y, decimals))
+        if not quantized or quantized[-1] != point:
+            quantized.append(point)
+    return quantized
+
+
+def resolution(pixel_size):
+    """Return (level, decimals) for drawing at pixel_size degrees per pixel.
+
+    The level is the coarsest one simplified to within a pixel, and
+    coordinates keep the decimals needed for a quarter of a pixel.  A
+    pixel_size of None asks for full resolution.
+    """
+    if pixel_size is None:
+        return 0, None
+    level = 0
+    for idx, tolerance in enumerate(TOLERANCES, 1):
+        if tolerance <= pixel_size:
+            level = idx
+    return level, max(0, int(math.ceil(-math.log10(pixel_size / 4))))
+
+
+def pixel_size(zoom=None, bbox=None):
+    """Return degrees per pixel for a web map zoom level or a west,south,east,north box."""
+    if bbox is not None:
+        west, south, east, north = [float(value) for value in bbox.split(',')]
+        return abs(east - west) / VIEWPORT_PIXELS
+    if zoom is not None:
+        return 360.0 / (TILE_PIXELS * 2 ** min(max(int(zoom), 0), MAX_ZOOM))
+    return None
+
+
+def multipolygon_geojson(polygons):
+    """Render polygons as a GeoJSON MultiPolygon geometry."""
+    return json.dumps({'type': 'MultiPolygon', 'coordinates': polygons}, separators=(',', ':'))
+
+
+def linestring_points(wkb):
+    """Read the (x, y) points of a 2D WKB LineString."""
+    byte_order = '<' if wkb[0:1] == b'\x01' else '>'
+    num_points = struct.unpack_from(byte_order + 'I', wkb, 5)[0]
+    coords = struct.unpack_from('{}{}d'.format(byte_order, 2 * num_points), wkb, 9)
+    return list(zip(coords[0::2], coords[1::2]))
+
+
+def load_topology(dbsession, level=0, dataset=COLORADO):
+    """Read the dataset's arc table, simplified to level, into a Topology."""
+    Arc, ArcLevel = dataset.arc, dataset.arc_level
+    if level:
+        rows = dbsession.query(Arc.tract_gid, Arc.other_gid, func.ST_AsBinary(ArcLevel.geom)).join(
+            ArcLevel, ArcLevel.arcid == Arc.arcid
+        ).filter(ArcLevel.level == level).order_by(Arc.arcid)
+    else:
+        rows = dbsession.query(Arc.tract_gid, Arc.other_gid, func.ST_AsBinary(Arc.geom)).order_by(Arc.arcid)
+    tract = []
+    other = []
+    points = []
+    for tract_gid, other_gid, wkb in rows:
+        tract.append(tract_gid)
+        other.append(other_gid)
+        points.append(linestring_points(bytes(wkb)))
+    return Topology(tract, other, points)
+
+
+def get_topology(dbsession, fingerprint, level=0, dataset=COLORADO, memory_bytes=GRAPH_MEMORY_BYTES):
+    """Return the dataset's arcs at level for the tables with this fingerprint, read once while held.
+
+    The arcs are held with the tract graphs, under the same memory_bytes
+    budget.  Returns None when the arc table is empty.
+    """
+    key = ('arcs', dataset.name, level)
+    topology = recall(key, fingerprint)
+    if topology is not None:
+        return topology
+    topology = load_topology(dbsession, level, dataset)
+    if not len(topology):
+        return None
+    return hold(key, fingerprint, topology, topology.size(), memory_bytes)
+
+
+def dissolve_plan(
+    dbsession, planid, topology=None, level=0, decimals=None, dataset=COLORADO, memory_bytes=GRAPH_MEMORY_BYTES
+):
+    """Return the plan's districts as plan_districts rows, their shapes dissolved from arcs.
+
+    level and decimals pick the simplified arcs and the rounding, as
+    resolution returns them.  Falls back to plan_districts, which unions
+    the tracts in PostGIS at full resolution, when the arc table hasn't
+    been loaded.  dataset is the state the plan was drawn for, and
+    memory_bytes the budget its arcs are held under.
+    """
+    if topology is None:
+        topology = get_topology(dbsession, current_fingerprint(dbsession, dataset), level, dataset, memory_bytes)
+    if topology is None:
+        return plan_districts(dbsession, planid, dataset.tract).all()
+    polygons = dissolve_polygons(topology, dict(plan_assignments(dbsession, planid)), decimals)
+    return [
+        District(row.districtid, row.area, row.population, multipolygon_geojson(polygons.get(row.districtid, [])))
+        for row in plan_totals(dbsession, planid, dataset.tract)
+    ]
+
+
+def tract_shapes(dbsession, level=0, decimals=None, dataset=COLORADO, memory_bytes=GRAPH_MEMORY_BYTES):
+    """Return every tract of the dataset as a TractShape, in gid order.
+
+    The shapes are drawn from the same arcs as dissolve_plan's districts,
+    so the two line up.  Without arcs PostGIS renders the stored shapes.
+    """
+    Tract = dataset.tract
+    query = dbsession.query(Tract.gid, Tract.shape_area, Tract.tract_pop).order_by(Tract.gid)
+    topology = get_topology(dbsession, current_fingerprint(dbsession, dataset), level, dataset, memory_bytes)
+    if topology is None:
+        return [TractShape(*row) for row in query.add_columns(func.ST_AsGeoJSON(func.ST_Multi(Tract.geom)))]
+    rows = query.all()
+    polygons = dissolve_polygons(topology, {row.gid: row.gid for row in rows}, decimals)
+    return [TractShape(gid, area, population, multipolygon_geojson(polygons.get(gid, []))) for gid, area, population in rows]
@@ -0,0 +1,175 @@
+"""
+Load the tract graph from the database in bulk.
+
+The tracts (without their geometry) and the edge table are read in two
+queries and packed into a compact CSR adjacency: tract i's neighbors are
+neighbors[offsets[i]:offsets[i + 1]], and every per-tract attribute lives
+in an array parallel to the tract index.
+"""
+
+from array import array
+
+import networkx as nx
+
+from gerrypy.models.datasets import COLORADO
+
+
+NO_COUNTY = -1
+
+
+class TractNode(object):
+    """A lightweight stand-in for a Tract row, used as a graph node."""
+
+    __slots__ = ('gid', 'tract_pop', 'shape_area', 'county', 'isborder', 'districtid', 'perimeter')
+
+    def __init__(self, gid, tract_pop, shape_area, county, isborder, districtid=None, perimeter=0.0):
+        """Initialize the TractNode Object."""
+        self.gid = gid
+        self.tract_pop = tract_pop
+        self.shape_area = shape_area
+        self.county = county
+        self.isborder = isborder
+        self.districtid = districtid
+        self.perimeter = perimeter
+
+    def __repr__(self):
+        """Show the tract gid."""
+        return '<TractNode gid={}>'.format(self.gid)
+
+
+class TractGraph(object):
+    """Tract adjacency in compressed sparse row form.
+
+    Tracts are indexed 0..n-1 in gid order.  offsets has n + 1 entries and
+    neighbors holds each tract's neighbor indexes in ascending order.
+    perimeter is each tract's boundary length, and lengths, parallel to
+    neighbors, the length of boundary it shares with each neighbor; both
+    are 0 when the tables don't have them.
+    """
+
+    def __init__(self, gid, tract_pop, shape_area, county, isborder, offsets, neighbors, perimeter=None, lengths=None):
+        """Initialize the TractGraph Object."""
+        self.gid = gid
+        self.tract_pop = tract_pop
+        self.shape_area = shape_area
+        self.county = county
+        self.isborder = isborder
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.perimeter = array('d', bytes(8 * len(gid))) if perimeter is None else perimeter
+        self.lengths = array('d', bytes(8 * len(neighbors))) if lengths is None else lengths
+        self.snapshot_path = None  # The file the arrays are mapped from, if any.
+        self._index = None
+
+    def __len__(self):
+        """Return the number of tracts."""
+        return len(self.gid)
+
+    @property
+    def index(self):
+        """Map each gid to its tract index."""
+        if self._index is None:
+            self._index = {gid: idx for idx, gid in enumerate(self.gid)}
+        return self._index
+
+    @property
+    def num_edges(self):
+        """Return the number of undirected edges."""
+        return len(self.neighbors) // 2
+
+    def neighbors_of(self, idx):
+        """Return the neighbor indexes of the tract at idx."""
+        return self.neighbors[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def lengths_of(self, idx):
+        """Return the boundary the tract at idx shares with each of its neighbors, in neighbors_of order."""
+        return self.lengths[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def degree(self, idx):
+        """Return the number of neighbors of the tract at idx."""
+        return self.offsets[idx + 1] - self.offsets[idx]
+
+
+def build_csr(num_tracts, pairs):
+    """Build CSR offsets and neighbors from (source, target) index pairs.
+
+    Pairs may be listed in either or both directions; duplicates and
+    self-loops are dropped.
+    """
+    adjacency = [set() for _ in range(num_tracts)]
+    for source, target in pairs:
+        if source != target:
+            adjacency[source].add(target)
+            adjacency[target].add(source)
+    offsets = array('l', [0])
+    neighbors = array('l')
+    for adjacent in adjacency:
+        neighbors.extend(sorted(adjacent))
+        offsets.append(len(neighbors))
+    return offsets, neighbors
+
+
+def csr_lengths(offsets, neighbors, shared):
+    """Return the lengths parallel to neighbors, from shared mapping (lower index, higher index) to length."""
+    lengths = array('d')
+    for idx in range(len(offsets) - 1):
+        for neighbor in neighbors[offsets[idx]:offsets[idx + 1]]:
+            lengths.append(shared.get((min(idx, neighbor), max(idx, neighbor)), 0.0))
+    return lengths
+
+
+def load_tract_graph(dbsession, dataset=COLORADO):
+    """Read the dataset's tract and edge tables in two queries and build a TractGraph."""
+    Tract, Edge = dataset.tract, dataset.edge
+    rows = dbsession.query(
+        Tract.gid, Tract.tract_pop, Tract.shape_area, Tract.county, Tract.isborder, Tract.perimeter
+    ).order_by(Tract.gid).all()
+    gid = array('l')
+    tract_pop = array('l')
+    shape_area = array('d')
+    county = array('l')
+    isborder = array('b')
+    perimeter = array('d')
+    for row in rows:
+        gid.append(row.gid)
+        tract_pop.append(row.tract_pop or 0)
+        shape_area.append(float(row.shape_area or 0))
+        county.append(NO_COUNTY if row.county is None else row.county)
+        isborder.append(row.isborder or 0)
+        perimeter.append(row.perimeter or 0.0)
+    index = {tract_gid: idx for idx, tract_gid in enumerate(gid)}
+    edges = [
+        (index[source], index[target], length or 0.0)
+        for source, target, length in dbsession.query(Edge.tract_source, Edge.tract_target, Edge.length)
+        if source in index and target in index  # Skip edges to tracts that aren't in the table.
+    ]
+    offsets, neighbors = build_csr(len(gid), ((source, target) for source, target, length in edges))
+    shared = {(min(source, target), max(source, target)): length for source, target, length in edges}
+    graph = TractGraph(
+        gid, tract_pop, shape_area, county, isborder, offsets, neighbors,
+        perimeter, csr_lengths(offsets, neighbors, shared),
+    )
+    graph._index = index
+    return graph
+
+
+def to_networkx(tract_graph):
+    """Build the networkx graph of TractNodes that State works on."""
+    graph = nx.Graph()
+    nodes = [
+        TractNode(
+            tract_graph.gid[idx],
+            tract_graph.tract_pop[idx],
+            tract_graph.shape_area[idx],
+            None if tract_graph.county[idx] == NO_COUNTY else tract_graph.county[idx],
+            tract_graph.isborder[idx],
+            perimeter=tract_graph.perimeter[idx],
+        )
+        for idx in range(len(tract_graph))
+    ]
+    graph.add_nodes_from(nodes)
+    for idx, node in enumerate(nodes):  # Each edge is added once, from its lower index.
+        for neighbor, length in zip(tract_graph.neighbors_of(idx), tract_graph.lengths_of(idx)):
+            if neighbor > idx:
+                graph.add_edge(node, nodes[neighbor], length=length)
+    return graph
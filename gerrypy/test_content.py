@@ -1,11 +1,12 @@
 import pytest
 import transaction
 from pyramid import testing
-from gerrypy.models.mymodel import Tract, Edge
+from gerrypy.models.mymodel import Tract, Edge, PlanAssignment, plan_districts
 from gerrypy.models.meta import Base
 from gerrypy.scripts.fish_scales import State, OccupiedDist
 from gerrypy.scripts.assigndistrict import assign_district
 import os
+import time
 import networkx as nx
 
 
@@ -99,7 +100,7 @@ def test_database_has_tracts(db_session):
 
 def test_database_has_edges(db_session):
     """Test that database has contents."""
-    assert db_session.query(Edge).count() == 15948
+    assert db_session.query(Edge).count() == 7974
 
 
 def test_edit_districtid(db_session):
@@ -117,45 +118,103 @@ def test_empty_district_nums(dummy_request, cleared_districts):
 
 
 def test_empty_district_nums_after_fill(dummy_request, filled_graph):
-    """Test that not all districts have no district id after they're filled."""
-    query = dummy_request.dbsession.query(Tract)
+    """Test that the filled plan gives some tracts a district."""
     criteria = {
         'county': 1,
         'compactness': 1
     }
     state = State(dummy_request, 1)
     state.fill_state(criteria)
-    no_d_id = query.filter(Tract.districtid == None).count()
-    assert no_d_id < 1249
+    query = dummy_request.dbsession.query(PlanAssignment)
+    assert 0 < query.filter(PlanAssignment.planid == state.planid).count() <= 1249
 
 
 def test_assign_district_add_one_dist_id(dummy_request, filled_graph, cleared_districts):
     """Test that a district id is filled by assign_district."""
     nx.nodes(filled_graph)[0].districtid = 3
-    assign_district(dummy_request, filled_graph)
-    query = dummy_request.dbsession.query(Tract)
-    no_d_id = query.filter(Tract.districtid == None).count()
-    assert no_d_id == 1248
+    planid = assign_district(dummy_request, filled_graph)
+    query = dummy_request.dbsession.query(PlanAssignment)
+    assert query.filter(PlanAssignment.planid == planid).count() == 1
 
 
 def test_assign_district_adds_mult_dist_ids(dummy_request, filled_graph, cleared_districts):
     """Test that multiple district ids are filled by assign_district."""
     nx.nodes(filled_graph)[0].districtid = 3
     nx.nodes(filled_graph)[1].districtid = 4
-    assign_district(dummy_request, filled_graph)
-    query = dummy_request.dbsession.query(Tract)
-    no_d_id = query.filter(Tract.districtid == None).count()
-    assert no_d_id == 1247
+    planid = assign_district(dummy_request, filled_graph)
+    query = dummy_request.dbsession.query(PlanAssignment)
+    assert query.filter(PlanAssignment.planid == planid).count() == 2
 
 
 def test_assign_district_correct_dist_assigned(dummy_request, filled_graph):
     """Test that assign_district adds the correct district to the db."""
     tractid = nx.nodes(filled_graph)[0].gid
     nx.nodes(filled_graph)[0].districtid = 3
-    assign_district(dummy_request, filled_graph)
-    query = dummy_request.dbsession.query(Tract)
-    test_tract = query.filter(Tract.gid == tractid).first()
-    assert test_tract.districtid == 3
+    planid = assign_district(dummy_request, filled_graph)
+    query = dummy_request.dbsession.query(PlanAssignment)
+    assignment = query.filter(PlanAssignment.planid == planid, PlanAssignment.gid == tractid).first()
+    assert assignment.districtid == 3
+
+
+def test_assign_gids_keeps_plans_apart(dummy_request, cleared_districts):
+    """Test that each plan is stored on its own and the tract table is untouched."""
+    from gerrypy.scripts.assigndistrict import assign_gids
+    first = assign_gids(dummy_request, [(1, 5), (2, 6), (3, None)])
+    second = assign_gids(dummy_request, [(1, 2)])
+    assert first != second
+    query = dummy_request.dbsession.query(PlanAssignment)
+    assert query.filter(PlanAssignment.planid == first).count() == 2
+    assert query.filter(PlanAssignment.planid == second).one().districtid == 2
+    assert dummy_request.dbsession.query(Tract).filter(Tract.districtid == None).count() == 1249
+
+
+def test_prune_plans_keeps_newest_and_referenced(dummy_request):
+    """Test that pruning deletes all but the newest plans and the referenced ones, with their assignments."""
+    from gerrypy.models.mymodel import Plan
+    from gerrypy.scripts.assigndistrict import assign_gids, prune_plans
+    planids = [assign_gids(dummy_request, [(1, 1), (2, 2)]) for _ in range(5)]
+    assert prune_plans(dummy_request.dbsession, 2, [planids[1]]) == 2
+    kept = [planid for planid, in dummy_request.dbsession.query(Plan.planid).filter(Plan.planid.in_(planids))]
+    assert sorted(kept) == [planids[1], planids[3], planids[4]]
+    assignments = dummy_request.dbsession.query(PlanAssignment).filter(PlanAssignment.planid.in_(planids))
+    assert sorted(set(row.planid for row in assignments)) == sorted(kept)
+    assert prune_plans(dummy_request.dbsession, 2, [planids[1]]) == 0
+
+
+def test_plan_districts_sums_each_district(dummy_request):
+    """Test that the plan's districts add up to the tracts assigned to them."""
+    from gerrypy.scripts.assigndistrict import assign_gids
+    tracts = dummy_request.dbsession.query(Tract).order_by(Tract.gid).limit(3).all()
+    planid = assign_gids(dummy_request, [(tracts[0].gid, 1), (tracts[1].gid, 1), (tracts[2].gid, 2)])
+    districts = plan_districts(dummy_request.dbsession, planid).all()
+    assert [district.districtid for district in districts] == [1, 2]
+    assert districts[0].population == tracts[0].tract_pop + tracts[1].tract_pop
+    assert '"MultiPolygon"' in districts[1].geojson
+
+
+def test_dissolve_plan_matches_union(dummy_request):
+    """Test that districts dissolved from arcs have the totals and shapes of the ST_Union ones."""
+    import json
+    from gerrypy.scripts.assigndistrict import assign_gids
+    from gerrypy.scripts.initializedb import DEFAULT_SHAPEFILE, load_arcs, tract_rings
+    from gerrypy.scripts.topology import build_topology, dissolve_plan
+    topology = build_topology(tract_rings(DEFAULT_SHAPEFILE))
+    load_arcs(dummy_request.dbsession, topology)
+    tracts = dummy_request.dbsession.query(Tract.gid, Tract.county).all()
+    planid = assign_gids(dummy_request, [(gid, county % 7 + 1) for gid, county in tracts])
+    dissolved = dissolve_plan(dummy_request.dbsession, planid, topology)
+    unioned = plan_districts(dummy_request.dbsession, planid).all()
+    assert [row[:3] for row in dissolved] == [row[:3] for row in unioned]
+    for ours, theirs in zip(dissolved, unioned):
+        assert len(json.loads(ours.geojson)['coordinates']) == len(json.loads(theirs.geojson)['coordinates'])
+
+
+def test_every_edge_has_an_arc(dummy_request):
+    """Test that every pair of tracts with a border in the edge table has an arc between them."""
+    from gerrypy.scripts.initializedb import DEFAULT_SHAPEFILE, load_arcs, tract_rings, unpaired_edges
+    from gerrypy.scripts.topology import build_topology
+    load_arcs(dummy_request.dbsession, build_topology(tract_rings(DEFAULT_SHAPEFILE)))
+    assert unpaired_edges(dummy_request.dbsession) == []
 
 # =======Functional Tests ================
 
@@ -225,12 +284,110 @@ def test_map_page_loads_json(testapp):
     assert 'map.data.loadGeoJson' in str(response)
 
 
+def wait_for_plan(testapp, result):
+    """Poll the job in a map form result until its plan is stored, and return the plan's links."""
+    while 'districts' not in result:
+        assert result['status'] in ('queued', 'running')
+        time.sleep(0.05)
+        result = testapp.get(result['job'], status=200).json
+    return result
+
+
 def test_map_page_loads_correct_json(testapp):
     """Test that map page loads json after get request."""
     get_params = {'countyweight': 1, 'compactweight': 1}
     response = testapp.get('/map', get_params, status=200)
-    json_url = response.html.find('script').attrs['data-json']
-    json_response = testapp.get(json_url, status=200).text
-    with open('gerrypy/views/geo.json', 'r') as the_file:
-        our_json = the_file.read()
-    assert our_json == json_response
+    script = response.html.find('script').attrs
+    json_url = script['data-json']
+    if not json_url:  # Not built yet, so the page follows the job.
+        json_url = wait_for_plan(testapp, testapp.get(script['data-job'], status=200).json)['geojson']
+    features = testapp.get(json_url, status=200).json['features']
+    assert sorted(feature['properties']['id'] for feature in features) == list(range(1, 8))
+
+
+def test_map_form_queues_job(testapp):
+    """Test that the page's form queues a job whose result links to the plan, and a cached plan comes back at once."""
+    get_params = {'countyweight': 2, 'compactweight': 3, 'seed': 11}
+    result = testapp.get('/map', get_params, xhr=True, status=200).json
+    plan = wait_for_plan(testapp, result)
+    if 'job' in result:
+        assert testapp.get(result['job'] + '/result', status=200).json == {
+            name: plan[name] for name in ('planid', 'geojson', 'districts')
+        }
+    assert testapp.get('/map', get_params, xhr=True, status=200).json['planid'] == plan['planid']
+    testapp.post('/jobs/unknown/cancel', status=404)
+
+
+def test_map_form_returns_plan_links(testapp):
+    """Test that the page's form gets the plan's links back as JSON, and its districts as a byte per tract."""
+    get_params = {'countyweight': 1, 'compactweight': 1}
+    plan = wait_for_plan(testapp, testapp.get('/map', get_params, xhr=True, status=200).json)
+    packed = testapp.get(plan['districts'], status=200).body
+    assert len(packed) == 1249 and set(packed) == set(range(1, 8))
+    assert testapp.get(plan['districts'], {'base': plan['planid']}, status=200).body == b''
+
+
+def test_tract_geojson_revalidates(testapp):
+    """Test that the tract shapes come in gid order and aren't sent again while the tables are unchanged."""
+    response = testapp.get('/tracts/geo.json', {'zoom': 7}, status=200)
+    features = response.json['features']
+    assert [feature['properties']['index'] for feature in features] == list(range(1249))
+    assert [feature['id'] for feature in features] == sorted(feature['id'] for feature in features)
+    testapp.get('/tracts/geo.json', {'zoom': 7}, headers={'If-None-Match': response.headers['ETag']}, status=304)
+
+
+def test_state_map_page(testapp):
+    """Test that a state's map page starts over the state and fetches its tracts, and unknown states aren't found."""
+    response = testapp.get('/map/colorado', status=200)
+    assert 'lat: 39.0, lng: -106.0' in str(response)
+    assert response.html.find('script').attrs['data-tracts'].endswith('/tracts/colorado/geo.json')
+    testapp.get('/map/atlantis', status=404)
+    testapp.get('/tracts/atlantis/geo.json', status=404)
+
+
+def test_state_map_form_draws_its_districts(testapp):
+    """Test that a plan drawn from a state's page has the state's number of districts."""
+    get_params = {'countyweight': 1, 'compactweight': 1, 'seed': 5}
+    plan = wait_for_plan(testapp, testapp.get('/map/colorado', get_params, xhr=True, status=200).json)
+    assert set(testapp.get(plan['districts'], status=200).body) == set(range(1, 8))
+
+
+def test_evaluate_scores_plans(testapp):
+    """Test that a batch of plans is scored from JSON or packed bytes, and malformed plans are refused."""
+    get_params = {'countyweight': 1, 'compactweight': 1}
+    plan = wait_for_plan(testapp, testapp.get('/map', get_params, xhr=True, status=200).json)
+    packed = testapp.get(plan['districts'], status=200).body
+    scores = testapp.post('/evaluate', packed * 3, content_type='application/octet-stream', status=200).json
+    assert scores['plans'] == 3 and scores['contiguous'] == [True] * 3
+    assert sum(scores['populations'][0]) == sum(
+        feature['properties']['population'] for feature in testapp.get(plan['geojson'], status=200).json['features']
+    )
+    assert testapp.post_json('/evaluate/colorado', {'plans': [list(packed)]}, status=200).json['cut_edges'] == scores['cut_edges'][:1]
+    testapp.post('/evaluate', packed[:-1], content_type='application/octet-stream', status=400)
+    testapp.post_json('/evaluate', {'plans': [[9] * len(packed)]}, status=400)
+    testapp.post_json('/evaluate/atlantis', {'plans': []}, status=404)
+
+
+def test_add_missing_columns_upgrades_old_tables(db_session):
+    """Test that columns the models gained are added to a table made before them, defaults and all."""
+    from sqlalchemy import Column, Float, Integer, MetaData, String, Table, text
+    from gerrypy.scripts.initializedb import add_missing_columns
+    engine = db_session.bind
+    with engine.begin() as connection:
+        connection.execute(text('DROP TABLE IF EXISTS upgrade_test'))
+        connection.execute(text('CREATE TABLE upgrade_test (id integer PRIMARY KEY)'))
+        connection.execute(text('INSERT INTO upgrade_test VALUES (1)'))
+    metadata = MetaData()
+    Table(
+        'upgrade_test', metadata, Column('id', Integer, primary_key=True), Column('length', Float),
+        Column('dataset', String, nullable=False, server_default='colorado'),
+    )
+    try:
+        assert add_missing_columns(engine, metadata) == ['upgrade_test.length', 'upgrade_test.dataset']
+        assert add_missing_columns(engine, metadata) == []
+        with engine.connect() as connection:
+            rows = connection.execute(text('SELECT id, length, dataset FROM upgrade_test')).fetchall()
+        assert [tuple(row) for row in rows] == [(1, None, 'colorado')]
+    finally:
+        with engine.begin() as connection:
+            connection.execute(text('DROP TABLE upgrade_test'))
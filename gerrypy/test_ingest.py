@@ -0,0 +1,361 @@
+"""Test reading and loading the tract shapefile."""
+
+import pytest
+from gerrypy.scripts.initializedb import DEFAULT_SHAPEFILE
+
+
+@pytest.fixture(scope="module")
+def records():
+    """Read every record of the shipped Colorado shapefile."""
+    from gerrypy.scripts.shapefile import read_shapefile
+    return list(read_shapefile(DEFAULT_SHAPEFILE))
+
+
+def test_shapefile_record_count(records):
+    """Test that every Colorado tract is read."""
+    assert len(records) == 1249
+
+
+def test_shapefile_record_numbers(records):
+    """Test that records are numbered from one, in file order."""
+    assert [number for number, attributes, rings in records] == list(range(1, 1250))
+
+
+def test_shapefile_attributes(records):
+    """Test that dbf fields are parsed to the right types."""
+    number, attributes, rings = records[0]
+    assert attributes['COUNTY'] == '031' and isinstance(attributes['tract_pop'], int)
+
+
+def test_shapefile_rings_closed(records):
+    """Test that every ring ends where it starts."""
+    for number, attributes, rings in records:
+        for ring in rings:
+            assert ring[0] == ring[-1]
+
+
+def test_rings_to_polygons_keeps_holes(records):
+    """Test that holes are kept with their shells rather than made into polygons."""
+    from gerrypy.scripts.shapefile import rings_to_polygons, signed_area
+    for number, attributes, rings in records:
+        for polygon in rings_to_polygons(rings):
+            assert signed_area(polygon[0]) < 0
+
+
+def test_multipolygon_ewkb_header():
+    """Test that EWKB is a little-endian MultiPolygon with an SRID."""
+    import struct
+    from gerrypy.scripts.shapefile import multipolygon_ewkb
+    square = [[[(0, 0), (0, 1), (1, 1), (1, 0), (0, 0)]]]
+    data = multipolygon_ewkb(square, 4269)
+    assert struct.unpack_from('<BIII', data) == (1, 0x20000006, 4269, 1)
+
+
+def test_tract_rows_columns():
+    """Test that tract rows line up with the copied columns."""
+    from gerrypy.scripts.initializedb import tract_rows
+    gid, shape_area, tract_pop, county, isborder, perimeter, geom = next(tract_rows(DEFAULT_SHAPEFILE, 4269))
+    assert gid == 1 and county == 31 and perimeter is None and isinstance(geom, bytes)
+
+
+def test_row_stream_chunks():
+    """Test that RowStream hands out COPY text in chunks of the requested size."""
+    from gerrypy.scripts.bulkload import RowStream
+    stream = RowStream((idx, 'row') for idx in range(1000))
+    chunks = []
+    chunk = stream.read(100)
+    while chunk:
+        assert len(chunk) <= 100
+        chunks.append(chunk)
+        chunk = stream.read(100)
+    assert b''.join(chunks).count(b'\n') == 1000
+
+
+def test_row_stream_escapes():
+    """Test that nulls, tabs and bytes are rendered in COPY text format."""
+    from gerrypy.scripts.bulkload import RowStream
+    assert RowStream([(None, 'a\tb', b'\x01')]).read() == b'\\N\ta\\tb\t01\n'
+
+
+@pytest.fixture(scope="module")
+def adjacency():
+    """Match the borders of the shipped Colorado tracts."""
+    from gerrypy.scripts.adjacency import build_adjacency
+    from gerrypy.scripts.initializedb import tract_rings
+    return build_adjacency(tract_rings(DEFAULT_SHAPEFILE))
+
+
+def test_adjacency_pair_count(adjacency):
+    """Test that every pair of touching Colorado tracts is found."""
+    assert len(adjacency.lengths) == 3987
+
+
+def test_adjacency_border_tracts(adjacency):
+    """Test that the border tracts found match the hand-coded Colorado count."""
+    assert sum(adjacency.isborder(gid) for gid in adjacency.perimeter) == 36
+
+
+def test_adjacency_parallel_matches_serial(adjacency):
+    """Test that matching strips in a process pool gives the same edges."""
+    from gerrypy.scripts.adjacency import build_adjacency
+    from gerrypy.scripts.initializedb import tract_rings
+    parallel = build_adjacency(tract_rings(DEFAULT_SHAPEFILE), workers=2, strips=4)
+    assert sorted(parallel.lengths) == sorted(adjacency.lengths)
+
+
+def test_adjacency_buckets_match(adjacency, tmpdir):
+    """Test that spilling segments to fewer buckets finds the same borders and cleans up after itself."""
+    from gerrypy.scripts.adjacency import build_adjacency
+    from gerrypy.scripts.initializedb import tract_rings
+    bucketed = build_adjacency(tract_rings(DEFAULT_SHAPEFILE), buckets=3, directory=str(tmpdir))
+    assert bucketed.lengths == pytest.approx(adjacency.lengths)
+    assert bucketed.perimeter == adjacency.perimeter
+    assert tmpdir.listdir() == []
+
+
+def test_adjacency_edge_rows_both_directions(adjacency):
+    """Test that each pair is written as an edge in both directions."""
+    rows = list(adjacency.edge_rows())
+    assert len(rows) == 2 * len(adjacency.lengths)
+    assert rows[0][1:] == (rows[1][2], rows[1][1], rows[1][3])
+
+
+def test_adjacency_partial_overlap():
+    """Test that borders sharing no vertices are matched by overlap."""
+    from gerrypy.scripts.adjacency import build_adjacency
+    big = [[(0, 0), (0, 2), (2, 2), (2, 0), (0, 0)]]
+    small = [[(2, 0.5), (2, 1.5), (3, 1.5), (3, 0.5), (2, 0.5)]]
+    adjacency = build_adjacency([(1, big), (2, small)], strips=2)
+    assert adjacency.lengths == {(1, 2): 1.0}
+
+
+def test_adjacency_corner_touch():
+    """Test that tracts meeting at a corner are neighbors with no shared length."""
+    from gerrypy.scripts.adjacency import build_adjacency
+    first = [[(0, 0), (0, 1), (1, 1), (1, 0), (0, 0)]]
+    second = [[(1, 1), (1, 2), (2, 2), (2, 1), (1, 1)]]
+    assert build_adjacency([(1, first), (2, second)]).lengths == {(1, 2): 0.0}
+    assert build_adjacency([(1, first), (2, second)], queen=False).lengths == {}
+
+
+@pytest.fixture(scope="module")
+def topology():
+    """Cut the shipped Colorado tract boundaries into arcs."""
+    from gerrypy.scripts.initializedb import tract_rings
+    from gerrypy.scripts.topology import build_topology
+    return build_topology(tract_rings(DEFAULT_SHAPEFILE))
+
+
+def test_topology_keeps_each_segment_once(topology, records):
+    """Test that the arcs hold every distinct boundary segment exactly once."""
+    from gerrypy.scripts.adjacency import segment_key
+    segments = set(
+        segment_key(start, end) for number, attributes, rings in records
+        for ring in rings for start, end in zip(ring, ring[1:]) if start != end
+    )
+    arc_segments = [segment_key(start, end) for points in topology.points for start, end in zip(points, points[1:])]
+    assert len(arc_segments) == len(segments) and set(arc_segments) == segments
+
+
+def test_streamed_topology_matches(topology, tmpdir):
+    """Test that cutting arcs a bucket and a chunk of rings at a time gives build_topology's arcs and rows."""
+    from gerrypy.scripts.initializedb import tract_rings
+    from gerrypy.scripts.topology import StreamedTopology
+    with StreamedTopology(lambda: tract_rings(DEFAULT_SHAPEFILE), 5, str(tmpdir), ring_chunk=100) as streamed:
+        assert list(streamed) == list(zip(topology.tract, topology.other, topology.points))
+        assert list(streamed.arc_rows(4269)) == list(topology.arc_rows(4269))
+        assert sorted(streamed.level_rows(4269)) == sorted(topology.level_rows(4269))
+    assert tmpdir.listdir() == []
+
+
+def test_topology_splits_overlaps(tmpdir):
+    """Test that boundary matched by overlap, not identical segments, is cut into an arc between both tracts."""
+    from gerrypy.scripts.topology import STATE_EDGE, StreamedTopology, build_topology, dissolve
+    tracts = [
+        (1, [[(0, 0), (0, 1), (1, 1), (1, 0), (0, 0)]]),
+        (2, [[(1, 0), (1, 0.5), (1, 1), (2, 1), (2, 0), (1, 0)]]),
+    ]
+    topology = build_topology(tracts)
+    with StreamedTopology(lambda: tracts, 3, str(tmpdir)) as streamed:
+        assert list(streamed) == list(zip(topology.tract, topology.other, topology.points))
+    shared = [points for tract, other, points in zip(topology.tract, topology.other, topology.points) if other == 2]
+    assert [sorted(points) for points in shared] == [[(1, 0), (1, 0.5), (1, 1)]]
+    assert not any(
+        start[0] == end[0] == 1 for other, points in zip(topology.other, topology.points) if other == STATE_EDGE
+        for start, end in zip(points, points[1:])
+    )
+    assert len(dissolve(topology, {1: 1, 2: 1})[1]) == 1
+
+
+def test_dissolve_area_matches_tracts(topology, records):
+    """Test that each dissolved district covers exactly the area of its tracts."""
+    from gerrypy.scripts.shapefile import signed_area
+    from gerrypy.scripts.topology import dissolve
+    district_of = {number: int(attributes['COUNTY']) % 7 + 1 for number, attributes, rings in records}
+    rings = dissolve(topology, district_of)
+    for district, district_rings in rings.items():
+        expected = sum(
+            signed_area(ring) for number, attributes, tract_rings in records
+            if district_of[number] == district for ring in tract_rings
+        )
+        assert sum(signed_area(ring) for ring in district_rings) == pytest.approx(expected)
+
+
+def test_dissolve_keeps_holes():
+    """Test that a tract surrounded by another district leaves a hole in it."""
+    from gerrypy.scripts.shapefile import signed_area
+    from gerrypy.scripts.topology import build_topology, dissolve_polygons
+    outer = [[(0, 0), (0, 3), (3, 3), (3, 0), (0, 0)], [(1, 1), (2, 1), (2, 2), (1, 2), (1, 1)]]
+    inner = [[(1, 1), (1, 2), (2, 2), (2, 1), (1, 1)]]
+    side = [[(3, 0), (3, 3), (4, 3), (4, 0), (3, 0)]]
+    topology = build_topology([(1, outer), (2, inner), (3, side)])
+    polygons = dissolve_polygons(topology, {1: 1, 2: 2, 3: 1})
+    assert len(polygons[1]) == 1 and len(polygons[1][0]) == 2
+    assert signed_area(polygons[1][0][0]) == -12 and signed_area(polygons[1][0][1]) == 1
+    assert len(polygons[2]) == 1 and len(polygons[2][0]) == 1
+
+
+def test_linestring_ewkb_round_trip():
+    """Test that arc geometry reads back as the points it was written from."""
+    from gerrypy.scripts.shapefile import linestring_ewkb
+    from gerrypy.scripts.topology import linestring_points
+    points = [(0.5, 1.0), (2.0, -3.25), (4.0, 4.0)]
+    data = linestring_ewkb(points, 4269)
+    wkb = data[:1] + (2).to_bytes(4, 'little') + data[9:]  # What ST_AsBinary returns: no SRID.
+    assert linestring_points(wkb) == points
+
+
+def test_simplify_points_keeps_ends():
+    """Test that simplifying keeps an arc's end points and a closed arc a ring."""
+    from gerrypy.scripts.topology import simplify_points
+    line = [(0, 0), (1, 0.001), (2, 0), (3, 1)]
+    assert simplify_points(line, 0.01) == [(0, 0), (2, 0), (3, 1)]
+    ring = [(0, 0), (0, 1), (1, 1), (1, 0), (0, 0)]
+    assert simplify_points(ring, 10) == ring
+
+
+def test_settle_arcs_keeps_arcs_apart():
+    """Test that an arc whose chord would cross its neighbor is simplified finer."""
+    from gerrypy.scripts.topology import halved, settle_arcs
+    arcs = {1: [(0, 0), (1, 1), (2, 0)], 2: [(1, 0.5), (1, -0.5)]}
+    halvings = settle_arcs(lambda: [arcs], 2)
+    assert halvings == {1: 2}
+    assert halved(arcs[1], 2, halvings[1]) == arcs[1]
+
+
+def test_simplified_rings_do_not_collapse():
+    """Test that a tract between two nodes keeps an outline with area at every level."""
+    from gerrypy.scripts.shapefile import signed_area
+    from gerrypy.scripts.topology import RING_POINTS, build_topology, dissolve
+    lens = [[(0, 0), (1, 0.1), (2, 0), (1, -0.1), (0, 0)]]
+    above = [[(0, 0), (0, 1), (2, 1), (2, 0), (1, 0.1), (0, 0)]]
+    simplified = build_topology([(1, lens), (2, above)]).simplified(1)
+    rings = dissolve(simplified, {1: 1, 2: 2})
+    assert len(rings[1][0]) >= RING_POINTS and signed_area(rings[1][0]) != 0
+    assert signed_area(rings[2][0]) != 0
+
+
+def test_simplified_arcs_do_not_conflict(topology):
+    """Test that no arc of the coarsest level crosses, touches or overlaps another."""
+    from gerrypy.scripts.topology import TOLERANCES, arc_conflicts
+    coarse = topology.simplified(TOLERANCES[-1])
+    assert arc_conflicts(dict(enumerate(coarse.points, 1))) == set()
+
+
+def test_resolution_coarser_when_zoomed_out():
+    """Test that lower zooms get coarser levels and fewer decimals."""
+    from gerrypy.scripts.topology import pixel_size, resolution
+    assert resolution(None) == (0, None)
+    levels = [resolution(pixel_size(zoom)) for zoom in range(4, 16)]
+    assert levels == sorted(levels, key=lambda level: (-level[0], level[1]))
+    assert resolution(pixel_size(bbox='-112,37,-100,41')) == resolution(pixel_size(zoom=7))
+
+
+def test_simplified_districts_leave_no_gaps(topology, records):
+    """Test that simplified districts still tile the simplified state exactly."""
+    from gerrypy.scripts.shapefile import signed_area
+    from gerrypy.scripts.topology import TOLERANCES, dissolve_polygons
+    coarse = topology.simplified(TOLERANCES[-1])
+    district_of = {number: int(attributes['COUNTY']) % 7 + 1 for number, attributes, rings in records}
+
+    def area(polygons):
+        return sum(signed_area(ring) for polygon in polygons for ring in polygon)
+    districts = dissolve_polygons(coarse, district_of, decimals=3)
+    state = dissolve_polygons(coarse, dict.fromkeys(district_of, 1), decimals=3)
+    assert sum(area(polygons) for polygons in districts.values()) == pytest.approx(area(state[1]))
+
+
+def _fields(data):
+    """Decode protocol buffer bytes into (field number, value) pairs, for reading tiles back."""
+    from gerrypy.scripts.tiles import _read_varint
+    fields = []
+    position = 0
+    while position < len(data):
+        key, position = _read_varint(data, position)
+        if key & 7 == 0:
+            value, position = _read_varint(data, position)
+        else:
+            length, position = _read_varint(data, position)
+            value, position = data[position:position + length], position + length
+        fields.append((key >> 3, value))
+    return fields
+
+
+def _rings(geometry):
+    """Decode tile geometry commands into rings of tile coordinates."""
+    from gerrypy.scripts.tiles import _read_varint
+    values = []
+    position = 0
+    while position < len(geometry):
+        value, position = _read_varint(geometry, position)
+        values.append(value)
+    rings = []
+    x = y = idx = 0
+    while idx < len(values):
+        command, count = values[idx] & 7, values[idx] >> 3
+        idx += 1
+        if command == 7:
+            continue
+        if command == 1:
+            rings.append([])
+        for _ in range(count):
+            x += (values[idx] >> 1) ^ -(values[idx] & 1)
+            y += (values[idx + 1] >> 1) ^ -(values[idx + 1] & 1)
+            rings[-1].append((x, y))
+            idx += 2
+    return rings
+
+
+def test_varint_and_zigzag():
+    """Test the protocol buffer integer encodings against the spec's examples."""
+    from gerrypy.scripts.tiles import varint, zigzag
+    assert varint(1) == b'\x01' and varint(300) == b'\xac\x02'
+    assert [zigzag(value) for value in (0, -1, 1, -2)] == [0, 1, 2, 3]
+
+
+def test_tiles_cover_every_tract(topology):
+    """Test that the tiles over Colorado hold every tract, with exterior rings wound as the spec asks."""
+    from gerrypy.scripts.tiles import TileSource, ring_area, tile_range
+    source = TileSource(topology)
+    seen = set()
+    for x, y in tile_range((-109.1, 36.9, -102.0, 41.1), 8):
+        for gid, geometry in source.features(8, x, y):
+            seen.add(gid)
+            assert ring_area(_rings(geometry)[0]) > 0
+    assert len(seen) == 1249
+
+
+def test_encode_tile_tags_districts(tmpdir):
+    """Test that a tile's features carry their gid and district, and cut features read back from disk."""
+    from gerrypy.scripts.tiles import encode_tile, read_features, write_features
+    path = str(tmpdir.join('6', '13', '24.bin'))
+    write_features(path, [(5, b'\x09\x00\x00\x0f'), (9, b'\x09\x02\x02\x0f')])
+    features = read_features(path)
+    assert features == [(5, b'\x09\x00\x00\x0f'), (9, b'\x09\x02\x02\x0f')]
+    (number, layer), = _fields(encode_tile(features, {5: 3}))
+    layer = _fields(layer)
+    assert (1, b'tracts') in layer and (3, b'district') in layer and (5, 4096) in layer
+    assert [_fields(value) for number, value in layer if number == 4] == [[(5, 3)]]
+    tagged, untagged = [_fields(value) for number, value in layer if number == 2]
+    assert tagged[0] == (1, 5) and tagged[1] == (2, b'\x00\x00')
+    assert untagged[0] == (1, 9) and all(number != 2 for number, value in untagged)
@@ -64,7 +64,145 @@ def test_fill_graph_node_has_right_pop(filled_graph, dummy_request):
 def test_fill_graph_node_has_right_area(filled_graph, dummy_request):
     """Test that filled_graph has same area value as database."""
     node_id = filled_graph.nodes()[50].gid
-    assert filled_graph.nodes()[50].shape_area == dummy_request.dbsession.query(Tract).get(node_id).shape_area
+    assert filled_graph.nodes()[50].shape_area == float(dummy_request.dbsession.query(Tract).get(node_id).shape_area)
+
+
+@pytest.fixture
+def tract_graph(dummy_request):
+    """Load the CSR tract graph."""
+    from gerrypy.scripts.tractgraph import load_tract_graph
+    return load_tract_graph(dummy_request.dbsession)
+
+
+def test_tract_graph_num_tracts(tract_graph):
+    """Test that the CSR graph has a row for every tract."""
+    assert len(tract_graph) == 1249 and len(tract_graph.offsets) == 1250
+
+
+def test_tract_graph_gid_order(tract_graph):
+    """Test that tracts are indexed in gid order."""
+    assert list(tract_graph.gid) == sorted(tract_graph.gid)
+
+
+def test_tract_graph_neighbors_symmetric(tract_graph):
+    """Test that every neighbor relation appears in both directions."""
+    for idx in range(len(tract_graph)):
+        for neighbor in tract_graph.neighbors_of(idx):
+            assert idx in tract_graph.neighbors_of(neighbor)
+
+
+def test_tract_graph_matches_networkx(tract_graph, filled_graph):
+    """Test that the networkx adapter has the same edges as the CSR graph."""
+    assert tract_graph.num_edges == filled_graph.number_of_edges()
+
+
+def test_tract_graph_population(tract_graph, dummy_request):
+    """Test that the tract populations match the database."""
+    from sqlalchemy import func
+    assert sum(tract_graph.tract_pop) == dummy_request.dbsession.query(func.sum(Tract.tract_pop)).scalar()
+
+
+def test_snapshot_round_trip(tract_graph, tmpdir):
+    """Test that a snapshot reads back the same arrays it was written with."""
+    from gerrypy.scripts.snapshot import write_snapshot, read_snapshot
+    path = str(tmpdir.join('tracts.graph'))
+    write_snapshot(path, tract_graph, 'a' * 40)
+    fingerprint, mapped = read_snapshot(path)
+    assert fingerprint == 'a' * 40
+    for attribute in ('gid', 'tract_pop', 'shape_area', 'county', 'isborder', 'offsets', 'neighbors', 'perimeter', 'lengths'):
+        assert list(getattr(mapped, attribute)) == list(getattr(tract_graph, attribute))
+
+
+def test_snapshot_fingerprint_stable(dummy_request):
+    """Test that the fingerprint doesn't change when the tables don't."""
+    from gerrypy.scripts.snapshot import table_fingerprint
+    assert table_fingerprint(dummy_request.dbsession) == table_fingerprint(dummy_request.dbsession)
+
+
+def test_snapshot_fingerprint_changes(dummy_request):
+    """Test that changing a tract changes the fingerprint."""
+    from gerrypy.scripts.snapshot import table_fingerprint
+    before = table_fingerprint(dummy_request.dbsession)
+    tract = dummy_request.dbsession.query(Tract).first()
+    tract.tract_pop += 1
+    dummy_request.dbsession.flush()
+    assert table_fingerprint(dummy_request.dbsession) != before
+
+
+def test_current_fingerprint_hashes_rarely(dummy_request):
+    """Test that requests reuse a recent hash of the tables, and see a change once it is old enough."""
+    from gerrypy.scripts.snapshot import current_fingerprint, fresh_fingerprint
+    before = fresh_fingerprint(dummy_request.dbsession)
+    tract = dummy_request.dbsession.query(Tract).first()
+    tract.tract_pop += 1
+    dummy_request.dbsession.flush()
+    assert current_fingerprint(dummy_request.dbsession) == before
+    assert current_fingerprint(dummy_request.dbsession, seconds=0) != before
+
+
+def test_snapshot_fingerprint_sees_swaps(dummy_request):
+    """Test that swapping two tracts' populations changes the fingerprint, though the totals don't."""
+    from gerrypy.scripts.snapshot import table_fingerprint
+    first, second = dummy_request.dbsession.query(Tract).filter(Tract.tract_pop > 0).order_by(Tract.gid).limit(2)
+    if first.tract_pop == second.tract_pop:
+        second.tract_pop += 1
+        dummy_request.dbsession.flush()
+    before = table_fingerprint(dummy_request.dbsession)
+    first.tract_pop, second.tract_pop = second.tract_pop, first.tract_pop
+    dummy_request.dbsession.flush()
+    assert table_fingerprint(dummy_request.dbsession) != before
+
+
+def test_get_tract_graph_reuses_mapping(dummy_request, tmpdir):
+    """Test that the graph is mapped once per fingerprint."""
+    from gerrypy.scripts.snapshot import get_tract_graph
+    first = get_tract_graph(dummy_request.dbsession, str(tmpdir))
+    assert get_tract_graph(dummy_request.dbsession, str(tmpdir)) is first
+
+
+def test_get_tract_graph_drops_least_recently_used(dummy_request, tmpdir):
+    """Test that graphs past the memory budget are dropped, least recently used first."""
+    from gerrypy.scripts.snapshot import get_tract_graph
+    first = get_tract_graph(dummy_request.dbsession, str(tmpdir.mkdir('first')), memory_bytes=1)
+    second = get_tract_graph(dummy_request.dbsession, str(tmpdir.mkdir('second')), memory_bytes=1)
+    assert get_tract_graph(dummy_request.dbsession, str(tmpdir.join('second')), memory_bytes=1) is second
+    assert get_tract_graph(dummy_request.dbsession, str(tmpdir.join('first')), memory_bytes=1) is not first
+
+
+def test_fingerprint_differs_by_dataset(dummy_request):
+    """Test that two states' tables never share a fingerprint."""
+    from gerrypy.models.datasets import COLORADO
+    from gerrypy.scripts.snapshot import table_fingerprint
+    other = COLORADO._replace(name='other')
+    assert table_fingerprint(dummy_request.dbsession, other) != table_fingerprint(dummy_request.dbsession)
+
+
+def test_parse_datasets():
+    """Test that every line of the setting becomes a dataset after Colorado."""
+    from gerrypy.models.datasets import COLORADO, parse_datasets
+    datasets = parse_datasets('\n  new_mexico 3 34.4 -106.1 6\n')
+    assert list(datasets) == ['colorado', 'new_mexico']
+    assert datasets['colorado'] is COLORADO
+    new_mexico = datasets['new_mexico']
+    assert (new_mexico.title, new_mexico.num_dst, new_mexico.center, new_mexico.zoom) == ('New Mexico', 3, (34.4, -106.1), 6)
+    assert new_mexico.tract.__table__.name == 'new_mexico_tracts'
+    assert new_mexico.arc_level.__table__.name == 'new_mexico_arc_level'
+
+
+def test_parse_datasets_rejects_bad_lines():
+    """Test that a line missing a field, or a name that isn't a table name, is refused."""
+    from gerrypy.models.datasets import parse_datasets
+    with pytest.raises(ValueError):
+        parse_datasets('texas 36')
+    with pytest.raises(ValueError):
+        parse_datasets('texas; 36 31 -99 6')
+
+
+def test_dataset_models_declared_once():
+    """Test that asking for a state's models twice returns the same classes."""
+    from gerrypy.models.datasets import dataset_models
+    assert dataset_models('utah') == dataset_models('utah')
+    assert dataset_models('utah')[1].__table__.name == 'utah_edge'
 
 
 def test_district_constructor_nodes(filled_graph):
@@ -245,6 +383,46 @@ def test_district_rem_node_area(filled_graph):
     assert dist.area == node_area
 
 
+def test_perimeter_keeps_insertion_order():
+    """Test that the perimeter iterates in the order tracts were added."""
+    from gerrypy.scripts.fish_scales import Perimeter
+    perimeter = Perimeter([3, 1, 2])
+    perimeter.remove(1)
+    perimeter.append(1)
+    perimeter.add(3)
+    assert perimeter == [3, 2, 1] and perimeter[-1] == 1 and 2 in perimeter
+
+
+def test_perimeter_remove_missing():
+    """Test that removing a tract that isn't there raises like a list."""
+    from gerrypy.scripts.fish_scales import Perimeter
+    with pytest.raises(ValueError):
+        Perimeter().remove(1)
+
+
+def test_district_inside_counts(filled_graph):
+    """Test that inside counts each perimeter tract's neighbors in the district."""
+    from gerrypy.scripts.fish_scales import OccupiedDist
+    dist = OccupiedDist(1, filled_graph)
+    node = filled_graph.nodes()[0]
+    dist.add_node(node, filled_graph)
+    for neighbor in filled_graph.neighbors(node)[:3]:
+        dist.add_node(neighbor, filled_graph)
+    dist.rem_node(node, filled_graph)
+    for tract in dist.perimeter:
+        assert dist.inside[tract] == len([n for n in filled_graph.neighbors(tract) if n in dist.nodes])
+    assert set(dist.inside) == set(dist.perimeter)
+
+
+def test_unoc_inside_counts(filled_graph):
+    """Test that an unoccupied district's perimeter is the tracts with outside neighbors."""
+    from gerrypy.scripts.fish_scales import UnoccupiedDist
+    unoc = UnoccupiedDist(None, filled_graph, tracts=filled_graph.nodes())
+    removed = filled_graph.nodes()[0]
+    unoc.rem_node(removed, filled_graph)
+    assert set(unoc.perimeter) == set(filled_graph.neighbors(removed))
+
+
 def test_unoc_rem_node(filled_graph):
     """Test that unoccupied district rem_node method properly removes a node from nodes."""
     from gerrypy.scripts.fish_scales import UnoccupiedDist
@@ -495,3 +673,759 @@ def test_build_state_right_number_districts(fill_colorado_multiple_districts):
     """Test that filling the state creates the correct number of districts."""
     from gerrypy.scripts.fish_scales import State
     assert len(fill_colorado_multiple_districts.districts) == 7
+
+
+def brute_force_next(state, dst, criteria):
+    """Pick the next tract the way select_next used to, by scanning the perimeter."""
+    best_rating = 0
+    best = None
+    counties = set(node.county for node in dst.nodes)
+    for tract in dst.perimeter:
+        if tract.districtid is None:
+            count = len([n for n in state.state_graph.neighbors(tract) if n.districtid == dst.districtID])
+            same_county = 1 if tract.county in counties else 0
+            rating = count * int(criteria['compactness']) + same_county * int(criteria['county'])
+            if rating > best_rating:
+                best_rating = rating
+                best = tract
+    return best
+
+
+@pytest.mark.parametrize('criteria', [
+    {'county': 1, 'compactness': 1},
+    {'county': 5, 'compactness': 1},
+    {'county': 1, 'compactness': 5},
+])
+def test_select_next_matches_scan(start_state, criteria):
+    """Test that the frontier picks the same tract a full perimeter scan would."""
+    from gerrypy.scripts.fish_scales import OccupiedDist
+    dst = OccupiedDist(1, start_state.state_graph)
+    start_state.districts.append(dst)
+    start_state.swap(dst, start_state.find_start())
+    for _ in range(100):
+        expected = brute_force_next(start_state, dst, criteria)
+        assert start_state.select_next(dst, criteria) is expected
+        start_state.swap(dst, expected)
+
+
+def test_district_counties(filled_graph):
+    """Test that a district counts its tracts per county."""
+    from gerrypy.scripts.fish_scales import OccupiedDist
+    nodes = filled_graph.nodes()[:20]
+    dist = OccupiedDist(1, filled_graph, tracts=nodes)
+    dist.rem_node(nodes[0], filled_graph)
+    assert sum(dist.counties.values()) == 19
+    assert set(dist.counties) == set(node.county for node in nodes[1:])
+
+
+def split_of(graph, removed):
+    """Remove a node from graph and return split_components' pieces around it."""
+    from gerrypy.scripts.fish_scales import split_components
+    sources = sorted(graph.neighbors(removed))
+    graph.remove_node(removed)
+    return split_components(sources, graph.neighbors, lambda node: 10)
+
+
+def test_split_components_whole():
+    """Test that removing a node from a cycle splits nothing."""
+    import networkx as nx
+    assert split_of(nx.cycle_graph(8), 0) == []
+
+
+def test_split_components_cut_off_piece():
+    """Test that the smaller side of a path is returned with its population."""
+    import networkx as nx
+    assert split_of(nx.path_graph(10), 2) == [([1, 0], 20)]
+
+
+def test_split_components_several_pieces():
+    """Test that every piece but the largest is returned."""
+    import networkx as nx
+    graph = nx.star_graph(3)
+    graph.add_edges_from([(3, 4), (4, 5)])
+    assert sorted(split_of(graph, 0)) == [([1], 10), ([2], 10)]
+
+
+def test_split_components_matches_connected_components(filled_graph):
+    """Test that cutting a band of Colorado matches networkx's components."""
+    import networkx as nx
+    graph = filled_graph.copy()
+    band = [node for node in graph.nodes() if node.gid % 50 == 0]
+    sources = set(n for node in band for n in graph.neighbors(node)) - set(band)
+    graph.remove_nodes_from(band)
+    from gerrypy.scripts.fish_scales import split_components, tract_population
+    pieces = split_components(sorted(sources, key=lambda node: node.gid), graph.neighbors, tract_population)
+    components = sorted(nx.connected_components(graph), key=len)[:-1]
+    components = [c for c in components if c & sources]
+    assert sorted(len(tracts) for tracts, population in pieces) == sorted(len(c) for c in components)
+    for tracts, population in pieces:
+        assert population == sum(node.tract_pop for node in tracts)
+
+
+def test_hop_distances_shrink():
+    """Test that adding a source only ever shortens hop counts."""
+    import networkx as nx
+    from gerrypy.scripts.fish_scales import HopDistances
+    hops = HopDistances(nx.path_graph(10))
+    hops.add_sources([0])
+    hops.add_sources([6])
+    assert [hops.get(node) for node in range(10)] == [0, 1, 2, 3, 2, 1, 0, 1, 2, 3]
+
+
+def test_hop_distances_unreached():
+    """Test that tracts no source reaches have no hop count."""
+    import networkx as nx
+    from gerrypy.scripts.fish_scales import HopDistances
+    hops = HopDistances(nx.Graph([(0, 1), (2, 3)]))
+    hops.add_sources([0])
+    assert hops.get(3) is None
+
+
+def test_find_start_unknown_seeding(start_state):
+    """Test that an unknown seeding mode is refused."""
+    with pytest.raises(ValueError):
+        start_state.find_start('middle')
+
+
+@pytest.mark.parametrize('seeding', ['border', 'farthest', 'kmeans++'])
+def test_fill_state_seeding(dummy_request, seeding):
+    """Test that every seeding mode claims every tract."""
+    from gerrypy.scripts.fish_scales import State
+    colorado = State(dummy_request, 7)
+    colorado.fill_state({'county': 1, 'compactness': 1, 'seeding': seeding, 'seed': 1})
+    assert not colorado.unoccupied
+    assert all(tract.districtid is not None for tract in colorado.state_graph)
+
+
+def test_find_start_farthest(start_state):
+    """Test that farthest seeding picks the perimeter tract the most hops from every district."""
+    from gerrypy.scripts.fish_scales import OccupiedDist
+    dst = OccupiedDist(1, start_state.state_graph)
+    start_state.districts.append(dst)
+    start_state.swap(dst, start_state.find_start())
+    start = start_state.find_start('farthest')
+    perimeter = start_state.unoccupied[0].perimeter
+    assert start_state.hops.get(start) == max(start_state.hops.get(tract) for tract in perimeter)
+
+
+def test_find_start_kmeans_seeded(dummy_request):
+    """Test that population weighted seeding repeats itself for the same seed."""
+    from gerrypy.scripts.fish_scales import State
+    plans = []
+    for _ in range(2):
+        colorado = State(dummy_request, 3)
+        colorado.fill_state({'county': 1, 'compactness': 1, 'seeding': 'kmeans++', 'seed': 4})
+        plans.append(sorted((tract.gid, tract.districtid) for tract in colorado.state_graph))
+    assert plans[0] == plans[1]
+
+
+def test_sources_linked():
+    """Test that sources bordering one another need no search."""
+    import networkx as nx
+    from gerrypy.scripts.fish_scales import sources_linked
+    graph = nx.path_graph(5)
+    assert sources_linked([1, 2, 3], graph.neighbors)
+    assert not sources_linked([1, 3], graph.neighbors)
+
+
+def test_label_islands():
+    """Test that islands are numbered in order of their lowest tract."""
+    import numpy as np
+    from gerrypy.scripts.array_engine import label_islands
+    from gerrypy.scripts.tractgraph import build_csr
+    offsets, neighbors = build_csr(6, [(0, 3), (1, 4), (4, 5)])
+    island = label_islands(np.asarray(offsets), np.asarray(neighbors))
+    assert island.tolist() == [0, 1, 2, 0, 1, 1]
+
+
+def test_expand_concatenates_neighbors():
+    """Test that expand lists each tract's neighbors in turn."""
+    import numpy as np
+    from gerrypy.scripts.array_engine import expand
+    from gerrypy.scripts.tractgraph import build_csr
+    offsets, neighbors = build_csr(4, [(0, 1), (1, 2), (2, 3)])
+    reached = expand(np.asarray(offsets), np.asarray(neighbors), np.array([1, 3]))
+    assert reached.tolist() == [0, 2, 2]
+
+
+@pytest.mark.parametrize('num_dst', [1, 7, 12])
+@pytest.mark.parametrize('criteria', [
+    {'county': 1, 'compactness': 1},
+    {'county': 5, 'compactness': 1},
+    {'county': 0, 'compactness': 3},
+    {'county': 1, 'compactness': 1, 'seeding': 'farthest'},
+    {'county': 1, 'compactness': 1, 'seeding': 'kmeans++', 'seed': 2},
+    {'county': 1, 'compactness': 1, 'polsby': 3},
+])
+def test_array_engine_matches_networkx(dummy_request, num_dst, criteria):
+    """Test that the array engine draws the same Colorado plan as State."""
+    from gerrypy.scripts.array_engine import ArrayState
+    from gerrypy.scripts.fish_scales import State
+    colorado = State(dummy_request, num_dst)
+    colorado.fill_state(criteria)
+    expected = [tract.districtid for tract in sorted(colorado.state_graph, key=lambda tract: tract.gid)]
+    arrays = ArrayState(dummy_request, num_dst)
+    arrays.build(criteria)
+    assert arrays.districtids() == expected
+    assert sorted(arrays.populations) == sorted(dst.population for dst in colorado.districts)
+
+
+@pytest.fixture
+def square_graph():
+    """A two by two grid of tracts: 0-1 on top, 2-3 below, in counties 1 and 2."""
+    from gerrypy.scripts.tractgraph import TractGraph, build_csr
+    offsets, neighbors = build_csr(4, [(0, 1), (0, 2), (1, 3), (2, 3)])
+    return TractGraph([1, 2, 3, 4], [10, 10, 10, 30], [1.0] * 4, [1, 1, 2, 2], [1] * 4, offsets, neighbors)
+
+
+def test_plan_metrics(square_graph):
+    """Test deviation, county splits and cut edges on a plan splitting both counties."""
+    from gerrypy.scripts.metrics import plan_metrics
+    metrics = plan_metrics(square_graph, [1, 2, 1, 2], 2)
+    assert metrics.deviation == pytest.approx(1 / 3)
+    assert metrics.county_splits == 2
+    assert metrics.cut_edges == 2
+
+
+@pytest.fixture
+def unit_square_graph():
+    """The square graph's grid as unit squares: each tract has a perimeter of 4 and a side with each neighbor."""
+    from array import array
+    from gerrypy.scripts.tractgraph import TractGraph, build_csr
+    offsets, neighbors = build_csr(4, [(0, 1), (0, 2), (1, 3), (2, 3)])
+    return TractGraph(
+        [1, 2, 3, 4], [10, 10, 10, 30], [1.0] * 4, [1, 1, 2, 2], [1] * 4, offsets, neighbors,
+        array('d', [4.0] * 4), array('d', [1.0] * len(neighbors)),
+    )
+
+
+def test_polsby_popper_metric(unit_square_graph):
+    """Test that two 2 by 1 rectangles score 4 pi 2 / 6 squared, and the whole square 4 pi 4 / 8 squared."""
+    import math
+    from gerrypy.scripts.metrics import polsby_popper
+    assert polsby_popper(unit_square_graph, [1, 1, 2, 2], 2).tolist() == pytest.approx([8 * math.pi / 36] * 2)
+    assert polsby_popper(unit_square_graph, [1, 1, 1, 1], 1).tolist() == pytest.approx([16 * math.pi / 64])
+
+
+def test_district_keeps_boundary(unit_square_graph):
+    """Test that a district's boundary and cut edges follow each tract added and removed."""
+    import math
+    from gerrypy.scripts.fish_scales import OccupiedDist, StateTemplate
+    state_graph, unoccupied = StateTemplate(unit_square_graph).clone()
+    tracts = state_graph.nodes()
+    dst = OccupiedDist(1, state_graph)
+    steps = []
+    for tract in tracts:
+        dst.add_node(tract, state_graph)
+        steps.append((dst.boundary, dst.cut_edges))
+    assert steps == [(4.0, 2), (6.0, 2), (8.0, 2), (8.0, 0)]
+    assert dst.polsby_popper == pytest.approx(math.pi / 4)
+    dst.rem_node(tracts[0], state_graph)
+    assert (dst.boundary, dst.cut_edges) == (8.0, 2)
+    assert dst.shared[tracts[0]] == 2.0
+
+
+def test_frontier_prefers_shared_boundary(unit_square_graph):
+    """Test that a polsby weight rates a tract by the share of its boundary the district has."""
+    from gerrypy.scripts.fish_scales import Frontier, OccupiedDist, StateTemplate
+    state_graph, unoccupied = StateTemplate(unit_square_graph).clone()
+    tracts = state_graph.nodes()
+    dst = OccupiedDist(1, state_graph, tracts=tracts[:3])
+    frontier = Frontier(dst, 0, 0, 4)
+    assert frontier.rating(tracts[3]) == pytest.approx(2.0)
+    assert frontier.best() is tracts[3]
+
+
+def test_pareto_front():
+    """Test that only plans some other plan improves on everywhere are dropped."""
+    from gerrypy.scripts.metrics import pareto_front
+    plans = [(0.1, 3, 50), (0.2, 2, 50), (0.2, 3, 50), (0.1, 3, 50)]
+    assert pareto_front(plans, key=lambda plan: plan) == [(0.1, 3, 50), (0.2, 2, 50), (0.1, 3, 50)]
+
+
+def test_start_criteria_seeds():
+    """Test that every start gets its own seed and random tie-breaking."""
+    from gerrypy.scripts.multistart import start_criteria
+    jobs = start_criteria({'county': 1, 'compactness': 1, 'seed': '5'}, 3)
+    assert [job['seed'] for job in jobs] == [5, 6, 7]
+    assert all(job['ties'] == 'random' and job['county'] == 1 for job in jobs)
+
+
+def test_multistart_sorted_by_deviation(tract_graph, tmpdir):
+    """Test that multistart returns a plan per start, best deviation first."""
+    from gerrypy.scripts.multistart import multistart
+    from gerrypy.scripts.snapshot import write_snapshot
+    path = str(tmpdir.join('tracts.graph'))
+    write_snapshot(path, tract_graph, 'f' * 40)
+    plans = multistart(path, 7, {'county': 1, 'compactness': 1}, 4, workers=1)
+    deviations = [plan.metrics.deviation for plan in plans]
+    assert len(plans) == 4 and deviations == sorted(deviations)
+    assert all((plan.assignment > 0).all() for plan in plans)
+
+
+def test_multistart_engines_agree(square_snapshot):
+    """Test that multistart draws the same plans with either engine, and refuses an unknown one."""
+    from gerrypy.scripts.multistart import multistart
+    criteria = {'county': 1, 'compactness': 1, 'seeding': 'kmeans++', 'seed': 2}
+    plans = multistart(square_snapshot, 2, criteria, 4, workers=1, engine='networkx')
+    expected = multistart(square_snapshot, 2, criteria, 4, workers=1, engine='array')
+    assert [plan.assignment.tolist() for plan in plans] == [plan.assignment.tolist() for plan in expected]
+    with pytest.raises(ValueError):
+        multistart(square_snapshot, 2, criteria, 1, workers=1, engine='bogus')
+
+
+def test_random_ties_repeat(tract_graph):
+    """Test that random tie-breaking gives the same plan for the same seed."""
+    from gerrypy.scripts.array_engine import ArrayState
+    state = ArrayState(None, 7, tract_graph=tract_graph)
+    criteria = {'county': 1, 'compactness': 1, 'ties': 'random', 'seed': 9}
+    assert (state.build(criteria) == state.build(criteria)).all()
+
+
+@pytest.mark.parametrize('seeding', ['border', 'kmeans++'])
+def test_random_ties_engines_agree(refine_grid, seeding):
+    """Test that State breaks ties at random exactly as ArrayState does."""
+    from gerrypy.scripts.array_engine import ArrayState
+    from gerrypy.scripts.fish_scales import State, StateTemplate
+    template = StateTemplate(refine_grid)
+    array_state = ArrayState(None, 3, tract_graph=refine_grid)
+    plans = set()
+    for seed in range(6):
+        criteria = {'county': 0, 'compactness': 1, 'seeding': seeding, 'ties': 'random', 'seed': seed}
+        assignment = State(None, 3, template=template).build(criteria).tolist()
+        assert assignment == array_state.build(criteria).tolist()
+        plans.add(tuple(assignment))
+    assert len(plans) > 1
+
+
+def grid_graph(size, tract_pop=None, lengths=False):
+    """Return a size by size grid of unit square tracts, one county per column.
+
+    tract_pop maps a tract to its population, 100 without it.  With lengths
+    the edge tracts are on the border and every tract has a perimeter and
+    border lengths.
+    """
+    from array import array
+    from gerrypy.scripts.tractgraph import TractGraph, build_csr
+    pairs = [(row * size + col, row * size + col + 1) for row in range(size) for col in range(size - 1)]
+    pairs += [(row * size + col, (row + 1) * size + col) for row in range(size - 1) for col in range(size)]
+    offsets, neighbors = build_csr(size * size, pairs)
+    tracts = range(size * size)
+    if not lengths:
+        return TractGraph(
+            [tract + 1 for tract in tracts], [tract_pop(tract) if tract_pop else 100 for tract in tracts],
+            [1.0] * len(tracts), [tract % size for tract in tracts], [0] * len(tracts), offsets, neighbors
+        )
+    edge = [tract // size in (0, size - 1) or tract % size in (0, size - 1) for tract in tracts]
+    return TractGraph(
+        [tract + 1 for tract in tracts], [tract_pop(tract) if tract_pop else 100 for tract in tracts],
+        [1.0] * len(tracts), [tract % size for tract in tracts], [int(border) for border in edge], offsets, neighbors,
+        array('d', [4.0] * len(tracts)), array('d', [1.0] * len(neighbors)),
+    )
+
+
+@pytest.fixture
+def grid_chain():
+    """A ReCom chain on an 8 by 8 grid split into four quadrants, one county per column."""
+    from gerrypy.scripts.recom import Recom
+    size = 8
+    graph = grid_graph(size)
+    tracts = range(size * size)
+    quadrants = [1 + (tract // size >= size // 2) * 2 + (tract % size >= size // 2) for tract in tracts]
+    return graph, Recom(graph, quadrants, epsilon=0.1, seed=3)
+
+
+def test_recom_tallies_match_recount(grid_chain):
+    """Test that incremental cut edges, splits and populations match a full recount."""
+    import numpy as np
+    from gerrypy.scripts.metrics import plan_metrics
+    graph, chain = grid_chain
+    history = chain.run(200)
+    assert any(step.accepted for step in history)
+    metrics = plan_metrics(graph, np.array(chain.assignment), 4)
+    assert (chain.cut_edges, chain.county_splits) == (metrics.cut_edges, metrics.county_splits)
+    assert chain.deviation() == pytest.approx(metrics.deviation)
+    assert sum(chain.populations) == 6400
+
+
+def test_recom_districts_stay_contiguous(grid_chain):
+    """Test that every district is still connected after many steps."""
+    import networkx as nx
+    graph, chain = grid_chain
+    chain.run(200)
+    for district in range(1, 5):
+        members = [tract for tract in range(64) if chain.assignment[tract] == district]
+        subgraph = nx.Graph()
+        subgraph.add_nodes_from(members)
+        subgraph.add_edges_from(
+            (tract, neighbor) for tract in members
+            for neighbor in graph.neighbors_of(tract) if chain.assignment[neighbor] == district
+        )
+        assert members and nx.is_connected(subgraph)
+
+
+def test_recom_balanced(grid_chain):
+    """Test that a balanced start never leaves epsilon."""
+    graph, chain = grid_chain
+    assert all(step.deviation <= 0.1 for step in chain.run(200))
+
+
+@pytest.fixture
+def refine_grid():
+    """An 8 by 8 grid of unit squares with its edge tracts on the border and populations that vary by row."""
+    return grid_graph(8, lambda tract: 100 + 10 * (tract // 8), lengths=True)
+
+
+def district_pieces(graph, assignment, district):
+    """Return how many connected pieces district's tracts form."""
+    import networkx as nx
+    members = [tract for tract in range(len(graph)) if assignment[tract] == district]
+    subgraph = nx.Graph()
+    subgraph.add_nodes_from(members)
+    subgraph.add_edges_from(
+        (tract, neighbor) for tract in members
+        for neighbor in graph.neighbors_of(tract) if assignment[neighbor] == district
+    )
+    return nx.number_connected_components(subgraph)
+
+
+def test_refine_evens_populations(refine_grid):
+    """Test that refining a lopsided split lowers its deviation, reports it, and keeps every district whole."""
+    import numpy as np
+    from gerrypy.scripts.metrics import population_deviation
+    from gerrypy.scripts.refine import refine_plan
+    lopsided = [1 if tract % 8 < 2 else 2 if tract < 32 else 3 for tract in range(64)]
+    refinement = refine_plan(refine_grid, lopsided, 3)
+    assert refinement.before == pytest.approx(population_deviation(refine_grid, np.array(lopsided), 3))
+    assert refinement.deviation == pytest.approx(population_deviation(refine_grid, np.array(refinement.assignment), 3))
+    assert refinement.deviation < 0.02 < refinement.before
+    assert refinement.moves > 0
+    assert all(district_pieces(refine_grid, refinement.assignment, district) == 1 for district in (1, 2, 3))
+
+
+def test_refine_keeps_balanced_plan(refine_grid):
+    """Test that a plan no move can improve is left alone."""
+    from gerrypy.scripts.refine import refine_plan
+    halves = [1 if tract % 8 < 4 else 2 for tract in range(64)]
+    refinement = refine_plan(refine_grid, halves, 2)
+    assert refinement.assignment == halves
+    assert (refinement.moves, refinement.passes) == (0, 1)
+
+
+def test_refine_never_splits_a_district():
+    """Test that a tract holding its district together stays, even when moving it would balance the plan."""
+    from gerrypy.scripts.refine import Refiner
+    from gerrypy.scripts.tractgraph import TractGraph, build_csr
+    offsets, neighbors = build_csr(5, [(0, 1), (1, 2), (0, 3), (1, 3), (1, 4), (2, 4), (3, 4)])
+    graph = TractGraph([1, 2, 3, 4, 5], [10, 10, 10, 1, 1], [1.0] * 5, [1] * 5, [0] * 5, offsets, neighbors)
+    refiner = Refiner(graph, [1, 1, 1, 2, 2], 2)
+    assert not refiner.stays_connected(1)
+    assert refiner.stays_connected(0)
+    refinement = refiner.refine()
+    assert refinement.assignment[1] == 1
+    assert district_pieces(graph, refinement.assignment, 1) == 1
+
+
+def random_grid_plan(rng, size, num_dst):
+    """Return a random plan of num_dst contiguous districts on a size by size grid, grown from random seeds."""
+    assignment = [0] * (size * size)
+    frontier = []
+    for district, seed in enumerate(rng.sample(range(size * size), num_dst), 1):
+        assignment[seed] = district
+        frontier.append(seed)
+    while frontier:
+        tract = frontier.pop(rng.randrange(len(frontier)))
+        row, col = divmod(tract, size)
+        for near_row, near_col in ((row - 1, col), (row + 1, col), (row, col - 1), (row, col + 1)):
+            neighbor = near_row * size + near_col
+            if 0 <= near_row < size and 0 <= near_col < size and not assignment[neighbor]:
+                assignment[neighbor] = assignment[tract]
+                frontier.append(neighbor)
+    return assignment
+
+
+def test_refine_keeps_random_plans_contiguous():
+    """Test that refining random plans never splits a district, even after tracts move back and forth."""
+    import random
+    from gerrypy.scripts.refine import Refiner
+    size, num_dst = 6, 4
+    for trial in range(700):
+        rng = random.Random(trial)
+        tract_pop = [rng.randint(50, 150) for _ in range(size * size)]
+        graph = grid_graph(size, tract_pop.__getitem__)
+        refinement = Refiner(graph, random_grid_plan(rng, size, num_dst), num_dst, max_search=size * size).refine()
+        for district in range(1, num_dst + 1):
+            assert district_pieces(graph, refinement.assignment, district) == 1, trial
+
+
+@pytest.mark.parametrize('criteria', [
+    {'county': 1, 'compactness': 1},
+    {'county': 0, 'compactness': 1, 'polsby': 3},
+])
+def test_refine_engines_agree(refine_grid, criteria):
+    """Test that State and ArrayState refine to the same plan and keep their district tallies up to date."""
+    from gerrypy.scripts.array_engine import ArrayState
+    from gerrypy.scripts.fish_scales import State, StateTemplate
+    from gerrypy.scripts.metrics import polsby_popper
+    state = State(None, 3, template=StateTemplate(refine_grid))
+    for num in range(3):
+        rem_pop = sum(unoc.population for unoc in state.unoccupied)
+        state.build_district(rem_pop / (3 - len(state.districts)), num + 1, criteria)
+    refinement = state.refine()
+    array_state = ArrayState(None, 3, tract_graph=refine_grid)
+    assignment = array_state.build(dict(criteria, refine='1'))
+    assert assignment.tolist() == refinement.assignment == [tract.districtid for tract in state.state_graph]
+    assert array_state.refinement == refinement
+    populations = [sum(refine_grid.tract_pop[tract] for tract in range(64) if assignment[tract] == num) for num in (1, 2, 3)]
+    assert [dst.population for dst in state.districts] == array_state.populations == populations
+    assert [dst.polsby_popper for dst in state.districts] == pytest.approx(polsby_popper(refine_grid, assignment, 3).tolist())
+    assert array_state.polsby_popper() == pytest.approx(polsby_popper(refine_grid, assignment, 3).tolist())
+
+
+def test_evaluate_plans_matches_plan_metrics(refine_grid):
+    """Test that scoring plans as a batch agrees with scoring them one at a time."""
+    import numpy as np
+    from gerrypy.scripts.evaluate import evaluate_plans
+    from gerrypy.scripts.metrics import plan_metrics
+    plans = np.array([
+        [1 if tract % 8 < 4 else 2 for tract in range(64)],
+        [1 if tract < 32 else 2 for tract in range(64)],
+        [1 + (tract // 8 + tract % 8) % 2 for tract in range(64)],  # A checkerboard: every tract its own piece.
+        [0] * 8 + [1] * 28 + [2] * 28,
+    ])
+    metrics = evaluate_plans(refine_grid, plans, 2, chunk=3)
+    for plan, deviation, county_splits, cut_edges in zip(plans, *metrics[1:4]):
+        assert (deviation, county_splits, cut_edges) == pytest.approx(tuple(plan_metrics(refine_grid, plan, 2)))
+    assert metrics.populations.tolist()[:2] == [[4320, 4320], [3680, 4960]]
+    assert metrics.pieces.tolist() == [[1, 1], [1, 1], [32, 32], [1, 1]]
+    assert metrics.contiguous.tolist() == [True, True, False, True]
+
+
+def test_evaluate_plans_rejects_bad_plans(refine_grid):
+    """Test that plans of the wrong length or with unknown districts are refused."""
+    from gerrypy.scripts.evaluate import evaluate_plans
+    with pytest.raises(ValueError):
+        evaluate_plans(refine_grid, [[1] * 63], 2)
+    with pytest.raises(ValueError):
+        evaluate_plans(refine_grid, [[3] * 64], 2)
+    assert evaluate_plans(refine_grid, [1] * 64, 2).pieces.tolist() == [[1, 0]]
+
+
+def test_rank():
+    """Test the share of the ensemble at or below a value."""
+    from gerrypy.scripts.recom import rank
+    assert rank(3, [1, 2, 3, 4]) == 0.75
+
+
+def test_plan_key_skips_random_builds():
+    """Test that plans seeded from the clock aren't cached and weights change the key."""
+    from gerrypy.scripts.plancache import plan_key
+    criteria = {'county': '1', 'compactness': '1', 'seeding': 'kmeans++', 'seed': None}
+    assert plan_key('f' * 40, 7, criteria) is None
+    assert plan_key('f' * 40, 7, criteria, starts=16) is not None
+    border = dict(criteria, seeding='border')
+    assert plan_key('f' * 40, 7, border) == plan_key('f' * 40, 7, dict(border, county=1))
+    assert plan_key('f' * 40, 7, border) != plan_key('f' * 40, 7, dict(border, county=2))
+    assert plan_key('f' * 40, 7, border) != plan_key('f' * 40, 7, dict(border, refine='1'))
+    assert plan_key('f' * 40, 7, border) != plan_key('f' * 40, 7, border, engine='networkx')
+
+
+def test_plan_cache_lists_planids(tmpdir):
+    """Test that the cache lists the ids of the plans it holds in memory and on disk."""
+    from gerrypy.scripts.plancache import CachedPlan, PlanCache
+    cache = PlanCache(str(tmpdir), memory_bytes=1)
+    for planid in (3, 4):
+        cache.get('key{}'.format(planid), lambda: CachedPlan(planid, [(1, 2)], '{}'))
+    tmpdir.join('plan-bogus.bin').write('not a plan')
+    assert cache.planids() == {3, 4}
+    assert PlanCache(str(tmpdir)).planids() == {3, 4}
+
+
+def test_plan_cache_memory_then_disk(tmpdir):
+    """Test that a plan is built once, then found in memory, then on disk by a new cache."""
+    from gerrypy.scripts.plancache import CachedPlan, PlanCache
+    plan = CachedPlan(4, [(1, 2), (2, 1)], '{"type": "FeatureCollection"}')
+    builds = []
+    cache = PlanCache(str(tmpdir))
+    assert cache.get('key', lambda: builds.append(1) or plan) == plan
+    assert cache.get('key', lambda: builds.append(1) or plan) == plan
+    fresh = PlanCache(str(tmpdir))
+    assert fresh.get('key', lambda: builds.append(1) or plan) == plan
+    assert builds == [1]
+    assert cache.stats()['misses'] == 1 and cache.stats()['memory_hits'] == 1
+    assert fresh.stats()['disk_hits'] == 1
+
+
+def test_plan_cache_evicts_past_limit(tmpdir):
+    """Test that both tiers drop the least recently used plan once full."""
+    from gerrypy.scripts.plancache import CachedPlan, PlanCache
+    cache = PlanCache(str(tmpdir), memory_bytes=150, disk_bytes=300)
+    for planid in range(3):
+        cache.get(str(planid), lambda: CachedPlan(planid, [], 'x' * 100))
+    assert cache.stats()['evictions'] == 3  # Two from memory, one file.
+    assert len(tmpdir.listdir()) == 2
+    assert cache.find(2).planid == 2
+    assert cache.find(0) is None and cache.find(1) is None
+
+
+def test_plan_cache_shares_the_graph_budget(tmpdir):
+    """Test that plans in memory are dropped when the process's budget makes room for something newer."""
+    from gerrypy.scripts.plancache import CachedPlan, PlanCache
+    from gerrypy.scripts.snapshot import hold, let_go, recall
+    cache = PlanCache(str(tmpdir), budget_bytes=150)
+    cache.get('key', lambda: CachedPlan(1, [], 'x' * 100))
+    assert cache.find(1).planid == 1
+    arcs = hold(('arcs', 'test', 0), 'f' * 40, object(), 100, memory_bytes=150)
+    assert cache.find(1) is None and cache.stats()['evictions'] == 1
+    assert recall(('arcs', 'test', 0), 'f' * 40) is arcs
+    assert recall(('arcs', 'test', 0), 'e' * 40) is None
+    let_go(('arcs', 'test', 0))
+
+
+def test_plan_cache_coalesces_identical_builds(tmpdir):
+    """Test that requests waiting on the same plan share one build."""
+    import threading
+    import time
+    from gerrypy.scripts.plancache import CachedPlan, PlanCache
+    cache = PlanCache(str(tmpdir))
+    started = threading.Event()
+    release = threading.Event()
+    builds = []
+
+    def build():
+        builds.append(1)
+        started.set()
+        release.wait()
+        return CachedPlan(1, [], '{}')
+    results = []
+    first = threading.Thread(target=lambda: results.append(cache.get('key', build)))
+    first.start()
+    started.wait()
+    others = [threading.Thread(target=lambda: results.append(cache.get('key', build))) for _ in range(3)]
+    for thread in others:
+        thread.start()
+    while cache.stats()['coalesced'] < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in [first] + others:
+        thread.join()
+    assert builds == [1] and len(results) == 4
+
+
+def test_feature_collection_is_valid_json():
+    """Test that the streamed features join into one FeatureCollection, empty or not."""
+    import json
+    from collections import namedtuple
+    from decimal import Decimal
+    from gerrypy.views.default import feature_collection
+    Row = namedtuple('Row', 'districtid area population geojson')
+    rows = [Row(1, Decimal('2.5'), 10, '{"type": "MultiPolygon", "coordinates": []}'), Row(2, Decimal('1'), 5, 'null')]
+    collection = json.loads(''.join(feature_collection(rows)))
+    assert [feature['properties']['id'] for feature in collection['features']] == [1, 2]
+    assert collection['features'][0]['properties']['color'] == 'blue'
+    assert json.loads(''.join(feature_collection([]))) == {'type': 'FeatureCollection', 'features': []}
+
+
+def test_pack_and_diff_districts():
+    """Test that a plan packs to a byte per tract and a diff lists only the tracts that moved."""
+    from gerrypy.scripts.assigndistrict import DIFF_RECORD, diff_districts, pack_districts
+    gids = [1, 2, 3, 5]
+    packed = pack_districts(gids, [(1, 2), (3, 7), (5, 1)])
+    base = pack_districts(gids, [(1, 2), (2, 3), (3, 1), (5, 1)])
+    assert packed == b'\x02\x00\x07\x01'
+    diff = diff_districts(packed, base)
+    assert list(DIFF_RECORD.iter_unpack(diff)) == [(1, 0), (2, 7)]
+    assert diff_districts(packed, packed) == b''
+
+
+@pytest.fixture
+def square_snapshot(square_graph, tmpdir):
+    """The path of a snapshot of the square graph."""
+    from gerrypy.scripts.snapshot import write_snapshot
+    path = str(tmpdir.join('square.graph'))
+    write_snapshot(path, square_graph, 'f' * 40)
+    return path
+
+
+def test_job_queue_stores_best_plan(square_snapshot):
+    """Test that a job builds its starts in the pool, stores the best plan once and shares its key."""
+    import time
+    from gerrypy.scripts.jobs import DONE, JobQueue
+    stored = []
+
+    def store(assignment):
+        stored.append(list(assignment))
+        return 7
+    queue = JobQueue(workers=2)
+    criteria = {'county': 1, 'compactness': 1, 'seed': 3}
+    job = queue.submit('key', square_snapshot, 2, criteria, 4, store)
+    assert queue.submit('key', square_snapshot, 2, criteria, 4, store) is job
+    while job.finished is None:
+        time.sleep(0.01)
+    queue.shutdown()
+    assert job.status == DONE and job.planid == 7 and job.progress == 1.0
+    assert len(stored) == 1 and set(stored[0]) == {1, 2}
+    assert queue.get(job.jobid) is job
+
+
+def test_job_queue_limits_and_cancels(square_snapshot):
+    """Test that a full queue refuses jobs and a cancelled job stores nothing."""
+    from gerrypy.scripts.jobs import CANCELLED, JobQueue, QueueFull
+    stored = []
+    queue = JobQueue(workers=1, max_jobs=1)
+    criteria = {'county': 1, 'compactness': 1, 'seed': 0}
+    job = queue.submit('first', square_snapshot, 2, criteria, 64, stored.append)
+    with pytest.raises(QueueFull):
+        queue.submit('second', square_snapshot, 2, criteria, 1, stored.append)
+    assert queue.cancel(job.jobid).status == CANCELLED
+    queue.submit('second', square_snapshot, 2, criteria, 1, lambda assignment: 1)
+    queue.shutdown()
+    assert job.status == CANCELLED and stored == []
+    assert queue.cancel('missing') is None
+
+
+def test_request_starts_validated():
+    """Test that starts must be a whole number from 1 to the configured most."""
+    from pyramid.httpexceptions import HTTPBadRequest
+    from gerrypy.views.default import request_starts
+    with testing.testConfig(settings={'gerrypy.max_starts': '16'}):
+        assert request_starts(testing.DummyRequest(params={'starts': '16'})) == 16
+        assert request_starts(testing.DummyRequest()) == 1
+        for starts in ('17', '0', '-1', 'many', '1.5'):
+            with pytest.raises(HTTPBadRequest):
+                request_starts(testing.DummyRequest(params={'starts': starts}))
+
+
+def test_pinned_snapshot_outlives_refresh(square_graph, tmpdir):
+    """Test that a stale snapshot a pending job pins is kept until the job finishes."""
+    from gerrypy.scripts.jobs import JobQueue
+    from gerrypy.scripts.snapshot import _remove_stale, write_snapshot
+    stale = str(tmpdir.join('tracts-colorado-old.graph'))
+    current = str(tmpdir.join('tracts-colorado-new.graph'))
+    write_snapshot(stale, square_graph, 'a' * 40)
+    queue = JobQueue(workers=1)
+    job = queue.submit(None, stale, 2, {'county': 1, 'compactness': 1, 'seed': 0}, 32, lambda assignment: 1)
+    _remove_stale(str(tmpdir), 'tracts-colorado-', current)
+    assert tmpdir.join('tracts-colorado-old.graph').check()
+    queue.cancel(job.jobid)
+    queue.shutdown()
+    _remove_stale(str(tmpdir), 'tracts-colorado-', current)
+    assert not tmpdir.join('tracts-colorado-old.graph').check()
+
+
+def test_state_clones_from_template(square_graph):
+    """Test that States cloned from one template build apart and draw the array engine's plan."""
+    from gerrypy.scripts.array_engine import ArrayState
+    from gerrypy.scripts.fish_scales import State, StateTemplate
+    template = StateTemplate(square_graph)
+    first = State(None, 2, template=template)
+    second = State(None, 2, template=template)
+    criteria = {'county': 1, 'compactness': 1}
+    for num in range(2):
+        first.build_district(sum(unoc.population for unoc in first.unoccupied) / (2 - num), num + 1, criteria)
+    assert all(tract.districtid is None for tract in second.state_graph)
+    assert [tract.gid for tract in second.unoccupied[0].perimeter] == [1, 2, 3, 4]
+    assert len(second.unoccupied[0].nodes) == len(template.unoccupied[0].nodes) == 4
+    assert second.population == 60
+    expected = ArrayState(None, 2, tract_graph=square_graph).build(criteria).tolist()
+    assert [tract.districtid for tract in first.state_graph] == expected
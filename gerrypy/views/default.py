@@ -1,7 +1,29 @@
 """Handle view requests."""
+import json
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import numpy as np
+import transaction
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound, HTTPNotModified, HTTPServiceUnavailable
+from pyramid.response import Response
 from pyramid.view import view_config
-from gerrypy.scripts.fish_scales import State
-from gerrypy.models.mymodel import DistrictView
+from gerrypy.models import get_tm_session
+from gerrypy.models.datasets import COLORADO, get_dataset
+from gerrypy.scripts.assigndistrict import (
+    assign_gids, diff_districts, keep_plans, pack_districts, plan_assignments, plan_dataset, prune_plans,
+    tract_gids,
+)
+from gerrypy.scripts.evaluate import evaluate_plans, max_plans
+from gerrypy.scripts.jobs import DONE, QUEUED, RUNNING, QueueFull, get_job_queue, max_starts
+from gerrypy.scripts.multistart import ENGINES
+from gerrypy.scripts.plancache import CachedPlan, get_plan_cache, plan_key
+from gerrypy.scripts.snapshot import current_fingerprint, memory_budget, request_tract_graph
+from gerrypy.scripts.tiles import encode_tile, tile_dir, tile_features
+from gerrypy.scripts.topology import MAX_ZOOM, dissolve_plan, pixel_size, resolution, tract_shapes
+
+
+COLORS = ['blue', 'red', 'yellow', 'purple', 'orange', 'green', 'black']
 
 
 @view_config(route_name='home', renderer='../templates/home.jinja2')
@@ -11,20 +33,211 @@ def home_view(request):
 
 
 @view_config(route_name='map', renderer='../templates/map.jinja2')
+@view_config(route_name='map', renderer='json', xhr=True)
+@view_config(route_name='state_map', renderer='../templates/map.jinja2')
+@view_config(route_name='state_map', renderer='json', xhr=True)
 def map_view(request):
-    """If form submitted, generate districts and build geojson api."""
+    """If form submitted, queue the districts' build, or link to them if they're cached.
+
+    The page submits its form with XMLHttpRequest and gets the job or the
+    plan's links back as JSON.  It polls the job until the plan is stored,
+    then re-colors the tracts it already has.  /map/<state> draws the named
+    dataset's districts; /map draws Colorado's.
+    """
+    dataset = find_dataset(request)
     if request.GET:  # Unless 'Generate Districts' is clicked, there are no GET params.
         criteria = {
             'county': request.GET['countyweight'],
-            'compactness': request.GET['compactweight']
+            'compactness': request.GET['compactweight'],
+            'polsby': request.GET.get('polsbyweight', 0),
+            'refine': request.GET.get('refine', 0),
+            'seeding': request.GET.get('seeding', 'border'),
+            'seed': request.GET.get('seed'),
         }
-        num_dst = 7
-        state = State(request, num_dst)
-        state.fill_state(criteria)
-        with open('gerrypy/views/geo.json', 'w') as the_file:  # Builds the API for GMaps to read.
-            the_file.write(build_JSON(request))
-        return {'geojson': 'ready'}
-    return {}
+        engine = request.GET.get('engine', 'networkx')
+        if engine not in ENGINES:
+            raise HTTPBadRequest('Unknown engine {!r}.'.format(engine))
+        num_dst = dataset.num_dst
+        starts = request_starts(request)
+        dbsession = request.dbsession
+        key = plan_key(current_fingerprint(dbsession, dataset), num_dst, criteria, starts, engine)
+        plan = get_plan_cache(request).lookup(key) if key is not None else None
+        if plan is not None:
+            return page_result(request, dataset, plan_links(request, plan.planid))
+        tract_graph = request_tract_graph(request, dataset)
+        store = plan_store(request.registry, key, list(tract_graph.gid), dataset)
+        try:
+            job = get_job_queue(request).submit(key, tract_graph.snapshot_path, num_dst, criteria, starts, store, engine)
+        except QueueFull as error:
+            raise HTTPServiceUnavailable(str(error), headers={'Retry-After': '10'})
+        return page_result(request, dataset, job_status(request, job))
+    return {'dataset': dataset}
+
+
+def request_starts(request):
+    """Return how many starts the form asks for, from 1 to max_starts."""
+    limit = max_starts(request)
+    try:
+        starts = int(request.GET.get('starts', 1))
+    except ValueError:
+        starts = 0
+    if not 1 <= starts <= limit:
+        raise HTTPBadRequest('starts must be a whole number from 1 to {}.'.format(limit))
+    return starts
+
+
+def page_result(request, dataset, result):
+    """Return result as JSON for the page's script, or with the dataset for the map template."""
+    if not request.is_xhr:
+        result['dataset'] = dataset
+    return result
+
+
+def find_dataset(request):
+    """Return the dataset named by the URL's state, or Colorado's if it names none."""
+    dataset = get_dataset(request, request.matchdict.get('state', COLORADO.name))
+    if dataset is None:
+        raise HTTPNotFound()
+    return dataset
+
+
+def find_plan_dataset(request, planid):
+    """Return the dataset a plan was drawn for."""
+    dataset = get_dataset(request, plan_dataset(request.dbsession, planid) or '')
+    if dataset is None:
+        raise HTTPNotFound()
+    return dataset
+
+
+def plan_store(registry, key, gids, dataset=COLORADO):
+    """Return a function storing an assignment in gids order as a plan of dataset, for the job queue.
+
+    It runs outside any request, so it opens its own session and
+    transaction, and it caches the plan under key like a build in a
+    request would.  Then all but the newest gerrypy.keep_plans plans are
+    deleted, unless the plan cache still links to them.
+    """
+    def store(assignment):
+        manager = transaction.TransactionManager()
+        with manager:
+            request = SimpleNamespace(registry=registry, dbsession=get_tm_session(registry['dbsession_factory'], manager))
+
+            def build():
+                planid = assign_gids(request, zip(gids, (int(district) or None for district in assignment)), dataset)
+                geojson = ''.join(feature_collection(
+                    dissolve_plan(request.dbsession, planid, dataset=dataset, memory_bytes=memory_budget(request))
+                ))
+                return CachedPlan(planid, plan_assignments(request.dbsession, planid), geojson)
+            cache = get_plan_cache(request)
+            plan = build() if key is None else cache.get(key, build)
+            keep = keep_plans(request)
+            if keep:
+                prune_plans(request.dbsession, keep, cache.planids() | {plan.planid})
+        return plan.planid
+    return store
+
+
+def plan_links(request, planid):
+    """Return a plan's id and the links to its GeoJSON and packed districts."""
+    return {
+        'planid': planid,
+        'geojson': request.route_url('plan_geojson', planid=planid),
+        'districts': request.route_url('plan_districts', planid=planid),
+    }
+
+
+def job_status(request, job):
+    """Return a job's status with the links to poll and cancel it, and its plan's once it's done."""
+    status = job.as_dict()
+    status['job'] = request.route_url('job', jobid=job.jobid)
+    status['cancel'] = request.route_url('job_cancel', jobid=job.jobid)
+    if job.status == DONE:
+        status.update(plan_links(request, job.planid))
+    return status
+
+
+def find_job(request):
+    """Return the job named in the URL."""
+    job = get_job_queue(request).get(request.matchdict['jobid'])
+    if job is None:
+        raise HTTPNotFound()
+    return job
+
+
+@view_config(route_name='job', renderer='json')
+def job_view(request):
+    """Return a plan build's status and progress, for the page to poll."""
+    return job_status(request, find_job(request))
+
+
+@view_config(route_name='job_result', renderer='json')
+def job_result_view(request):
+    """Return the links to a job's plan.
+
+    While it is building, answer 202 with its status; if it failed or
+    was cancelled, 410.
+    """
+    job = find_job(request)
+    if job.status == DONE:
+        return plan_links(request, job.planid)
+    request.response.status = 202 if job.status in (QUEUED, RUNNING) else 410
+    return job_status(request, job)
+
+
+@view_config(route_name='job_cancel', renderer='json', request_method='POST')
+def job_cancel_view(request):
+    """Cancel a plan build and return its status."""
+    job = get_job_queue(request).cancel(request.matchdict['jobid'])
+    if job is None:
+        raise HTTPNotFound()
+    return job_status(request, job)
+
+
+@view_config(route_name='evaluate', renderer='json', request_method='POST')
+@view_config(route_name='state_evaluate', renderer='json', request_method='POST')
+def evaluate_view(request):
+    """Score a batch of plans of the state without drawing or storing them.
+
+    The body is either JSON, {"plans": [[district, ...], ...]}, or
+    application/octet-stream, plans one after another packed a byte per
+    tract as plan_districts sends them.  Either way each plan has a
+    district for every tract in gid order, the order of tract_geojson's
+    tracts, with 0 for none.  The scores come back a list per field, one
+    entry per plan.
+    """
+    dataset = find_dataset(request)
+    tract_graph = request_tract_graph(request, dataset)
+    plans = requested_plans(request, len(tract_graph))
+    if len(plans) > max_plans(request):
+        raise HTTPBadRequest('At most {} plans can be scored at once.'.format(max_plans(request)))
+    try:
+        metrics = evaluate_plans(tract_graph, plans, dataset.num_dst)
+    except ValueError as error:
+        raise HTTPBadRequest(str(error))
+    result = OrderedDict([('plans', len(metrics.deviation))])
+    for field, values in zip(metrics._fields, metrics):
+        result[field] = values.tolist()
+    return result
+
+
+def requested_plans(request, num_tracts):
+    """Return the plans in the request's body, as packed bytes or as JSON lists."""
+    if request.content_type == 'application/octet-stream':
+        body = request.body
+        if len(body) % num_tracts:
+            raise HTTPBadRequest('Packed plans must have a byte for each of the {} tracts.'.format(num_tracts))
+        return np.frombuffer(body, dtype=np.uint8).reshape(-1, num_tracts)
+    try:
+        body = request.json_body
+    except ValueError:
+        raise HTTPBadRequest('The body must be JSON or packed plans.')
+    plans = body.get('plans') if isinstance(body, dict) else None
+    if not isinstance(plans, list):
+        raise HTTPBadRequest('The JSON must have a list of plans.')
+    try:
+        return np.array(plans)
+    except ValueError:
+        raise HTTPBadRequest('Plans must have one district for each of the {} tracts.'.format(num_tracts))
 
 
 @view_config(route_name='about', renderer='../templates/about.jinja2')
@@ -52,16 +265,134 @@ def about_view(request):
     }
 
 
-def build_JSON(request):
-    """Build JSON from the polygons in the database."""
-    geojson_queries = request.dbsession.query(DistrictView.geom.ST_AsGeoJSON()).all()
-    properties = request.dbsession.query(DistrictView).all()
-    colors = ['blue', 'red', 'yellow', 'purple', 'orange', 'green', 'black']
+@view_config(route_name='plan_geojson', http_cache=3600)
+def plan_geojson_view(request):
+    """Stream a plan's districts as GeoJSON.  A plan never changes, so browsers may keep it.
+
+    A zoom level or a west,south,east,north bbox asks for shapes simplified
+    and rounded to what the map can show there; without either the shapes
+    are full resolution.
+    """
+    planid = int(request.matchdict['planid'])
+    size = requested_pixel_size(request)
+    level, decimals = resolution(size)
+    plan = get_plan_cache(request).find(planid) if size is None else None
+    if plan is not None:
+        chunks = [plan.geojson]
+    else:
+        districts = dissolve_plan(  # Fetched now; the transaction ends before the body is sent.
+            request.dbsession, planid, level=level, decimals=decimals, dataset=find_plan_dataset(request, planid),
+            memory_bytes=memory_budget(request),
+        )
+        if not districts:
+            raise HTTPNotFound()
+        chunks = feature_collection(districts)
+    response = Response(content_type='application/geo+json', charset='utf-8')
+    response.app_iter = (chunk.encode('utf-8') for chunk in chunks)
+    return response
+
+
+@view_config(route_name='plan_tile', http_cache=3600)
+def plan_tile_view(request):
+    """Return a vector tile of the tracts, each tagged with its district in the plan."""
+    planid, z, x, y = (int(request.matchdict[name]) for name in ('planid', 'z', 'x', 'y'))
+    if z > MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        raise HTTPNotFound()
+    assignment = find_assignment(request, planid)
+    dataset = find_plan_dataset(request, planid)
+    dbsession = request.dbsession
+    features = tile_features(
+        dbsession, current_fingerprint(dbsession, dataset), tile_dir(request), z, x, y, dataset, memory_budget(request)
+    )
+    return Response(body=encode_tile(features, dict(assignment)), content_type='application/vnd.mapbox-vector-tile')
+
+
+@view_config(route_name='plan_districts', http_cache=3600)
+def plan_districts_view(request):
+    """Return a plan's districts as one byte per tract, in the order of tract_geojson's tracts.
+
+    With base=<planid>, return only the tracts whose district differs from
+    that plan's, as DIFF_RECORDs of their position and new district.
+    """
+    planid = int(request.matchdict['planid'])
+    dataset = find_plan_dataset(request, planid)
+    gids = tract_gids(request.dbsession, dataset)
+    packed = pack_districts(gids, find_assignment(request, planid))
+    base = request.GET.get('base')
+    if base is not None:
+        if not base.isdigit():
+            raise HTTPBadRequest('base must be a planid.')
+        if find_plan_dataset(request, int(base)) != dataset:
+            raise HTTPBadRequest('base must be a plan of the same state.')
+        packed = diff_districts(packed, pack_districts(gids, find_assignment(request, int(base))))
+    return Response(body=packed, content_type='application/octet-stream')
+
+
+@view_config(route_name='tract_geojson', http_cache=3600)
+@view_config(route_name='state_tract_geojson', http_cache=3600)
+def tract_geojson_view(request):
+    """Stream every tract's shape in the state as GeoJSON, for the map to color by plan.
+
+    Takes zoom or bbox like plan_geojson_view.  The shapes change only with
+    the tract tables, so the response is tagged with their fingerprint and
+    browsers that have it are told it hasn't changed.
+    """
+    dataset = find_dataset(request)
+    level, decimals = resolution(requested_pixel_size(request))
+    etag = '{}-{}-{}'.format(current_fingerprint(request.dbsession, dataset), level, decimals)
+    if etag in request.if_none_match:
+        return HTTPNotModified(etag=etag)
+    chunks = tract_collection(tract_shapes(request.dbsession, level, decimals, dataset, memory_budget(request)))
+    response = Response(content_type='application/geo+json', charset='utf-8', etag=etag)
+    response.app_iter = (chunk.encode('utf-8') for chunk in chunks)
+    return response
+
+
+def requested_pixel_size(request):
+    """Return the degrees per pixel asked for by the zoom or bbox parameter, or None."""
+    try:
+        return pixel_size(request.GET.get('zoom'), request.GET.get('bbox'))
+    except ValueError:
+        raise HTTPBadRequest('zoom must be a whole number and bbox west,south,east,north.')
+
+
+def find_assignment(request, planid):
+    """Return a plan's (gid, districtid) pairs, from the plan cache if it's there."""
+    plan = get_plan_cache(request).find(planid)
+    assignment = plan.assignment if plan is not None else plan_assignments(request.dbsession, planid)
+    if not assignment:
+        raise HTTPNotFound()
+    return assignment
+
+
+def feature_collection(districts):
+    """Yield a GeoJSON FeatureCollection of district rows one feature at a time."""
+    yield '{"type": "FeatureCollection", "features": ['
+    for idx, district in enumerate(districts):
+        properties = json.dumps(OrderedDict([
+            ('id', district.districtid),
+            ('area', float(district.area)),
+            ('population', int(district.population)),
+            ('color', COLORS[idx % len(COLORS)]),
+        ]))
+        yield '{}{{"type": "Feature", "properties": {}, "geometry": {}}}'.format(',' if idx else '', properties, district.geojson)
+    yield ']}'
+
+
+def tract_collection(tracts):
+    """Yield a GeoJSON FeatureCollection of TractShapes one feature at a time.
 
-    json_string = '{"type": "FeatureCollection","features": ['
-    for idx, block in enumerate(properties):
-        json_string += '{' + '"type": "Feature", "properties": '
-        json_string += '{'
-        json_string += '"id": {}, "area": {}, "population": {}, "color": "{}"'.format(str(block.districtid), str(block.area), str(block.population), str(colors[idx % 7])) + '}'
-        json_string += ', "geometry": {}'.format(geojson_queries[idx][0]) + '}' + ','
-    return json_string[:-1] + ']}'
+    Each feature's id is its gid and its index property its position, which
+    is where plan_districts_view puts its district.
+    """
+    yield '{"type": "FeatureCollection", "features": ['
+    for idx, tract in enumerate(tracts):
+        properties = json.dumps(OrderedDict([
+            ('index', idx),
+            ('area', float(tract.area)),
+            ('population', int(tract.population)),
+        ]))
+        yield '{}{{"type": "Feature", "id": {}, "properties": {}, "geometry": {}}}'.format(
+            ',' if idx else '', tract.gid, properties, tract.geojson
+        )
+    yield ']}'
@@ -12,6 +12,7 @@ requires = [
     'psycopg2',
     'jupyter',
     'networkx',
+    'numpy',
     'geoalchemy2'
 ]
 
@@ -54,5 +55,8 @@ setup(name='GerryPy',
       main = gerrypy:main
       [console_scripts]
       initialize_db = gerrypy.scripts.initializedb:main
+      gerrypy_benchmark = gerrypy.scripts.benchmarks:main
+      gerrypy_ensemble = gerrypy.scripts.recom:main
+      gerrypy_tiles = gerrypy.scripts.tiles:main
       """,
       )